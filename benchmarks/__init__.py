@@ -0,0 +1,4 @@
+'''
+Benchmarks for ir_module. Run the suite from the repository root with
+    python -m benchmarks.run [--quick] [--filter PATTERN] [--output FILE] [--compare BASELINE]
+'''
@@ -0,0 +1,29 @@
+'''
+Compare the whole-signal FFT convolution engine with the uniformly-partitioned overlap-save engine.
+Run from the repository root:
+    python -m benchmarks.bench_convolve [source_seconds] [ir_seconds] [block_size]
+'''
+import sys
+import numpy as np
+from ir_module import convolve, default
+from .harness import measure
+
+
+def main(source_seconds=120, ir_seconds=4, block_size=default.block_size):
+    rng = np.random.default_rng(0)
+    source = (rng.random(default.sample_rate * source_seconds, dtype=np.float32) - 0.5)
+    decay = np.exp(-np.arange(default.sample_rate * ir_seconds) / default.sample_rate * 3).astype(np.float32)
+    impulse = (rng.random(len(decay), dtype=np.float32) - 0.5) * decay
+
+    fft_out, fft_time, fft_peak = measure(convolve.convolve_audio, source, impulse)
+    part_out, part_time, part_peak = measure(convolve.convolve_audio, source, impulse, engine='partitioned', block_size=block_size)
+    # the output array itself is unavoidable, report what each engine needs on top of it
+    out_bytes = part_out.nbytes
+    print(f'{source_seconds}s source, {ir_seconds}s IR @ {default.sample_rate}Hz, block size {block_size}')
+    print(f'  fft:         {fft_time:.3f}s, {(fft_peak - out_bytes) / 2**20:.1f} MiB working memory')
+    print(f'  partitioned: {part_time:.3f}s, {(part_peak - out_bytes) / 2**20:.1f} MiB working memory')
+    print(f'  max abs difference: {np.max(np.abs(fft_out - part_out)):.2e}')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,44 @@
+'''
+Compare the FFT choices of fft_backend on the deconvolution of a 30 s sweep: transforms at the raw convolution
+length against the next fast length, and one worker thread against all CPUs for a multichannel recording.
+Run from the repository root:
+    python -m benchmarks.bench_fft [sweep_seconds] [channels] [backend]
+'''
+import sys
+import numpy as np
+from ir_module import default, fft_backend as fb
+from . import synthetic
+from .harness import measure
+
+
+def _deconvolve(recorded, sweep, nfft, workers):
+    conv_len = len(recorded) + len(sweep) - 1
+    inverse = fb.rfft(sweep[::-1], nfft, workers=workers)
+    spectra = fb.rfft(recorded, nfft, axis=0, workers=workers)
+
+    return fb.irfft(spectra * inverse[:, np.newaxis], nfft, axis=0, workers=workers)[:conv_len]
+
+
+def main(sweep_seconds=30, channels=8, backend='scipy'):
+    fb.set_backend(backend)
+    sample_rate = default.sample_rate
+    sweep = synthetic.sweep(sweep_seconds, sample_rate)
+    impulse = synthetic.room_impulse_response(1, sample_rate, channels)
+    recorded = synthetic.recordings(sweep, impulse, 1, max_shift=0)[0]
+    conv_len = len(recorded) + len(sweep) - 1
+    fast_len = fb.next_fast_len(conv_len)
+
+    print(f'{sweep_seconds}s sweep, {channels} channels @ {sample_rate}Hz, backend {fb.get_backend()}')
+    results = {}
+    for label, nfft, workers in (('raw length, 1 worker', conv_len, 1), ('fast length, 1 worker', fast_len, 1),
+                                 ('fast length, all CPUs', fast_len, -1)):
+        results[label], seconds, peak = measure(_deconvolve, recorded, sweep, nfft, workers)
+        print(f'  {label:<24} nfft {nfft:>9}: {seconds:.3f}s, {peak / 2**20:.1f} MiB peak')
+    reference = results['raw length, 1 worker']
+    difference = np.max(np.abs(reference - results['fast length, all CPUs'])) / np.max(np.abs(reference))
+    print(f'  max difference relative to the peak: {difference:.2e}')
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(*(int(arg) for arg in args[:2]), *args[2:])
@@ -0,0 +1,69 @@
+'''
+Compare the vectorized WAVE decoding path in wav_util against the original list-based readers.
+Run from the repository root:
+    python -m benchmarks.bench_wav_decode [seconds]
+'''
+import os, struct, sys, tempfile
+import wave as w
+import numpy as np
+from ir_module import wav_util, default
+from .harness import measure
+
+
+def legacy_read_16bit(wav_obj, params):
+    frames = wav_obj.readframes(params.nframes)
+    sample_array = struct.unpack(f'<{params.nframes}h', frames)
+    samples = np.array(sample_array, 'f')
+    return samples / (2**15)
+
+
+def legacy_read_24bit(wave_obj, params):
+    frames = wave_obj.readframes(params.nframes)
+    frames = [
+        frames[i] | (frames[i + 1] << 8) | (frames[i + 2] << 16)
+        for i in range(0, params.nframes * 3, 3)
+    ]
+    sign_bit = 0x800000
+    sign_mask = sign_bit - 1
+    def sign_extend(value):
+        return (value & sign_mask) - (value & sign_bit)
+    frames = [sign_extend(f) / sign_bit for f in frames]
+    return np.array(frames, 'f')
+
+
+def legacy_read(wavfile):
+    with w.open(wavfile, 'rb') as wav:
+        params = wav.getparams()
+        if params.sampwidth == 2:
+            return legacy_read_16bit(wav, params)
+        return legacy_read_24bit(wav, params)
+
+
+def write_test_file(fname, sampwidth, nframes):
+    rng = np.random.default_rng(0)
+    ints = rng.integers(-(2**(8 * sampwidth - 1)), 2**(8 * sampwidth - 1), nframes, dtype=np.int32)
+    data = ints.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :sampwidth].tobytes()
+    with w.open(fname, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(sampwidth)
+        wav.setframerate(default.sample_rate)
+        wav.writeframes(data)
+
+
+def main(seconds=30):
+    nframes = default.sample_rate * seconds
+    with tempfile.TemporaryDirectory() as tmp:
+        for sampwidth in (2, 3):
+            fname = os.path.join(tmp, f'bench_{sampwidth * 8}bit.wav')
+            write_test_file(fname, sampwidth, nframes)
+            old, old_time, old_peak = measure(legacy_read, fname)
+            (_, new), new_time, new_peak = measure(wav_util.read_wave_nbit, fname)
+            assert np.allclose(old, new, atol=1e-6)
+            print(f'{sampwidth * 8}-bit, {seconds}s @ {default.sample_rate}Hz: '
+                  f'legacy {old_time:.3f}s / {old_peak / 2**20:.1f} MiB peak, '
+                  f'vectorized {new_time:.3f}s / {new_peak / 2**20:.1f} MiB peak '
+                  f'({old_time / new_time:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -0,0 +1,161 @@
+'''
+Minimal benchmark harness: a registry of parameterized cases, timing with peak-memory tracking,
+JSON results tagged with the git commit, and comparison of two result files.
+'''
+import fnmatch, itertools, json, os, platform, subprocess, time, tracemalloc
+import numpy as np
+import scipy
+
+# name -> (function, parameter grid, quick parameter grid)
+cases = {}
+
+
+def benchmark(name, quick=None, **grid):
+    '''
+    Register a benchmark case. The decorated function is called with one keyword argument per grid entry, for every
+    combination of values, and returns (run, frames): run is a callable without arguments that does the timed work,
+    and frames is the number of sample frames it processes, for the throughput.
+    :name: (string) case name, e.g. 'wav_util.read'
+    :quick: optional smaller grid used with --quick; missing entries fall back to grid
+    :grid: parameter name -> list of values
+    '''
+    def register(func):
+        cases[name] = (func, grid, dict(grid, **(quick or {})))
+        return func
+
+    return register
+
+
+def measure(func, *args, **kwargs):
+    '''
+    Call func once, tracing allocations.
+    Returns its result, the elapsed wall time in seconds and the peak traced memory in bytes.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def time_run(run, repeat=5, min_time=0.2):
+    '''
+    Time run() without tracing (tracemalloc slows allocation-heavy code down), repeating it at least repeat times
+    and for at least min_time seconds, then once more with tracing for the peak memory.
+    Returns a dict with the best and median wall times in seconds and the peak memory in bytes.
+    '''
+    run()
+    times = []
+    total = 0.0
+    while len(times) < repeat or total < min_time:
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+        total += times[-1]
+    _, _, peak = measure(run)
+
+    return {'best': min(times), 'median': float(np.median(times)), 'repeats': len(times), 'peak_bytes': peak}
+
+
+def git_commit():
+    '''
+    Returns the commit hash of the working tree, with '-dirty' appended when there are uncommitted changes,
+    or None outside a git repository.
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ('-dirty' if dirty else '')
+
+
+def environment():
+    '''
+    Returns a dict describing the machine and library versions the results were recorded with.
+    '''
+    return {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def case_id(name, params):
+    '''
+    Returns a stable identifier of one parameter combination of a case, e.g. 'convolve[channels=2,seconds=10]'.
+    '''
+    return f'{name}[{",".join(f"{key}={value}" for key, value in sorted(params.items()))}]'
+
+
+def run(pattern='*', quick=False, repeat=5, log=print):
+    '''
+    Run every registered case whose name matches the glob pattern, over its parameter grid.
+    Returns a dict with the environment and a result per case id: parameters, timings, peak memory and throughput
+    in frames per second.
+    '''
+    results = {}
+    for name, (func, grid, quick_grid) in cases.items():
+        if not fnmatch.fnmatch(name, pattern):
+            continue
+        grid = quick_grid if quick else grid
+        keys = sorted(grid)
+        for values in itertools.product(*(grid[key] for key in keys)):
+            params = dict(zip(keys, values))
+            run_case, frames = func(**params)
+            timing = time_run(run_case, repeat=1 if quick else repeat)
+            timing['frames_per_second'] = frames / timing['best']
+            results[case_id(name, params)] = dict(timing, name=name, params=params)
+            log(f'{case_id(name, params):<80} {timing["best"] * 1e3:10.2f} ms {timing["peak_bytes"] / 2**20:9.1f} MiB '
+                f'{timing["frames_per_second"] / 1e6:9.2f} Mframes/s')
+            del run_case
+
+    return {'environment': environment(), 'results': results}
+
+
+def save(results, path):
+    '''
+    Write results from run to a JSON file.
+    '''
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1)
+
+
+def load(path):
+    '''
+    Read results written by save.
+    '''
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(baseline, current, threshold=0.1, log=print):
+    '''
+    Compare two result sets (from run or load) case by case.
+    :threshold: relative change in best time or peak memory reported as a regression or improvement
+    Returns the list of case ids that regressed.
+    '''
+    log(f'baseline {baseline["environment"]["commit"]}  ->  current {current["environment"]["commit"]}')
+    regressions = []
+    for case, new in current['results'].items():
+        old = baseline['results'].get(case)
+        if old is None:
+            continue
+        time_ratio = new['best'] / old['best']
+        memory_ratio = (new['peak_bytes'] + 1) / (old['peak_bytes'] + 1)
+        flag = ''
+        if time_ratio > 1 + threshold or memory_ratio > 1 + threshold:
+            flag = 'REGRESSION'
+            regressions.append(case)
+        elif time_ratio < 1 - threshold or memory_ratio < 1 - threshold:
+            flag = 'improved'
+        log(f'{case:<80} time x{time_ratio:6.2f}  memory x{memory_ratio:6.2f}  {flag}')
+
+    return regressions
@@ -0,0 +1,39 @@
+'''
+Run the benchmark suite, optionally saving the results and comparing them with an earlier run.
+Run from the repository root:
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --compare results.json
+'''
+import argparse, sys
+import matplotlib
+# graph_stft draws with pyplot; benchmarks never open a window
+matplotlib.use('Agg')
+from . import harness, suite
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', default='*', help='glob pattern of the case names to run, e.g. "convolve.*"')
+    parser.add_argument('--quick', action='store_true', help='run a reduced parameter grid, once per combination')
+    parser.add_argument('--repeat', type=int, default=5, help='minimum number of timed runs per combination')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change reported as a regression')
+    parser.add_argument('--list', action='store_true', help='list the registered cases and exit')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, (_, grid, _) in harness.cases.items():
+            print(name, grid)
+        return 0
+    results = harness.run(args.filter, quick=args.quick, repeat=args.repeat)
+    if args.output:
+        harness.save(results, args.output)
+    if args.compare:
+        regressions = harness.compare(harness.load(args.compare), results, threshold=args.threshold)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
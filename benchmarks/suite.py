@@ -0,0 +1,156 @@
+'''
+Benchmark cases for the hot paths of ir_module, registered with harness.benchmark.
+Each case builds its synthetic input once per parameter combination, outside the timed function.
+'''
+import os, subprocess, sys, tempfile
+import numpy as np
+from ir_module import acoustics, avg_signal as avg, convolve, fft_backend as fb, gen_sine as gs, graph, impulse_response as ir, resample as rs, wav_util
+from . import synthetic
+from .harness import benchmark
+
+# WAVE formats as (comptype, sampwidth)
+formats = {'int16': ('NONE', 2), 'int24': ('NONE', 3), 'float32': ('FLOAT', 4)}
+_workdir = tempfile.TemporaryDirectory(prefix='ir_module_bench_')
+
+
+def _path(name):
+    return os.path.join(_workdir.name, name)
+
+
+def _noise(seconds, sample_rate, channels, seed=0):
+    rng = np.random.default_rng(seed)
+    shape = (int(seconds * sample_rate), channels) if channels > 1 else (int(seconds * sample_rate),)
+    return (rng.random(shape, dtype=np.float32) - 0.5) * 1.8
+
+
+@benchmark('wav_util.read', quick={'seconds': [1], 'channels': [1]}, seconds=[1, 10, 60], channels=[1, 2], format=list(formats))
+def wav_read(seconds, channels, format):
+    comptype, sampwidth = formats[format]
+    path = _path(f'read_{seconds}_{channels}_{format}.wav')
+    samples = _noise(seconds, 48000, channels)
+    with wav_util.WaveWriter(path, 48000, channels, sampwidth, comptype) as writer:
+        writer.write(samples)
+
+    return (lambda: wav_util.read_wave_nbit(path)), len(samples)
+
+
+@benchmark('wav_util.write', quick={'seconds': [1], 'channels': [1]}, seconds=[1, 10, 60], channels=[1, 2], format=list(formats))
+def wav_write(seconds, channels, format):
+    comptype, sampwidth = formats[format]
+    path = _path(f'write_{seconds}_{channels}_{format}.wav')
+    samples = _noise(seconds, 48000, channels)
+
+    def run():
+        with wav_util.WaveWriter(path, 48000, channels, sampwidth, comptype, dither=comptype == 'NONE') as writer:
+            writer.write_blocks(wav_util.iter_blocks(samples, 1 << 16))
+
+    return run, len(samples)
+
+
+@benchmark('gen_sine.exp_sweep', quick={'seconds': [1], 'sample_rate': [48000]}, seconds=[1, 10, 60], sample_rate=[44100, 48000, 96000])
+def exp_sweep(seconds, sample_rate):
+    return (lambda: gs.exp_sweep(50, 5000, seconds, sample_rate=sample_rate)), seconds * sample_rate
+
+
+@benchmark('avg_signal.xcorr_and_avg', quick={'seconds': [1], 'takes': [4], 'channels': [1]}, seconds=[1, 5, 20], takes=[4, 16], channels=[1, 2])
+def xcorr_and_avg(seconds, takes, channels):
+    directory = _path(f'takes_{seconds}_{takes}_{channels}')
+    source = synthetic.sweep(seconds, 48000)
+    recorded = synthetic.recordings(source, synthetic.room_impulse_response(0.5, 48000, channels), takes)
+    synthetic.write_takes(directory, recorded, 48000)
+    nframes = recorded.shape[1]
+
+    return (lambda: avg.xcorr_and_avg(directory, nframes)), nframes * takes
+
+
+@benchmark('impulse_response.deconvolve_invfilt', quick={'seconds': [1], 'sample_rate': [48000], 'channels': [1]},
+           seconds=[1, 10, 30], sample_rate=[48000, 96000], channels=[1, 2], cache=['cold', 'warm'])
+def deconvolve_invfilt(seconds, sample_rate, channels, cache):
+    source = synthetic.sweep(seconds, sample_rate)
+    recorded = synthetic.recordings(source, synthetic.room_impulse_response(1, sample_rate, channels), 1)[0]
+
+    def run():
+        if cache == 'cold':
+            ir.default_deconvolver.clear()
+        ir.deconvolve_invfilt(recorded, source, sample_rate=sample_rate)
+
+    return run, len(recorded)
+
+
+@benchmark('fft_backend.rfft', quick={'seconds': [1], 'channels': [1]}, seconds=[1, 30], channels=[1, 8], length=['raw', 'fast'], workers=[1, -1])
+def fft_rfft(seconds, channels, length, workers):
+    samples = _noise(seconds, 48000, channels)
+    # a recording plus a sweep of the same length, as in deconvolution
+    nfft = 2 * len(samples) - 1
+    nfft = fb.next_fast_len(nfft) if length == 'fast' else nfft
+
+    return (lambda: fb.irfft(fb.rfft(samples, nfft, axis=0, workers=workers), nfft, axis=0, workers=workers)), len(samples)
+
+
+@benchmark('impulse_response.extract_ir', quick={'seconds': [1]}, seconds=[1, 4])
+def extract_ir(seconds):
+    rir = synthetic.room_impulse_response(seconds, 48000)
+    noisy = rir + np.random.default_rng(1).standard_normal(len(rir)).astype(np.float32) * 1e-4
+
+    return (lambda: ir.extract_ir(noisy, 48000)), len(noisy)
+
+
+@benchmark('convolve.convolve_audio', quick={'seconds': [10], 'ir_seconds': [1], 'channels': [1]},
+           seconds=[10, 60], ir_seconds=[1, 4], channels=[1, 2], engine=['fft', 'partitioned'])
+def convolve_audio(seconds, ir_seconds, channels, engine):
+    source = _noise(seconds, 48000, channels) * 0.5
+    impulse = synthetic.room_impulse_response(ir_seconds, 48000, channels)
+
+    return (lambda: convolve.convolve_audio(source, impulse, engine=engine)), len(source)
+
+
+@benchmark('convolve.convolve_one_to_many', quick={'irs': [4]}, seconds=[10], irs=[4, 16], method=['loop', 'batched'])
+def convolve_one_to_many(seconds, irs, method):
+    source = _noise(seconds, 48000, 1) * 0.5
+    impulses = [synthetic.room_impulse_response(1, 48000, seed=seed) for seed in range(irs)]
+
+    if method == 'loop':
+        return (lambda: [convolve.convolve_audio(source, impulse) for impulse in impulses]), len(source) * irs
+    return (lambda: convolve.convolve_one_to_many(source, impulses)), len(source) * irs
+
+
+@benchmark('resample.resample', quick={'rates': ['44100-48000']}, seconds=[10], channels=[1, 2], rates=['44100-48000', '48000-96000', '96000-48000'])
+def resample(seconds, channels, rates):
+    old_rate, new_rate = (int(rate) for rate in rates.split('-'))
+    samples = _noise(seconds, old_rate, channels)
+
+    return (lambda: rs.resample(samples, old_rate, new_rate)), len(samples)
+
+
+@benchmark('graph.graph_stft', quick={'seconds': [1], 'sample_rate': [48000]}, seconds=[1, 10], sample_rate=[48000, 96000])
+def graph_stft(seconds, sample_rate):
+    import matplotlib.pyplot as plt
+    samples = synthetic.sweep(seconds, sample_rate)
+
+    def run():
+        graph.graph_stft(samples, sample_rate=sample_rate, show=False)
+        plt.close('all')
+
+    return run, len(samples)
+
+
+@benchmark('graph.streaming_spectrogram', quick={'seconds': [10]}, seconds=[10, 60], sample_rate=[48000, 96000])
+def streaming_spectrogram(seconds, sample_rate):
+    samples = _noise(seconds, sample_rate, 1)
+
+    return (lambda: graph.streaming_spectrogram(samples, sample_rate=sample_rate)), len(samples)
+
+
+@benchmark('acoustics.analyze', quick={'irs': [1]}, irs=[1, 32])
+def analyze(irs):
+    rirs = [synthetic.room_impulse_response(1, 48000, seed=seed) for seed in range(irs)]
+
+    return (lambda: acoustics.analyze(rirs, 48000)), irs * 48000
+
+
+@benchmark('import', quick={'module': ['ir_module.Signal']}, module=['ir_module', 'ir_module.cli', 'ir_module.Signal', 'ir_module.batch'])
+def import_time(module):
+    # a new interpreter per run, so the time includes its startup, as for a batch worker process
+    command = [sys.executable, '-c', f'import {module}']
+
+    return (lambda: subprocess.run(command, check=True)), 0
@@ -0,0 +1,59 @@
+'''
+Synthetic measurement data for the benchmarks: sweeps, room impulse responses and multi-take recordings.
+'''
+import os
+import numpy as np
+from scipy import signal
+from ir_module import gen_sine as gs, wav_util
+from ir_module.measure import simulated_room
+
+
+def sweep(seconds, sample_rate, start=50, end=5000):
+    '''
+    Returns an exponential sweep from gen_sine.exp_sweep.
+    '''
+    return gs.exp_sweep(start, end, seconds, sample_rate=sample_rate)
+
+
+def room_impulse_response(seconds, sample_rate, channels=1, rt60=0.8, delay=0.005, seed=0):
+    '''
+    Returns a simulated room impulse response from measure.simulated_room: a direct-sound impulse followed by
+    exponentially decaying noise, (frames,) or (frames, channels), peak-normalized to 0.9.
+    '''
+    return simulated_room(sample_rate, rt60=rt60, seconds=seconds, channels=channels, delay=delay, seed=seed)
+
+
+def recordings(source, rir, takes, noise_db=-60, max_shift=200, seed=0):
+    '''
+    Simulate repeated recordings of source played into a room: each take is the convolution of source with rir,
+    shifted by a random number of frames (up to max_shift) and with white noise at noise_db relative to full scale.
+    Returns a (takes, frames) or (takes, frames, channels) float32 array, peak-normalized to 0.9.
+    '''
+    rng = np.random.default_rng(seed)
+    wet = signal.fftconvolve(source[:, np.newaxis] if rir.ndim == 2 else source, rir, axes=0)
+    wet *= 0.9 / np.max(np.abs(wet))
+    frames = len(wet) + max_shift
+    out = np.empty((takes, frames) + wet.shape[1:], dtype=np.float32)
+    for take in range(takes):
+        shift = rng.integers(0, max_shift + 1)
+        out[take] = rng.standard_normal(out.shape[1:]) * 10 ** (noise_db / 20)
+        out[take, shift:shift + len(wet)] += wet
+    out *= 0.9 / np.max(np.abs(out))
+
+    return out
+
+
+def write_takes(directory, takes, sample_rate, sampwidth=2):
+    '''
+    Write every take to '<directory>/take_<n>.wav'.
+    Returns the list of file paths.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, take in enumerate(takes):
+        path = os.path.join(directory, f'take_{i}.wav')
+        with wav_util.WaveWriter(path, sample_rate, take.shape[1] if take.ndim == 2 else 1, sampwidth) as writer:
+            writer.write(take)
+        paths.append(path)
+
+    return paths
@@ -1,4 +1,4 @@
-from ir_module import wav_util, default, graph
+from ir_module import wav_util, default, graph, instrument
 from ir_module.Signal import Signal
 import numpy as np
 from scipy import signal
@@ -14,12 +14,17 @@ input = Signal(inp, ip.framerate, ip.nchannels, ip.sampwidth)
 out_sig = Signal(sig, p.framerate, p.nchannels, p.sampwidth)
 
 # deconvolve input and speaker effects from recorded signal
-deconvolved = out_sig.deconvolve(input)
-dec_signal = deconvolved.get_signal()
+with instrument.track_allocations('deconvolve'):
+    deconvolved = out_sig.deconvolve(input)
+# keep only the impulse response, from its onset until it decays into the noise floor
+with instrument.track_allocations('extract_ir'):
+    rir = deconvolved.extract_ir()
 # normalize signal to ensure that floating-point values are between -1 and 1 (exclusive)
-overflow = np.argmax(np.abs(dec_signal))
-if np.abs(dec_signal)[overflow] >= 1:
-    dec_signal = dec_signal * (1/np.abs(dec_signal[overflow])) * 0.95
+with instrument.track_allocations('normalize'):
+    rir.normalize(0.95, inplace=True)
+dec_signal = rir.get_signal()
+# memory allocated by each step
+print(instrument.format_report())
 
 # plot extracted RIR
 plt.plot(dec_signal)
@@ -7,10 +7,8 @@ seconds = 5
 params, ir = wav_util.read_wave_nbit('demo/impulse_responses/garage_rir.wav')
 params, dry_audio = wav_util.read_wave_nbit('demo/dry_audio/bach_prelude_mono.wav')
 
-start = np.argmax(ir)
-impulse = ir[start:start+(default.sample_rate * seconds)]
-impulse = np.append(np.zeros(1000), impulse)
-ibytes = wav_util.samples_to_bytes_16bit(impulse)
+# garage_rir.wav is written by demo.py, already trimmed to the impulse response; cap its length for playback
+impulse = ir[:default.sample_rate * seconds]
 
 
 audio = Signal(dry_audio, params.framerate, params.nchannels, params.sampwidth)
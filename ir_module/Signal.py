@@ -1,18 +1,25 @@
-from distutils.log import error
-import scipy.signal as signal
-import math
-from . import avg_signal as avg, convolve, default, gen_sine as gs, graph, impulse_response as ir
+import numpy as np
+from . import acoustics, avg_signal as avg, convolve, default, gen_sine as gs, graph, impulse_response as ir, instrument, resample as rs, wav_util
 
 
 class Signal:
-    def __init__(self, signal, sps=default.sample_rate, channels=default.channels, width=default.sample_width):
+    __slots__ = ('_sample_rate', '_channels', '_sample_width', '_signal', '_dtype')
+
+    def __init__(self, signal, sps=default.sample_rate, channels=default.channels, width=default.sample_width, dtype=default.dtype):
         '''
         Initialize an instance of the Signal class. Includes parameters pertaining to the sampling rate and format of the data.
+        :signal: numpy array of floating-point samples, or a wav_util.MappedWave that is decoded the first time the samples are needed.
+        Multichannel signals are (frames, channels) arrays, and their channel count takes precedence over channels.
+        :dtype: working precision of the samples, np.float32 (default) or np.float64. Samples of another dtype are
+        converted once, here; an array that already has the working dtype is used without copying.
+        Signals returned by the methods of this instance keep its dtype.
         '''
+        self._dtype = np.dtype(dtype)
+        assert self._dtype in (np.float32, np.float64), f'dtype must be float32 or float64: {self._dtype}'
         self._sample_rate = sps
-        self._channels = channels
+        self._signal = signal if isinstance(signal, wav_util.MappedWave) else np.asarray(signal, dtype=self._dtype)
+        self._channels = self._signal.shape[1] if self._signal.ndim == 2 else channels
         self._sample_width = width
-        self._signal = signal
 
 
     def get_state(self):
@@ -29,11 +36,50 @@ class Signal:
         return self._sample_rate
     
 
+    def get_channels(self):
+        '''
+        Returns the number of channels in the signal.
+        '''
+        return self._channels
+
+
+    def get_dtype(self):
+        '''
+        Returns the working dtype of the samples.
+        '''
+        return self._dtype
+
+
+    def get_nframes(self):
+        '''
+        Returns the number of frames in the signal, without decoding a lazy source.
+        '''
+        return len(self._signal)
+
+
+    def is_lazy(self):
+        '''
+        Returns True if the samples are still backed by an undecoded file.
+        '''
+        return isinstance(self._signal, wav_util.MappedWave)
+
+
     def get_signal(self):
         '''
         Returns the signal as a numpy array of floating-point values.
+        A lazy source is decoded on the first call, and the decoded array is kept.
         '''
+        if self.is_lazy():
+            self._signal = np.asarray(self._signal, dtype=self._dtype)
         return self._signal
+
+
+    def blocks(self, blocksize, overlap=0, pad=False):
+        '''
+        Yield the signal in blocks of blocksize frames, with the given overlap between consecutive blocks.
+        A lazy source is decoded one block at a time and is not materialized.
+        '''
+        yield from wav_util.iter_blocks(self._signal, blocksize, overlap=overlap, pad=pad)
     
 
     def set_state(self, signal, sps, channels, width):
@@ -41,87 +87,273 @@ class Signal:
         Set or change the base parameters of the Signal instance.
         '''
         self._sample_rate = sps
-        self._channels = channels
-        self._width = width
-        self._signal = signal
+        self._signal = signal if isinstance(signal, wav_util.MappedWave) else np.asarray(signal, dtype=self._dtype)
+        self._channels = self._signal.shape[1] if self._signal.ndim == 2 else channels
+        self._sample_width = width
 
 
     def set_signal(self, samples):
         '''
         Set or change the signal within the Signal instance.
         '''
-        self._signal = samples
+        self._signal = samples if isinstance(samples, wav_util.MappedWave) else np.asarray(samples, dtype=self._dtype)
+        if self._signal.ndim == 2:
+            self._channels = self._signal.shape[1]
     
 
-    def copy(self):
-        cp_rate, cp_chan, cp_width = self.get_state()
-        cp_signal = self._signal
-        copied = Signal(cp_rate, cp_chan, cp_width)
-        copied.set_signal(cp_signal)
+    @instrument.instrumented()
+    def copy(self, dtype=None):
+        '''
+        Returns a new Signal instance with its own copy of the samples, optionally converted to another dtype.
+        A lazy source is read-only, so the copy shares it and stays lazy.
+        '''
+        dtype = self._dtype if dtype is None else dtype
+        samples = self._signal if self.is_lazy() else np.array(self._signal, dtype=dtype)
+
+        return Signal(samples, self._sample_rate, self._channels, self._sample_width, dtype)
+
+
+    def view(self, start=None, stop=None):
+        '''
+        Returns a new Signal instance sharing the samples of this instance (frames start to stop), without copying.
+        Changes made in place to either instance are visible in both. A lazy source is decoded first.
+        '''
+        return Signal(self.get_signal()[start:stop], self._sample_rate, self._channels, self._sample_width, self._dtype)
+
+
+    def _writable(self):
+        # in-place operations need an array of our own; decoded and cached arrays may be read-only or shared
+        samples = self.get_signal()
+        if not samples.flags.writeable:
+            self._signal = samples = samples.copy()
+        return samples
+
+
+    @instrument.instrumented()
+    def scale(self, gain, inplace=False):
+        '''
+        Multiply the samples by gain.
+        :inplace: (bool) modify this instance instead of returning a new one
+        Returns the scaled Signal instance (this instance when inplace).
+        '''
+        if not inplace:
+            return Signal(self.get_signal() * self._dtype.type(gain), self._sample_rate, self._channels, self._sample_width, self._dtype)
+        samples = self._writable()
+        np.multiply(samples, self._dtype.type(gain), out=samples)
+
+        return self
+
+
+    @instrument.instrumented()
+    def normalize(self, peak=1.0, inplace=False):
+        '''
+        Scale the samples so their largest absolute value, over all channels, is peak. Silent signals are unchanged.
+        :inplace: (bool) modify this instance instead of returning a new one
+        Returns the normalized Signal instance (this instance when inplace).
+        '''
+        samples = self.get_signal()
+        # max and min do not allocate a temporary array, unlike np.abs
+        current = max(samples.max(), -samples.min()) if len(samples) > 0 else 0
+
+        return self.scale(peak / current if current > 0 else 1, inplace=inplace)
+
 
-        return copied
+    @instrument.instrumented()
+    def trim(self, start=None, stop=None, inplace=False):
+        '''
+        Keep only frames start to stop.
+        :inplace: (bool) modify this instance, which then holds a view of its former samples, instead of returning a
+        new Signal instance with a copy
+        Returns the trimmed Signal instance (this instance when inplace).
+        '''
+        if inplace:
+            self._signal = self.get_signal()[start:stop]
+            return self
+
+        return Signal(self.get_signal()[start:stop].copy(), self._sample_rate, self._channels, self._sample_width, self._dtype)
     
 
+    @instrument.instrumented()
     def resample(self, new_sps):
         '''
         Up- or down-sample signal to new_sps sampling rate
         :new_sps: New sampling rate, can be value greater or less than original sampling rate.
+        Uses a polyphase FIR filter with a cached design per conversion ratio, see resample.resample.
         Returns the new sampling upon successful resampling
         '''
         if self._sample_rate == new_sps:
             return new_sps
 
-        signal_length = int(math.floor(len(self._signal) / self._sample_rate))
-        old_sps = self._sample_rate
+        self._signal = rs.resample(self.get_signal(), self._sample_rate, new_sps)
         self._sample_rate = new_sps
-        resamp_factor = new_sps / self._sample_rate
-        new_frames = int(len(self._sample_rate) * resamp_factor)
-        resampled = signal.resample(self._signal, new_frames)
-        self._signal = resampled
-        
-        if int(math.floor((self._signal / new_sps))) != signal_length:
-            self._sample_rate = old_sps
-            error(f'error in converting sampling rate from {old_sps}sps to {new_sps}sps')
-        
+
         return new_sps
     
 
-    def convolve(self, impulse_response):
+    @instrument.instrumented()
+    def convolve(self, impulse_response, engine='fft', block_size=default.block_size):
         '''
         Assumes the Signal instance is a dry audio signal, convolve with given room impulse response to get a transformed signal.
         If Signal and impulse_response are not of same sampling rate, the impulse_response will be resampled to match the Signal
-        :impulse_response: a Signal instance, containing a numpy array of floating-point values representing a room impulse response
+        Multichannel signals and/or impulse responses are convolved channel by channel in a single batched pass.
+        :impulse_response: a Signal instance, containing a numpy array of floating-point values representing a room impulse response,
+        or a convolve.PartitionedConvolver with precomputed partition spectra (e.g. from ir_library.IRLibrary.convolver), which
+        selects the 'partitioned' engine with its own block size. A PartitionedConvolver is not resampled, so it must have been
+        made at the sampling rate of this Signal.
+        :engine: ['fft', 'partitioned'] see convolve.convolve_audio. The 'partitioned' engine reads a lazy Signal block by block
+        without decoding it as a whole.
+        :block_size: (int) partition size in frames for the 'partitioned' engine
         Returns a Signal instance containing the transformed signal
         '''
-        assert self._sample_rate == impulse_response.get_sps(), f'impulse_response and signal sampling rates must match: Signal: {self.get_sps()}; Impulse Response: {impulse_response.get_sps()}'
-        convolved = convolve.convolve_audio(self._signal, impulse_response.get_signal())
+        if isinstance(impulse_response, convolve.PartitionedConvolver):
+            impulse, engine, channels = impulse_response, 'partitioned', impulse_response.get_channels()
+        else:
+            impulse, channels = _impulse_at(impulse_response, self._sample_rate), impulse_response.get_channels()
+        source = self._signal if engine == 'partitioned' else self.get_signal()
+        convolved = convolve.convolve_audio(source, impulse, engine=engine, block_size=block_size)
 
-        return Signal(convolved, self._sample_rate, self._channels, self._sample_width)
+        return Signal(convolved, self._sample_rate, max(self._channels, channels), self._sample_width, self._dtype)
 
 
+    @instrument.instrumented()
+    def convolve_many(self, impulse_responses, workers=None, max_memory=default.batch_memory):
+        '''
+        Convolve this Signal with every impulse response in impulse_responses, transforming this Signal only once
+        (see convolve.convolve_one_to_many). Impulse responses are resampled to the sampling rate of this Signal as in convolve.
+        :impulse_responses: list of Signal instances
+        :workers: (int) number of threads per FFT, -1 for all CPUs, default fft_backend.get_workers()
+        :max_memory: (int) bound in bytes on the intermediate arrays of one batch
+        Returns a list of Signal instances, one per impulse response.
+        '''
+        impulses = [_impulse_at(impulse_response, self._sample_rate) for impulse_response in impulse_responses]
+        convolved = convolve.convolve_one_to_many(self.get_signal(), impulses, workers=workers, max_memory=max_memory)
+
+        return [Signal(conv, self._sample_rate, max(self._channels, impulse_response.get_channels()), self._sample_width, self._dtype)
+                for conv, impulse_response in zip(convolved, impulse_responses)]
+
+
+    @instrument.instrumented()
     def deconvolve(self, input_signal):
         '''
         Extracts the impulse response from this Signal instance, which is assumed to be a recording of input_signal.
-        Signal and input_signal must have matching sampling rates
+        If Signal and input_signal are not of same sampling rate, input_signal will be resampled to match the Signal
+        All channels of a multichannel recording are deconvolved together, reusing one transform of input_signal.
+        The spectrum of the inverse filter is cached, so repeated deconvolution against the same input_signal does not transform it again.
         :input_signal: a Signal instance, with original input signal from which this Signal instance was generated.
         Returns a Signal instance representing the extracted impulse response
         '''
-        assert self._sample_rate == input_signal.get_sps(), f'input signal sampling rate must match Signal instance'
-        deconv = ir.deconvolve_invfilt(self._signal, input_signal.get_signal(), mode='freq')
+        deconv = ir.deconvolve_invfilt(self.get_signal(), input_signal.get_signal(), mode='freq', sample_rate=input_signal.get_sps(), output_rate=self._sample_rate)
+
+        return Signal(deconv, self._sample_rate, self._channels, self._sample_width, self._dtype)
+
+
+    @instrument.instrumented()
+    def deconvolve_exp_sweep(self, start, end, duration, st_amp=0.75, end_amp=0.75):
+        '''
+        Extracts the impulse response from this Signal instance, which is assumed to be a recording of an exponential
+        sweep generated by gen_sine.exp_sweep with the given parameters, using the analytic inverse filter.
+        See impulse_response.deconvolve_exp_sweep for more information.
+        Returns a Signal instance representing the extracted impulse response
+        '''
+        deconv = ir.deconvolve_exp_sweep(self.get_signal(), start, end, duration, self._sample_rate, st_amp, end_amp)
+
+        return Signal(deconv, self._sample_rate, self._channels, self._sample_width, self._dtype)
+
+
+    @instrument.instrumented()
+    def extract_ir(self, pre_onset=0.002, fade_out=0.05, max_seconds=None, sweep=None):
+        '''
+        Assumes the Signal instance is a deconvolved recording, and trims it to the linear impulse response: from just
+        before the direct sound onset to where the decay meets the noise floor, with short fades.
+        See impulse_response.extract_ir for the parameters.
+        Returns a Signal instance containing the trimmed impulse response
+        '''
+        trimmed, _ = ir.extract_ir(self.get_signal(), self._sample_rate, pre_onset=pre_onset, fade_out=fade_out, max_seconds=max_seconds, sweep=sweep)
+
+        return Signal(trimmed, self._sample_rate, self._channels, self._sample_width, self._dtype)
+
+
+    @instrument.instrumented()
+    def acoustic_parameters(self, fraction=1):
+        '''
+        Assumes the Signal instance is an impulse response, and computes its room acoustic parameters per octave
+        (fraction=1) or third-octave (fraction=3) band. Multichannel signals are analyzed on their first channel.
+        See acoustics.analyze for more information, and to analyze many impulse responses at once.
+        Returns a dict of per-band numpy arrays: 'EDT', 'T20', 'T30', 'C50', 'C80', 'D50' and the band 'centres'.
+        '''
+        params = acoustics.analyze([self.get_signal()], self._sample_rate, fraction=fraction)
 
-        return Signal(deconv, self._sample_rate, self._channels, self._sample_width)
+        return {name: (values if name == 'centres' else values[0]) for name, values in params.items()}
 
 
-def average_signal(directory, num_frames):
+    @instrument.instrumented()
+    def spectrogram(self, fname, background=False, **kwargs):
+        '''
+        Render a spectrogram of the signal to an image file, without a display. A lazy source is read in chunks and is
+        not materialized. See graph.spectrogram_to_file for the keyword arguments.
+        Returns fname, or the rendering thread when background is True.
+        '''
+        return graph.spectrogram_to_file(self._signal, fname, sample_rate=self._sample_rate, background=background, **kwargs)
+
+
+@instrument.instrumented()
+def load_signal(wavfile, lazy=False, dtype=default.dtype):
+    '''
+    Read a WAVE file into a Signal instance.
+    :wavfile: (string) path to the file
+    :lazy: (bool) memory-map the file and defer decoding until the samples are needed
+    :dtype: working dtype of the Signal instance, see Signal
+    Returns a Signal instance.
+    '''
+    params, frames = wav_util.read_wave_nbit(wavfile, lazy=lazy)
+
+    return Signal(frames, params.framerate, params.nchannels, params.sampwidth, dtype)
+
+
+@instrument.instrumented()
+def average_signal(directory, num_frames, cache=None):
     '''
     See documentation in avg_signal.py for more information.
     :directory: (string)
     :num_frames: (int)
+    :cache: optional cache.DiskCache
     Returns a numpy array of floating-point values.
     '''
-    return avg.xcorr_and_avg(directory, num_frames)
+    return avg.xcorr_and_avg(directory, num_frames, cache=cache)
+
+
+@instrument.instrumented()
+def convolve_signals(signals, impulse_response, workers=None, max_memory=default.batch_memory):
+    '''
+    Convolve every Signal in signals with impulse_response, transforming the impulse response only once
+    (see convolve.convolve_many_to_one). The signals must share one sampling rate; impulse_response is resampled to it.
+    :signals: list of Signal instances
+    :impulse_response: a Signal instance
+    :workers: (int) number of threads per FFT, -1 for all CPUs, default fft_backend.get_workers()
+    :max_memory: (int) bound in bytes on the intermediate arrays of one batch
+    Returns a list of Signal instances, each as long as the corresponding Signal in signals.
+    '''
+    sample_rate = signals[0].get_sps()
+    assert all(sig.get_sps() == sample_rate for sig in signals), 'signals have different sampling rates'
+    impulse = _impulse_at(impulse_response, sample_rate)
+    convolved = convolve.convolve_many_to_one([sig.get_signal() for sig in signals], impulse, workers=workers, max_memory=max_memory)
+
+    return [Signal(conv[:sig.get_nframes()], sample_rate, max(sig.get_channels(), impulse_response.get_channels()), sig.get_state()[2], sig.get_dtype())
+            for conv, sig in zip(convolved, signals)]
+
+
+def _impulse_at(impulse_response, sample_rate):
+    # samples of impulse_response, resampled to sample_rate
+    impulse = impulse_response.get_signal()
+    if impulse_response.get_sps() != sample_rate:
+        impulse = rs.resample(impulse, impulse_response.get_sps(), sample_rate)
+        # the resampling filter can overshoot on a full-scale direct sound
+        impulse = impulse / max(1.0, np.max(np.abs(impulse)))
+
+    return impulse
 
 
+@instrument.instrumented()
 def generate_sine(freq=440, amp=.75, duration=1, start=440, end=440, start_amp=0.75, end_amp=0.75, sr=default.sample_rate, mode='lin'):
     '''
     Generate a sine wave or sweep of given duration.
@@ -147,8 +379,8 @@ def generate_sine(freq=440, amp=.75, duration=1, start=440, end=440, start_amp=0
     return samples
 
 
-def plot_fft(signal, save=False, fname=''):
+def plot_fft(signal, save=False, fname='', sample_rate=default.sample_rate):
     '''
     A utility function to plot the fft of the Signal instance. Option to save graph to given file.
     '''
-    graph.graph_stft(signal, save=save, fname=fname)
\ No newline at end of file
+    graph.graph_stft(signal, save=save, fname=fname, sample_rate=sample_rate)
\ No newline at end of file
@@ -0,0 +1,20 @@
+'''
+Room impulse response processing.
+Submodules are imported when they are first used (e.g. ir_module.convolve after import ir_module), so importing the
+package does not load numpy, scipy, matplotlib or PyAudio by itself. The submodules load numpy; scipy is loaded by the
+first transform or filter, matplotlib by the first graph and PyAudio by the first audio stream.
+'''
+import importlib
+
+_submodules = ('Signal', 'acoustics', 'avg_signal', 'batch', 'cache', 'cli', 'convolve', 'default', 'fft_backend', 'gen_sine',
+               'graph', 'impulse_response', 'instrument', 'ir_library', 'measure', 'realtime', 'resample', 'wav_util')
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f'.{name}', __name__)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_submodules))
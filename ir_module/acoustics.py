@@ -0,0 +1,195 @@
+import functools
+import numpy as np
+from . import fft_backend as fb, impulse_response as ir, instrument
+
+'''
+room acoustic parameters of impulse responses, after ISO 3382-1
+'''
+# octave ratio for base-10 band edges (IEC 61260-1)
+octave_ratio = 10 ** (3 / 10)
+
+
+def band_centres(fraction=1, fmin=63, fmax=8000):
+    '''
+    Exact mid-band frequencies of the octave (fraction=1) or fractional-octave (e.g. fraction=3) bands,
+    from the band containing fmin to the band containing fmax.
+    Returns a numpy array of frequencies in Hz.
+    '''
+    lowest = int(np.round(fraction * np.log(fmin / 1000) / np.log(octave_ratio)))
+    highest = int(np.round(fraction * np.log(fmax / 1000) / np.log(octave_ratio)))
+
+    return 1000 * octave_ratio ** (np.arange(lowest, highest + 1) / fraction)
+
+
+@functools.lru_cache(maxsize=16)
+def filterbank(sample_rate, fraction=1, fmin=63, fmax=8000, order=3):
+    '''
+    Butterworth band-pass filters for every band from band_centres that lies below the Nyquist frequency.
+    The design is cached per set of arguments.
+    Returns the band centre frequencies and a list of second-order-section filters, one per band.
+    '''
+    from scipy import signal
+
+    centres = band_centres(fraction, fmin, fmax)
+    half_band = octave_ratio ** (1 / (2 * fraction))
+    centres = centres[centres * half_band < sample_rate / 2]
+    sos = [signal.butter(order, [fc / half_band, fc * half_band], btype='bandpass', output='sos', fs=sample_rate) for fc in centres]
+    centres.flags.writeable = False
+
+    return centres, sos
+
+
+@functools.lru_cache(maxsize=16)
+def band_responses(sample_rate, nfft, fraction=1, fmin=63, fmax=8000, order=3):
+    '''
+    Magnitude responses of the filterbank at the bins of a real FFT of size nfft, for zero-phase band filtering in
+    the frequency domain. The responses are cached per set of arguments.
+    Returns the band centre frequencies and a read-only (bands, nfft // 2 + 1) float32 array.
+    '''
+    from scipy import signal
+
+    centres, sos = filterbank(sample_rate, fraction, fmin, fmax, order)
+    freqs = fb.rfftfreq(nfft, 1 / sample_rate)
+    responses = np.array([np.abs(signal.sosfreqz(band, worN=freqs, fs=sample_rate)[1]) for band in sos], dtype=np.float32)
+    responses.flags.writeable = False
+
+    return centres, responses
+
+
+def stack_irs(irs):
+    '''
+    Stack impulse responses of different lengths into a zero-padded (IRs, samples) float64 array.
+    Multichannel impulse responses are reduced to their first channel.
+    '''
+    irs = [np.asarray(x) for x in irs]
+    irs = [x[:, 0] if x.ndim == 2 else x for x in irs]
+    stacked = np.zeros((len(irs), max(len(x) for x in irs)))
+    for row, x in zip(stacked, irs):
+        row[:len(x)] = x
+
+    return stacked
+
+
+def schroeder(energy):
+    '''
+    Schroeder backward integral of squared impulse responses, along the last axis, in dB relative to the total energy.
+    :energy: array of squared samples, (..., samples)
+    Returns the energy decay curves, of the same shape.
+    '''
+    edc = np.cumsum(energy[..., ::-1], axis=-1)[..., ::-1]
+    total = edc[..., :1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 10 * np.log10(edc / np.where(total > 0, total, 1))
+
+
+def decay_sums(edc_db):
+    '''
+    Running sums used by decay_time, shared between the fits of one set of decay curves.
+    Returns the cumulative sums of the decay curves and of the decay curves times the sample index, with a leading zero.
+    '''
+    zero = np.zeros(edc_db.shape[:-1] + (1,))
+    finite = np.where(np.isfinite(edc_db), edc_db, 0)
+    sum_y = np.concatenate((zero, np.cumsum(finite, axis=-1)), axis=-1)
+    sum_ny = np.concatenate((zero, np.cumsum(finite * np.arange(edc_db.shape[-1]), axis=-1)), axis=-1)
+
+    return sum_y, sum_ny
+
+
+def decay_time(edc_db, sample_rate, top, bottom, sums=None):
+    '''
+    Reverberation time from a least-squares fit to each energy decay curve between top and bottom dB,
+    extrapolated to 60 dB of decay (e.g. top=-5, bottom=-25 gives T20). All curves are fitted at once.
+    Decay curves are non-increasing, so each fit covers one contiguous range of samples, and the regression sums
+    are read from running sums instead of being accumulated per fit.
+    :edc_db: energy decay curves in dB, (..., samples)
+    :sums: optional result of decay_sums(edc_db), to reuse between fits
+    Returns the reverberation times in seconds, (...); NaN where a curve does not span the range.
+    '''
+    sum_y, sum_ny = decay_sums(edc_db) if sums is None else sums
+    first = np.argmax(edc_db <= top, axis=-1)
+    below = edc_db < bottom
+    last = np.argmax(below, axis=-1)
+    spans = np.any(below, axis=-1) & (last - first > 1)
+    last = np.where(spans, last, first)
+
+    take = lambda sums, index: np.take_along_axis(sums, index[..., np.newaxis], axis=-1)[..., 0]
+    n = (last - first).astype(np.float64)
+    # sums of the sample index and its square over [first, last)
+    sum_n = (last * (last - 1) - first * (first - 1)) / 2
+    sum_nn = ((last - 1) * last * (2 * last - 1) - (first - 1) * first * (2 * first - 1)) / 6
+    sum_y = take(sum_y, last) - take(sum_y, first)
+    sum_ny = take(sum_ny, last) - take(sum_ny, first)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (n * sum_ny - sum_n * sum_y) / (n * sum_nn - sum_n ** 2) * sample_rate
+        return np.where(spans & (slope < 0), -60 / slope, np.nan)
+
+
+def clarity(energy, sample_rate, early):
+    '''
+    Early-to-late energy ratio in dB, with the boundary at early seconds after the start of each response (C50, C80).
+    '''
+    split = int(early * sample_rate)
+    with np.errstate(divide='ignore'):
+        return 10 * np.log10(energy[..., :split].sum(axis=-1) / energy[..., split:].sum(axis=-1))
+
+
+def definition(energy, sample_rate, early=0.05):
+    '''
+    Ratio of the energy in the first early seconds to the total energy (D50).
+    '''
+    split = int(early * sample_rate)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return energy[..., :split].sum(axis=-1) / energy.sum(axis=-1)
+
+
+@instrument.instrumented()
+def analyze(irs, sample_rate, fraction=1, fmin=63, fmax=8000, truncate=True):
+    '''
+    Compute EDT, T20, T30, C50, C80 and D50 per band for many impulse responses in a single pass.
+    Each response is aligned to its direct sound onset (impulse_response.find_onset); with truncate, its energy past
+    the point where the decay meets the noise floor (impulse_response.lundeby) is discarded before integration.
+    All responses are transformed once, and band-filtered together, one band at a time, by multiplying with the cached
+    magnitude responses of the filterbank (zero-phase filtering, with the magnitude response of the Butterworth bands).
+    :irs: (IRs, samples) array, or a list of impulse responses of any length
+    :sample_rate: (int) sampling rate in Hz
+    :fraction: (int) 1 for octave bands, 3 for third-octave bands
+    :fmin: / :fmax: lowest and highest band centres, in Hz
+    :truncate: (bool) discard the noise after the Lundeby crosspoint
+    Returns a dict of (IRs, bands) arrays keyed 'EDT', 'T20', 'T30' (seconds), 'C50', 'C80' (dB) and 'D50', and the
+    band centre frequencies under 'centres'.
+    '''
+    stacked = stack_irs(irs)
+    # filtering in single precision halves the cost of the transforms; energies are accumulated in double precision
+    aligned = np.zeros(stacked.shape, dtype=np.float32)
+    ends = np.full(len(stacked), stacked.shape[1])
+    for i, x in enumerate(stacked):
+        onset = ir.find_onset(x)
+        aligned[i, :len(x) - onset] = x[onset:]
+        if truncate:
+            ends[i] = max(1, ir.lundeby(x[onset:], sample_rate)[0])
+    keep = np.arange(aligned.shape[1]) < ends[:, np.newaxis]
+
+    nframes = aligned.shape[1]
+    # padding keeps the ringing of the band filters, before and after the response, from wrapping around
+    nfft = fb.next_fast_len(nframes + int(0.25 * sample_rate))
+    instrument.note('fft_size', nfft)
+    spectra = fb.rfft(aligned, nfft, axis=-1)
+    centres, responses = band_responses(sample_rate, nfft, fraction, fmin, fmax)
+    fit_step = max(1, sample_rate // 1000)
+    shape = (len(stacked), len(centres))
+    results = {name: np.empty(shape) for name in ('EDT', 'T20', 'T30', 'C50', 'C80', 'D50')}
+    for band, response in enumerate(responses):
+        energy = np.square(fb.irfft(spectra * response, nfft, axis=-1)[:, :nframes], dtype=np.float64)
+        energy *= keep
+        # decay curves are smooth, so they are fitted at a resolution of about 1 ms
+        edc = schroeder(energy)[:, ::fit_step]
+        sums = decay_sums(edc)
+        results['EDT'][:, band] = decay_time(edc, sample_rate / fit_step, 0, -10, sums)
+        results['T20'][:, band] = decay_time(edc, sample_rate / fit_step, -5, -25, sums)
+        results['T30'][:, band] = decay_time(edc, sample_rate / fit_step, -5, -35, sums)
+        results['C50'][:, band] = clarity(energy, sample_rate, 0.05)
+        results['C80'][:, band] = clarity(energy, sample_rate, 0.08)
+        results['D50'][:, band] = definition(energy, sample_rate, 0.05)
+    results['centres'] = centres
+
+    return results
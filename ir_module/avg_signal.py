@@ -1,21 +1,22 @@
 import os, glob
 import numpy as np
-from scipy import signal
-from . import wav_util, default
+from . import wav_util, default, fft_backend as fb, instrument
 
+@instrument.instrumented()
 def retrieve_wave_files(directory, num_frames):
     '''
-    Reads in a batch of wave files within a single specified directory.
+    Reads in a batch of wave files within a single specified directory, in sorted file name order.
     :directory: file directory containing desired files
     :num_frames: for simplicity, all files will be constrained in length (number of frames)
-    Returns an numpy ndarray of samples
+    Returns an numpy ndarray of samples, (files, frames) or (files, frames, channels) for multichannel recordings
     '''
-    samples_array = []
+    samples_array = None
     sample_rate = None
     sample_width = None
     file_dir = os.path.join(f'{directory}', '*.wav')
-    files = glob.glob(file_dir)
-    for file in files:
+    files = sorted(glob.glob(file_dir))
+    assert len(files) > 0, f'no WAVE files found in {directory}'
+    for i, file in enumerate(files):
         params, samples = wav_util.read_wave_nbit(file)
         assert len(samples) >= num_frames, f'all files must be at least of length {num_frames}. {file} is too short: {len(samples)} frames'
         if sample_rate is None:
@@ -24,27 +25,27 @@ def retrieve_wave_files(directory, num_frames):
         if sample_width is None:
             sample_width = params.sampwidth
         assert params.sampwidth == sample_width, f'{file}: sample/frame width mismatch. all  files must be at same frame width.'
-        samples_array = np.append(samples_array, samples[:num_frames])
-    samples_array = samples_array.reshape(len(files), num_frames)
+        if samples_array is None:
+            samples_array = np.empty((len(files), num_frames) + samples.shape[1:], dtype=samples.dtype)
+        assert samples.shape[1:] == samples_array.shape[2:], f'{file}: channel count mismatch. all files must have the same number of channels.'
+        samples_array[i] = samples[:num_frames]
 
     return samples_array
 
 
-def upsample(samples_to_upsamp, upsamp_factor=default.upsample_rate):
+@instrument.instrumented()
+def upsample(samples_to_upsamp, upsamp_factor=default.upsample_rate // default.sample_rate):
     '''
     Upsamples the original files by the given factor
-    :samples_to_upsamp: original array of samples
-    :upsamp_factor: factor by which to upsample
+    :samples_to_upsamp: original array of samples, (files, frames) or (files, frames, channels)
+    :upsamp_factor: (int) factor by which to upsample, default the ratio of default.upsample_rate to default.sample_rate
     '''
-    upsamples_arr = []
+    from scipy import signal
+
     samples = len(samples_to_upsamp[0])
-    upsamples = samples * upsamp_factor
-    tests = len(samples_to_upsamp)
-    for i in range(tests):
-        upsampled = signal.resample(samples_to_upsamp[i], len(samples_to_upsamp[i])*upsamp_factor)
-        upsamples_arr = np.append(upsamples_arr, upsampled)
+    with fb.scipy_context():
+        upsamples_arr = signal.resample(samples_to_upsamp, samples * upsamp_factor, axis=1)
 
-    upsamples_arr = upsamples_arr.reshape(tests,upsamples)
     return upsamples_arr
 
 
@@ -58,7 +59,10 @@ def xcorrelate(samples_x, samples_y):
     If lag is positive, samples_y leads samples_x if lag is negative, samples_y lags samples_x. 
     If lag is 0, samples_x and samples_y are already maximally correlated.
     '''
-    correlation = np.correlate(samples_x, samples_y, mode='same')
+    from scipy import signal
+
+    with fb.scipy_context():
+        correlation = signal.correlate(samples_x, samples_y, mode='same', method='fft')
     lags = signal.correlation_lags(samples_x.size, samples_y.size, mode='same')
     lag = lags[np.argmax(correlation)]
     return lag
@@ -87,25 +91,76 @@ def shift_signal(samples, lag):
     return new_samples
 
 
-def xcorr_and_avg(source_samples_dir, nframes):
+@instrument.instrumented()
+def estimate_lags(takes, reference=0):
+    '''
+    Estimate the lag of every take relative to a reference take, with sub-sample precision.
+    All takes are cross-correlated with the reference at once, via the FFT, and the lag of each correlation peak is
+    refined by fitting a parabola through the peak and its two neighbours.
+    The sign convention follows xcorrelate: shifting a take by its lag (see shift_signal) aligns it with the reference.
+    :takes: (takes, frames) array, or (takes, frames, channels), in which case the channels are summed for the estimate
+    :reference: (int) index of the reference take
+    Returns a floating-point numpy array of lags, one per take, and the spectra of the takes (FFT size, spectra).
+    '''
+    nframes = takes.shape[1]
+    nfft = fb.next_fast_len(2 * nframes - 1)
+    instrument.note('fft_size', nfft)
+    spectra = fb.rfft(takes, nfft, axis=1)
+    mono_spectra = spectra.sum(axis=2) if spectra.ndim == 3 else spectra
+    # circular cross-correlation, long enough to hold every linear lag; negative lags wrap to the end
+    xcorr = fb.irfft(mono_spectra[reference] * np.conj(mono_spectra), nfft, axis=1)
+    peaks = np.argmax(xcorr, axis=1)
+    rows = np.arange(len(takes))
+    left = xcorr[rows, peaks - 1]
+    centre = xcorr[rows, peaks]
+    right = xcorr[rows, (peaks + 1) % nfft]
+    curvature = left - 2 * centre + right
+    offset = np.divide(0.5 * (left - right), curvature, out=np.zeros(len(takes), dtype=xcorr.dtype), where=curvature != 0)
+    lags = np.where(peaks > nfft // 2, peaks - nfft, peaks) + offset
+
+    return lags, (nfft, spectra)
+
+
+@instrument.instrumented()
+def align_and_average(takes, reference=0):
+    '''
+    Align a batch of repeated recordings of the same input to a reference take, and average them.
+    Takes are shifted by their (fractional) lags in the frequency domain, reusing the spectra from estimate_lags, and
+    every take has the same weight in the mean, which is brought back to the time domain with a single inverse FFT.
+    Shifted takes are zero-padded, as in shift_signal.
+    :takes: (takes, frames) or (takes, frames, channels) array
+    :reference: (int) index of the reference take
+    Returns a numpy array of floating-point values, (frames,) or (frames, channels), representing the averaged signal.
+    '''
+    lags, (nfft, spectra) = estimate_lags(takes, reference)
+    bins = np.arange(spectra.shape[1])
+    total = np.zeros(spectra.shape[1:], dtype=spectra.dtype)
+    for spectrum, lag in zip(spectra, lags):
+        # a delay of lag frames is a linear phase shift
+        phase = np.exp(-2j * np.pi * bins * (lag / nfft)).astype(spectra.dtype)
+        total += spectrum * (phase[:, np.newaxis] if spectrum.ndim == 2 else phase)
+    total /= len(takes)
+
+    return fb.irfft(total, nfft, axis=0)[:takes.shape[1]]
+
+
+@instrument.instrumented()
+def xcorr_and_avg(source_samples_dir, nframes, cache=None):
     '''
     Cross-correlate and average a batch of files. 
     :source_samples_dir: (string) takes given source directory and reads in all WAVE files in the directory. Assumes a batch of signals that are repeated recordings of the same input, and of same length.
     :nframes: (int) number of frames in a single file.
+    :cache: optional cache.DiskCache; the average is then keyed by the contents of the files and nframes, and
+    served from the cache (memory-mapped, read-only) while the files are unchanged.
+    Takes are aligned with sub-sample precision to the first file, see align_and_average.
     Returns a numpy array of floating-point values representing the averaged signal.
     '''
-    source_samples_arr = retrieve_wave_files(source_samples_dir, nframes)
-
-    # upsample for higher accuracy cross-correlation
-    upsampled_arr = upsample(source_samples_arr)
-    avg_signal = upsampled_arr[0]
-    for s in upsampled_arr:
-        lag = xcorrelate(avg_signal, s)
-        shifted = shift_signal(s, lag)
-        avg_signal = np.average(np.array([avg_signal, shifted]), axis=0)
-    
-    # downsample
-    avg_signal = signal.decimate(avg_signal, 2, ftype='fir', zero_phase=True)
-    
-    return avg_signal
-    
\ No newline at end of file
+    def average():
+        source_samples_arr = retrieve_wave_files(source_samples_dir, nframes)
+        return align_and_average(source_samples_arr)
+
+    if cache is None:
+        return average()
+    files = sorted(glob.glob(os.path.join(f'{source_samples_dir}', '*.wav')))
+
+    return cache.cached(cache.key('xcorr_and_avg', files, nframes=nframes), average)
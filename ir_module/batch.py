@@ -0,0 +1,211 @@
+import os, glob, time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from . import avg_signal as avg, default, fft_backend as fb, impulse_response as ir, instrument, resample as rs, wav_util
+from .cache import DiskCache, file_hash
+
+'''
+run the full measurement pipeline over a tree of recording directories
+'''
+# the inverse-filter spectra of the reference sweep per recording sampling rate, attached once per worker process,
+# and the sweep's content hash
+_shared = {}
+
+
+def find_recording_dirs(root):
+    '''
+    Find every directory under root (including root) that directly contains WAVE files,
+    e.g. one directory per microphone position, each holding repeated takes.
+    Returns a sorted list of directory paths.
+    '''
+    dirs = [path for path, _, files in os.walk(root) if any(f.lower().endswith('.wav') for f in files)]
+
+    return sorted(dirs)
+
+
+def _inverse_spectrum(sweep_file, nframes, sample_rate, cache=None):
+    # the inverse filter of the sweep for takes of nframes frames at sample_rate, resampling the sweep to that rate
+    sweep_params = wav_util.MappedWave(sweep_file).params
+    conv_len = nframes + rs.resampled_length(sweep_params.nframes, sweep_params.framerate, sample_rate) - 1
+    nfft = fb.next_fast_len(conv_len)
+
+    def compute():
+        _, sweep = wav_util.read_wave_nbit(sweep_file)
+        return ir.default_deconvolver.inverse_spectrum(sweep, nfft, sweep_params.framerate, sample_rate)
+
+    spectrum = compute() if cache is None else cache.cached(cache.key('inverse_spectrum', [sweep_file], nfft=nfft, sample_rate=sample_rate), compute)
+
+    return spectrum, nfft, conv_len
+
+
+def _attach(shm_name, layout, sweep_hash):
+    # layout maps each sampling rate to (byte offset, shape, dtype, nfft, conv_len) of its spectrum in shm
+    shm = shared_memory.SharedMemory(name=shm_name)
+    _shared['shm'] = shm
+    _shared['spectra'] = {rate: (np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset), nfft, conv_len) for rate, (offset, shape, dtype, nfft, conv_len) in layout.items()}
+    _shared['sweep'] = sweep_hash
+
+
+def _detach():
+    shm = _shared['shm']
+    # drop the array on the shared buffer before closing it
+    _shared.clear()
+    shm.close()
+
+
+def _init_worker(*initargs):
+    # the processes already use every CPU
+    fb.set_workers(1)
+    _attach(*initargs)
+
+
+@instrument.instrumented()
+def process_directory(directory, out_file, nframes, max_seconds=None, pre_onset=0.002, cache_dir=None, cache_size=default.cache_size, sweep_file=None):
+    '''
+    Run read -> align/average -> deconvolve -> trim -> write for one directory of repeated takes,
+    using the inverse-filter spectrum shared with this process by process_tree, or that of sweep_file.
+    :directory: (string) directory of WAVE files, see avg_signal.retrieve_wave_files
+    :out_file: (string) path of the 16-bit WAVE file to write the impulse response to
+    :nframes: (int) number of frames read from every take
+    :max_seconds: (float) optional upper bound on the impulse response length, see impulse_response.extract_ir
+    :pre_onset: (float) seconds kept before the direct sound onset
+    :cache_dir: (string) optional cache.DiskCache directory. The averaged recording, the raw and the trimmed impulse
+    responses are cached, keyed by the contents of the takes and of the sweep and by the parameters of each stage,
+    and the stages whose result is cached are skipped.
+    :cache_size: (int) upper bound in bytes on the size of the cache directory
+    :sweep_file: (string) WAVE file of the sweep played during the recordings, resampled to the sampling rate of the
+    takes when it differs. Required outside of process_tree.
+    Returns a dict with the directory, output file, impulse response length, sampling rate and per-stage timings in seconds.
+    Stages skipped on a cache hit have no timing; the time spent storing results is reported as 'cache'.
+    '''
+    timings = {}
+    clock = time.perf_counter()
+
+    def lap(stage):
+        nonlocal clock
+        now = time.perf_counter()
+        timings[stage] = now - clock
+        clock = now
+
+    files = sorted(glob.glob(os.path.join(directory, '*.wav')))
+    params, _ = wav_util.read_wave_nbit(files[0], lazy=True)
+    cache = None if cache_dir is None else DiskCache(cache_dir, cache_size)
+    if sweep_file is not None:
+        spectrum, nfft, conv_len = _inverse_spectrum(sweep_file, nframes, params.framerate, cache)
+        sweep_hash = file_hash(sweep_file)
+    elif params.framerate in _shared.get('spectra', {}):
+        spectrum, nfft, conv_len = _shared['spectra'][params.framerate]
+        sweep_hash = _shared['sweep']
+    else:
+        raise ValueError(f'no inverse filter for the {params.framerate} Hz takes in {directory}: pass sweep_file, or use process_tree')
+    if cache is not None:
+        keys = {
+            # the same key as avg_signal.xcorr_and_avg, so the two share entries
+            'average': cache.key('xcorr_and_avg', files, nframes=nframes),
+            'deconvolve': cache.key('deconvolve', files, nframes=nframes, sweep=sweep_hash),
+            'trim': cache.key('extract_ir', files, nframes=nframes, sweep=sweep_hash, max_seconds=max_seconds, pre_onset=pre_onset),
+        }
+
+    def cached(stage, compute):
+        return compute() if cache is None else cache.cached(keys[stage], compute)
+
+    def average():
+        takes = avg.retrieve_wave_files(directory, nframes)
+        lap('read')
+        averaged = avg.align_and_average(takes)
+        lap('average')
+        return averaged
+
+    def deconvolve():
+        averaged = cached('average', average)
+        deconv = ir.apply_inverse_spectrum(averaged, spectrum, nfft, conv_len)
+        deconv = deconv / np.max(np.abs(deconv)) * 0.95
+        lap('deconvolve')
+        return deconv
+
+    def trim():
+        rir, _ = ir.extract_ir(cached('deconvolve', deconvolve), params.framerate, pre_onset=pre_onset, max_seconds=max_seconds)
+        lap('trim')
+        return rir
+
+    rir = cached('trim', trim)
+    if cache is not None:
+        lap('cache')
+    wav_util.write_wav_file_16bit(out_file, rir, params.nchannels, params.framerate, 2)
+    lap('write')
+
+    return {'directory': directory, 'output': out_file, 'frames': len(rir), 'sample_rate': params.framerate, 'timings': timings}
+
+
+@instrument.instrumented()
+def process_tree(root, sweep_file, out_dir, nframes=None, workers=None, max_seconds=None, pre_onset=0.002, cache_dir=None, cache_size=default.cache_size):
+    '''
+    Extract an impulse response from every recording directory under root, in parallel over a process pool.
+    The reference sweep is decoded once, and the spectrum of its inverse filter is computed once per sampling rate of
+    the recordings and placed in shared memory, where every worker process attaches to it instead of reading and
+    transforming the sweep per task.
+    :root: (string) top of the tree of recording directories, e.g. demo/recorded_output
+    :sweep_file: (string) WAVE file of the sweep played during the recordings. It is resampled to the sampling rate of
+    recordings made at another rate.
+    :out_dir: (string) directory to write one '<relative path>_rir.wav' file per recording directory to
+    :nframes: (int) number of frames read from every take, default: the length of the shortest take
+    :workers: (int) number of worker processes, default: the number of CPUs. 1 runs in the calling process.
+    :max_seconds: / :pre_onset: / :cache_dir: / :cache_size: see process_directory. With a cache, the inverse-filter
+    spectrum of the sweep is cached as well.
+    Returns a list of per-directory results from process_directory, each with a 'timings' dict, and the total timings
+    per stage (including 'setup', the sweep preparation) summed over all directories.
+    '''
+    setup_start = time.perf_counter()
+    dirs = find_recording_dirs(root)
+    assert len(dirs) > 0, f'no recording directories found under {root}'
+    takes = {d: [wav_util.MappedWave(f).params for f in glob.glob(os.path.join(d, '*.wav'))] for d in dirs}
+    rates = set()
+    for d, params in takes.items():
+        # the takes of a directory are averaged, so they must share a rate
+        dir_rates = {p.framerate for p in params}
+        if len(dir_rates) > 1:
+            raise ValueError(f'the takes in {d} have different sampling rates: {sorted(dir_rates)} Hz')
+        rates |= dir_rates
+    if nframes is None:
+        nframes = min(p.nframes for params in takes.values() for p in params)
+    cache = None if cache_dir is None else DiskCache(cache_dir, cache_size)
+    spectra = {rate: _inverse_spectrum(sweep_file, nframes, rate, cache) for rate in sorted(rates)}
+    os.makedirs(out_dir, exist_ok=True)
+
+    tasks = []
+    for d in dirs:
+        name = os.path.relpath(d, root).replace(os.sep, '_')
+        name = os.path.basename(os.path.abspath(root)) if name == '.' else name
+        tasks.append((d, os.path.join(out_dir, f'{name}_rir.wav'), nframes, max_seconds, pre_onset, cache_dir, cache_size))
+
+    layout, offset = {}, 0
+    for rate, (spectrum, nfft, conv_len) in spectra.items():
+        layout[rate] = (offset, spectrum.shape, spectrum.dtype, nfft, conv_len)
+        offset += spectrum.nbytes
+    shm = shared_memory.SharedMemory(create=True, size=offset)
+    try:
+        for rate, (spectrum, _, _) in spectra.items():
+            offset, shape, dtype, _, _ = layout[rate]
+            np.ndarray(shape, dtype=dtype, buffer=shm.buf, offset=offset)[:] = spectrum
+        initargs = (shm.name, layout, file_hash(sweep_file))
+        totals = {'setup': time.perf_counter() - setup_start}
+        if workers == 1:
+            _attach(*initargs)
+            try:
+                results = [process_directory(*task) for task in tasks]
+            finally:
+                _detach()
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=initargs) as pool:
+                futures = [pool.submit(process_directory, *task) for task in tasks]
+                results = [future.result() for future in futures]
+    finally:
+        shm.close()
+        shm.unlink()
+
+    for result in results:
+        for stage, seconds in result['timings'].items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+
+    return results, totals
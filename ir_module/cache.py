@@ -0,0 +1,190 @@
+import os, hashlib, threading, uuid
+import numpy as np
+from . import default
+
+'''
+content-addressed on-disk cache for intermediate arrays of the pipeline
+'''
+# content hashes of files, keyed by path and revalidated against (size, mtime, inode)
+_file_hashes = {}
+_file_hashes_lock = threading.Lock()
+
+
+def file_hash(path, chunk_size=1<<20):
+    '''
+    SHA-256 of the contents of a file. The hash is remembered per path, and only recomputed when the file's size,
+    modification time or inode change, so unchanged files are not read again.
+    Returns a hex digest string.
+    '''
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    signature = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+    with _file_hashes_lock:
+        known = _file_hashes.get(path)
+    if known is not None and known[0] == signature:
+        return known[1]
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    digest = digest.hexdigest()
+    with _file_hashes_lock:
+        _file_hashes[path] = (signature, digest)
+
+    return digest
+
+
+def _param_bytes(value):
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        return hashlib.sha256(value.view(np.uint8)).hexdigest().encode() + f'{value.dtype.str}{value.shape}'.encode()
+    return repr(value).encode()
+
+
+class DiskCache:
+    '''
+    Cache of numpy arrays stored as .npy files in a directory, keyed by the contents of the input files and the
+    parameters of the computation. Arrays are returned memory-mapped and read-only, so a hit costs no decoding.
+    The total size of the directory is bounded; when it is exceeded, the least recently used entries are removed.
+    Entries are written atomically, so several processes can share a cache directory.
+    '''
+    def __init__(self, directory, max_bytes=default.cache_size):
+        '''
+        :directory: (string) cache directory, created if it does not exist
+        :max_bytes: (int) upper bound on the total size of the cached arrays
+        '''
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._hits = 0
+        self._misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+
+    def key(self, step, files=(), **params):
+        '''
+        Build a cache key from the name of the computation, the contents of its input files and its parameters.
+        :step: (string) name of the computation, e.g. 'xcorr_and_avg'
+        :files: paths of the input files; their order is significant
+        :params: parameters of the computation; numpy arrays are hashed by content, other values by repr
+        Returns a hex digest string.
+        '''
+        digest = hashlib.sha256(step.encode())
+        for path in files:
+            digest.update(file_hash(path).encode())
+        for name in sorted(params):
+            digest.update(name.encode() + b'=' + _param_bytes(params[name]) + b';')
+
+        return digest.hexdigest()
+
+
+    def path(self, key):
+        '''
+        Returns the path of the .npy file of key.
+        '''
+        return os.path.join(self._directory, f'{key}.npy')
+
+
+    def get(self, key):
+        '''
+        Returns the array stored under key, memory-mapped read-only, or None if there is none.
+        '''
+        path = self.path(key)
+        try:
+            array = np.load(path, mmap_mode='r')
+            # the modification time records the last use, for eviction
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            self._misses += 1
+            return None
+        self._hits += 1
+
+        return array
+
+
+    def put(self, key, array):
+        '''
+        Store array under key, then evict least recently used entries until the cache fits in max_bytes.
+        Returns the stored array, memory-mapped read-only.
+        '''
+        path = self.path(key)
+        temp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp, 'wb') as f:
+            np.save(f, np.asarray(array))
+        os.replace(temp, path)
+        stored = np.load(path, mmap_mode='r')
+        self.evict(keep=path)
+
+        return stored
+
+
+    def cached(self, key, compute):
+        '''
+        Returns the array stored under key; on a miss, calls compute() and stores its result first.
+        '''
+        array = self.get(key)
+        if array is None:
+            array = self.put(key, compute())
+
+        return array
+
+
+    def entries(self):
+        '''
+        Returns a list of (last use, size in bytes, path) of the cached arrays, least recently used first.
+        '''
+        entries = []
+        for entry in os.scandir(self._directory):
+            if entry.name.endswith('.npy'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+
+        return sorted(entries)
+
+
+    def evict(self, keep=None):
+        '''
+        Remove least recently used entries until the total size is at most max_bytes. The entry at path keep, if
+        given, is removed last, and only if it alone exceeds max_bytes.
+        Returns the number of bytes removed.
+        '''
+        entries = self.entries()
+        entries.sort(key=lambda entry: entry[2] == keep)
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total - removed <= self._max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # already removed by another process, or still mapped on platforms that forbid removing it
+                continue
+            removed += size
+
+        return removed
+
+
+    def cache_info(self):
+        '''
+        Returns (hits, misses, number of entries, total bytes, maximum bytes) of the cache.
+        '''
+        entries = self.entries()
+
+        return self._hits, self._misses, len(entries), sum(size for _, size, _ in entries), self._max_bytes
+
+
+    def clear(self):
+        '''
+        Remove all cached arrays.
+        '''
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        self._hits = 0
+        self._misses = 0
@@ -0,0 +1,183 @@
+'''
+Command-line interface of ir_module, for headless use (no display or audio device is needed):
+    python -m ir_module sweep sweep.wav --start 50 --end 20000 --seconds 10
+    python -m ir_module average recordings/position_1 averaged.wav
+    python -m ir_module deconvolve averaged.wav ir.wav --sweep 50 20000 10 --trim
+    python -m ir_module trim ir.wav trimmed.wav --max-seconds 2
+    python -m ir_module convolve dry.wav trimmed.wav wet.wav --engine partitioned
+    python -m ir_module spectrogram trimmed.wav trimmed.png
+Every command imports only the modules it uses, so the interpreter starts quickly.
+'''
+import argparse, sys
+
+# WAVE formats as (comptype, sampwidth)
+formats = {'int16': ('NONE', 2), 'int24': ('NONE', 3), 'float32': ('FLOAT', 4)}
+
+
+def _write(path, samples, sample_rate, format, peak=None):
+    from . import wav_util
+
+    if peak is not None:
+        samples = samples * (peak / max(float(samples.max()), -float(samples.min()), 1e-30))
+    comptype, sampwidth = formats[format]
+    channels = samples.shape[1] if samples.ndim == 2 else 1
+    with wav_util.WaveWriter(path, sample_rate, channels, sampwidth, comptype, dither=comptype == 'NONE') as writer:
+        writer.write(samples)
+    if writer.get_clipped():
+        print(f'{path}: {writer.get_clipped()} samples clipped', file=sys.stderr)
+
+
+def _sweep(args):
+    from . import gen_sine as gs
+
+    generate = gs.exp_sweep if args.mode == 'exp' else gs.lin_sweep
+    samples = generate(args.start, args.end, args.seconds, sample_rate=args.rate, st_amp=args.amplitude, end_amp=args.amplitude)
+    _write(args.output, samples, args.rate, args.format)
+
+
+def _average(args):
+    import glob, os
+    from . import avg_signal as avg, wav_util
+    from .cache import DiskCache
+
+    files = sorted(glob.glob(os.path.join(args.directory, '*.wav')))
+    assert files, f'no WAVE files found in {args.directory}'
+    params = [wav_util.MappedWave(f).params for f in files]
+    nframes = args.frames if args.frames is not None else min(p.nframes for p in params)
+    cache = DiskCache(args.cache_dir) if args.cache_dir is not None else None
+    averaged = avg.xcorr_and_avg(args.directory, nframes, cache=cache)
+    _write(args.output, averaged, params[0].framerate, args.format)
+
+
+def _deconvolve(args):
+    from . import impulse_response as ir
+    from .Signal import load_signal
+
+    if (args.sweep is None) == (args.reference is None):
+        raise SystemExit('deconvolve: give either the parameters of the exponential sweep (--sweep) or the sweep file')
+    recording = load_signal(args.recording)
+    if args.sweep is not None:
+        # the analytic inverse filter compensates the pink spectrum of the sweep
+        start, end, seconds = args.sweep
+        deconvolved = ir.deconvolve_exp_sweep(recording.get_signal(), start, end, seconds, recording.get_sps())
+    else:
+        deconvolved = recording.deconvolve(load_signal(args.reference)).get_signal()
+    if args.trim:
+        deconvolved, _ = ir.extract_ir(deconvolved, recording.get_sps(), pre_onset=args.pre_onset, max_seconds=args.max_seconds, sweep=args.sweep)
+    _write(args.output, deconvolved, recording.get_sps(), args.format, peak=args.peak)
+
+
+def _trim(args):
+    from . import impulse_response as ir, wav_util
+
+    params, samples = wav_util.read_wave_nbit(args.input)
+    trimmed, info = ir.extract_ir(samples, params.framerate, pre_onset=args.pre_onset, max_seconds=args.max_seconds, sweep=args.sweep)
+    _write(args.output, trimmed, params.framerate, args.format, peak=args.peak)
+    print(f'onset {info["onset"]}, end {info["end"]}, noise floor {info["noise_floor_db"]:.1f} dB')
+
+
+def _convolve(args):
+    from .Signal import load_signal
+
+    source = load_signal(args.source, lazy=args.engine == 'partitioned')
+    if args.library is not None:
+        from .ir_library import IRLibrary
+
+        library = IRLibrary(args.library)
+        assert library.info(args.impulse)['sample_rate'] == source.get_sps(), 'the impulse response has a different sampling rate'
+        impulse = library.convolver(args.impulse, args.block_size)
+    else:
+        impulse = load_signal(args.impulse)
+    convolved = source.convolve(impulse, engine=args.engine, block_size=args.block_size)
+    _write(args.output, convolved.get_signal(), source.get_sps(), args.format, peak=args.peak)
+
+
+def _spectrogram(args):
+    from .Signal import load_signal
+
+    source = load_signal(args.input, lazy=True)
+    source.spectrogram(args.output, fmax=args.fmax, width=args.width, height=args.height)
+
+
+def _add_output(parser, format='int16', peak=False):
+    parser.add_argument('output', help='output file')
+    parser.add_argument('--format', choices=list(formats), default=format, help=f'output sample format (default {format})')
+    if peak:
+        parser.add_argument('--peak', type=float, default=0.95, help='normalize the output to this peak (default 0.95)')
+
+
+def _add_trim(parser):
+    parser.add_argument('--pre-onset', type=float, default=0.002, help='seconds kept before the direct sound')
+    parser.add_argument('--max-seconds', type=float, help='upper bound on the length of the impulse response')
+
+
+def parser():
+    '''
+    Returns the argparse parser of the command line.
+    '''
+    parser = argparse.ArgumentParser(prog='python -m ir_module', description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    sweep = commands.add_parser('sweep', help='generate a sine sweep')
+    _add_output(sweep)
+    sweep.add_argument('--start', type=float, default=50, help='start frequency in Hz')
+    sweep.add_argument('--end', type=float, default=20000, help='end frequency in Hz')
+    sweep.add_argument('--seconds', type=float, default=10, help='duration in seconds')
+    sweep.add_argument('--rate', type=int, default=48000, help='sampling rate in Hz')
+    sweep.add_argument('--amplitude', type=float, default=0.75, help='amplitude between 0 and 1')
+    sweep.add_argument('--mode', choices=['exp', 'lin'], default='exp', help='exponential or linear sweep')
+    sweep.set_defaults(run=_sweep)
+
+    average = commands.add_parser('average', help='align and average repeated recordings')
+    average.add_argument('directory', help='directory of WAVE files, one per take')
+    _add_output(average, 'float32')
+    average.add_argument('--frames', type=int, help='frames read from every take (default: the shortest take)')
+    average.add_argument('--cache-dir', help='directory of an on-disk cache for the average')
+    average.set_defaults(run=_average)
+
+    deconvolve = commands.add_parser('deconvolve', help='extract the impulse response of a recorded sweep')
+    deconvolve.add_argument('recording', help='recording of the sweep')
+    deconvolve.add_argument('reference', nargs='?', metavar='sweep_file', help='the sweep that was played, for sweeps not made by the sweep command; it is applied time-reversed, without compensating its spectrum')
+    _add_output(deconvolve, 'float32', peak=True)
+    deconvolve.add_argument('--sweep', type=float, nargs=3, metavar=('START', 'END', 'SECONDS'), help='parameters of the exponential sweep that was played (as given to the sweep command), deconvolved with its amplitude-compensated inverse filter')
+    deconvolve.add_argument('--trim', action='store_true', help='trim the result to the impulse response (see trim)')
+    _add_trim(deconvolve)
+    deconvolve.set_defaults(run=_deconvolve)
+
+    trim = commands.add_parser('trim', help='trim a deconvolved recording to its impulse response')
+    trim.add_argument('input', help='deconvolved recording')
+    _add_output(trim, 'float32', peak=True)
+    _add_trim(trim)
+    trim.add_argument('--sweep', type=float, nargs=3, metavar=('START', 'END', 'SECONDS'), help='parameters of an exponential sweep, to skip its harmonic distortion')
+    trim.set_defaults(run=_trim)
+
+    convolve = commands.add_parser('convolve', help='apply an impulse response to a dry recording')
+    convolve.add_argument('source', help='dry recording')
+    convolve.add_argument('impulse', help='impulse response file, or its name with --library')
+    _add_output(convolve, peak=True)
+    convolve.add_argument('--engine', choices=['fft', 'partitioned'], default='fft', help='convolution engine, see convolve.convolve_audio')
+    convolve.add_argument('--block-size', type=int, default=4096, help='partition size of the partitioned engine')
+    convolve.add_argument('--library', help='ir_library directory to look the impulse response up in')
+    convolve.set_defaults(run=_convolve)
+
+    spectrogram = commands.add_parser('spectrogram', help='render a spectrogram to an image file')
+    spectrogram.add_argument('input', help='WAVE file')
+    spectrogram.add_argument('output', help='image file; the format follows the extension')
+    spectrogram.add_argument('--fmax', type=float, help='highest frequency shown, in Hz')
+    spectrogram.add_argument('--width', type=int, default=1024, help='time resolution in pixels')
+    spectrogram.add_argument('--height', type=int, default=512, help='frequency resolution in pixels')
+    spectrogram.set_defaults(run=_spectrogram)
+
+    return parser
+
+
+def main(argv=None):
+    '''
+    Run a command of the command line.
+    :argv: list of arguments, default sys.argv[1:]
+    Returns the exit status.
+    '''
+    args = parser().parse_args(argv)
+    args.run(args)
+
+    return 0
@@ -1,39 +1,350 @@
+import functools
 import numpy as np
-import scipy.signal as signal
+from . import default, fft_backend as fb, instrument, wav_util
 
 
 
-def convolve_audio(source, impulse):
+@instrument.instrumented()
+def convolve_audio(source, impulse, engine='fft', block_size=default.block_size):
     '''
     Convolve source signal with impulse response (i.e. to add reverb effects to a dry audio file)
-    :source: (array) input audio signal
-    :impulse: (array) impulse response 
+    :source: (array) input audio signal, (frames,) or (frames, channels)
+    :impulse: (array) impulse response, (frames,) or (frames, channels), or a PartitionedConvolver, which selects the
+    'partitioned' engine with its precomputed spectra and block size
+    :engine: ['fft', 'partitioned'] 'fft' convolves the whole signal in one transform. 'partitioned' uses a
+    PartitionedConvolver, whose memory use depends on block_size and the impulse response length but not on the source length.
+    :block_size: (int) partition size in frames for the 'partitioned' engine
+    A mono impulse response is applied to every channel of the source, and a mono source is sent through every channel
+    of the impulse response; otherwise channel counts must match. All channels are convolved in one batched FFT pass,
+    transforming a mono operand only once.
     Returns the convolved audio
     '''
-    assert source[np.argmax(source)] <= 1.0 and source[np.argmin(source)] >= -1.0, f'ir samples not within bounds: {source[np.argmin(source)], source[np.argmax(source)]}'
-    assert impulse[np.argmax(impulse)] <= 1.0 and impulse[np.argmin(impulse)] >= -1.0, f'ir samples not within bounds {impulse[np.argmin(impulse)], impulse[np.argmax(impulse)]}'
+    if isinstance(impulse, PartitionedConvolver):
+        engine = 'partitioned'
+    else:
+        assert np.max(impulse) <= 1.0 and np.min(impulse) >= -1.0, f'ir samples not within bounds {np.min(impulse), np.max(impulse)}'
+    # a lazily decoded source (wav_util.MappedWave) of integer PCM is within bounds by construction, but floating-point
+    # files are not normalized, so they are checked as well: block by block as the partitioned engine decodes them
+    float_source = isinstance(source, wav_util.MappedWave) and source.params.comptype != 'NONE'
+    if float_source and engine == 'fft':
+        source = np.asarray(source)
+    if isinstance(source, np.ndarray):
+        assert np.max(source) <= 1.0 and np.min(source) >= -1.0, f'ir samples not within bounds: {np.min(source), np.max(source)}'
 
-    zeros = np.zeros(len(impulse))
-    padded_src = np.append(zeros, source)
-    padded_src = np.append(padded_src, zeros)
-    convolved = signal.convolve(padded_src, impulse, mode='full', method='auto')
+    if engine == 'partitioned':
+        scaled_conv = convolve_partitioned(source, impulse, block_size=block_size, check_bounds=float_source)
+        scaled_conv *= 0.75
+        return scaled_conv
+    assert engine == 'fft', f'unknown convolution engine: {engine}'
+    # the transform size fftconvolve uses
+    instrument.note('fft_size', fb.next_fast_len(len(source) + len(impulse) - 1))
+
+    if source.ndim == 2 or impulse.ndim == 2:
+        source = source.reshape(len(source), -1)
+        impulse = impulse.reshape(len(impulse), -1)
+        assert 1 in (source.shape[1], impulse.shape[1]) or source.shape[1] == impulse.shape[1], f'channel mismatch: source: {source.shape[1]}; impulse: {impulse.shape[1]}'
+    convolved = fb.fftconvolve(source, impulse)
     # normalize
-    max_val = np.ceil(convolved[np.argmax(convolved)])
-    scaled_conv = convolved * 0.75
+    scaled_conv = convolved[:len(source)] * 0.75
    
-    return scaled_conv[len(impulse):len(impulse)+len(source)]
+    return scaled_conv
+
+
+def _stack(arrays):
+    # (items, frames, channels), zero-padded to the longest item, and whether every item is mono
+    if isinstance(arrays, np.ndarray):
+        return arrays.reshape(arrays.shape[:2] + (-1,)), arrays.ndim == 2
+    arrays = [np.asarray(array) for array in arrays]
+    channels = max(array.shape[1] if array.ndim == 2 else 1 for array in arrays)
+    dtype = np.result_type(np.float32, *arrays)
+    stacked = np.zeros((len(arrays), max(len(array) for array in arrays), channels), dtype=dtype)
+    for item, array in zip(stacked, arrays):
+        item[:len(array)] = array.reshape(len(array), -1)
+
+    return stacked, all(array.ndim == 1 for array in arrays)
+
+
+def _convolve_batched(batch, shared, frames, workers, max_memory):
+    # convolve every item of batch (items, frames, channels) with shared (frames, channels), truncated to frames
+    assert 1 in (batch.shape[2], shared.shape[1]) or batch.shape[2] == shared.shape[1], f'channel mismatch: {batch.shape[2]}; {shared.shape[1]}'
+    nfft = fb.next_fast_len(batch.shape[1] + len(shared) - 1)
+    instrument.note('fft_size', nfft)
+    channels = max(batch.shape[2], shared.shape[1])
+    dtype = np.result_type(np.float32, batch.dtype, shared.dtype)
+    # the shared operand is transformed once, and broadcast against every item
+    shared_spectrum = fb.rfft(shared, nfft, axis=0, workers=workers)
+    out = np.empty((len(batch), frames, channels), dtype=dtype)
+    # per item: its spectrum, the product, and the inverse transform
+    item_bytes = (nfft // 2 + 1) * channels * 2 * np.dtype(shared_spectrum.dtype).itemsize + nfft * channels * dtype.itemsize
+    step = max(1, int(max_memory // item_bytes))
+    for start in range(0, len(batch), step):
+        spectra = fb.rfft(batch[start:start + step], nfft, axis=1, workers=workers)
+        spectra = spectra * shared_spectrum
+        out[start:start + step] = fb.irfft(spectra, nfft, axis=1, workers=workers)[:, :frames]
+
+    return out
+
+
+def _check_bounds(array, name):
+    assert np.max(array) <= 1.0 and np.min(array) >= -1.0, f'{name} samples not within bounds: {np.min(array), np.max(array)}'
+
+
+@instrument.instrumented()
+def convolve_one_to_many(source, impulses, workers=None, max_memory=default.batch_memory):
+    '''
+    Convolve one source with many impulse responses (e.g. a dry track with the impulse responses of every measured
+    position). The source is transformed once; the impulse responses are transformed, multiplied and inverse
+    transformed together, in batches of at most max_memory bytes of intermediate arrays.
+    :source: (frames,) or (frames, channels) array
+    :impulses: sequence of impulse responses, each (frames,) or (frames, channels), or an array whose first axis indexes
+    them; shorter impulse responses are zero-padded
+    :workers: (int) number of threads used by each FFT, -1 for all CPUs, default fft_backend.get_workers()
+    :max_memory: (int) bound in bytes on the intermediate arrays of one batch
+    Channels are broadcast as in convolve_audio, and the results are scaled in the same way.
+    Returns a (impulses, frames) or (impulses, frames, channels) array, frames being the length of source.
+    '''
+    source = np.asarray(source)
+    _check_bounds(source, 'source')
+    stacked, mono = _stack(impulses)
+    _check_bounds(stacked, 'ir')
+    convolved = _convolve_batched(stacked, source.reshape(len(source), -1), len(source), workers, max_memory)
+    convolved *= 0.75
+
+    return convolved[:, :, 0] if mono and source.ndim == 1 else convolved
+
+
+@instrument.instrumented()
+def convolve_many_to_one(sources, impulse, workers=None, max_memory=default.batch_memory):
+    '''
+    Convolve many sources (e.g. the stems of a mix) with one impulse response, which is transformed once; the sources
+    are transformed, multiplied and inverse transformed together, in batches of at most max_memory bytes of
+    intermediate arrays.
+    :sources: sequence of sources, each (frames,) or (frames, channels), or an array whose first axis indexes them;
+    shorter sources are zero-padded to the longest
+    :impulse: (frames,) or (frames, channels) impulse response
+    :workers: (int) number of threads used by each FFT, -1 for all CPUs, default fft_backend.get_workers()
+    :max_memory: (int) bound in bytes on the intermediate arrays of one batch
+    Channels are broadcast as in convolve_audio, and the results are scaled in the same way.
+    Returns a (sources, frames) or (sources, frames, channels) array, frames being the length of the longest source.
+    '''
+    impulse = np.asarray(impulse)
+    _check_bounds(impulse, 'ir')
+    stacked, mono = _stack(sources)
+    _check_bounds(stacked, 'source')
+    convolved = _convolve_batched(stacked, impulse.reshape(len(impulse), -1), stacked.shape[1], workers, max_memory)
+    convolved *= 0.75
+
+    return convolved[:, :, 0] if mono and impulse.ndim == 1 else convolved
+
+
+def partition_spectra(impulse, block_size=default.block_size):
+    '''
+    Split an impulse response into partitions of block_size frames and transform them (FFT size 2 * block_size),
+    as used by PartitionedConvolver.
+    :impulse: impulse response, (frames,) or (frames, channels)
+    Returns a (partitions, block_size + 1, channels) complex array.
+    '''
+    impulse = np.asarray(impulse)
+    impulse = impulse.reshape(len(impulse), -1)
+    partitions = max(1, -(-len(impulse) // block_size))
+    padded = np.zeros((partitions * block_size, impulse.shape[1]), dtype=np.result_type(impulse.dtype, np.float32))
+    padded[:len(impulse)] = impulse
+
+    return fb.rfft(padded.reshape(partitions, block_size, -1), 2 * block_size, axis=1)
+
+
+class PartitionedConvolver:
+    '''
+    Uniformly-partitioned overlap-save convolution.
+    The impulse response is split into partitions of block_size frames, whose spectra (FFT size 2 * block_size) are
+    computed once. Each input block is transformed once and kept in a frequency-domain delay line, so an output block
+    costs one forward FFT, one inverse FFT and a multiply-accumulate over the partitions.
+    Output block n holds the convolution output for the frames of input block n.
+    '''
+    def __init__(self, impulse, block_size=default.block_size, spectra=None):
+        '''
+        :impulse: impulse response, (frames,) or (frames, channels)
+        :block_size: (int) number of frames per partition and per processed block
+        :spectra: optional precomputed partition spectra (see partition_spectra), e.g. memory-mapped from an
+        ir_library.IRLibrary. impulse is then ignored (it can be None), the block size follows from the spectra, and
+        single-channel spectra are treated as a mono impulse response.
+        '''
+        if spectra is None:
+            impulse = np.asarray(impulse)
+            self._mono = impulse.ndim == 1
+            spectra = partition_spectra(impulse, block_size)
+        else:
+            self._mono = spectra.shape[2] == 1
+        # (partitions, bins, channels)
+        self._spectra = spectra
+        self._block_size = spectra.shape[1] - 1
+        self._fdl = None
+        self._input = None
+        self._tail = None
+        self._pos = 0
+        self._prepared = 1
+
+
+    def get_block_size(self):
+        '''
+        Returns the number of frames per block.
+        '''
+        return self._block_size
+
+
+    def get_partitions(self):
+        '''
+        Returns the number of impulse response partitions.
+        '''
+        return len(self._spectra)
+
+
+    def get_channels(self):
+        '''
+        Returns the number of impulse response channels.
+        '''
+        return self._spectra.shape[2]
+
+
+    def get_spectra(self):
+        '''
+        Returns the (partitions, block_size + 1, channels) partition spectra.
+        '''
+        return self._spectra
+
+
+    def reset(self):
+        '''
+        Clear the input history, as if no blocks had been processed.
+        '''
+        self._fdl = None
+        self._input = None
+        self._tail = None
+        self._pos = 0
+        self._prepared = 1
+
+
+    def prepare(self, partitions=None):
+        '''
+        Accumulate part of the next output block ahead of time. Partitions after the first only apply to blocks that
+        were already processed, so their multiply-accumulate can be spread over the time until the next block arrives,
+        and process then only applies the first partition to the new block.
+        :partitions: (int) number of partitions to accumulate, default all remaining
+        Returns the number of partitions still to accumulate.
+        '''
+        total = len(self._spectra)
+        if self._fdl is None:
+            return 0
+        first = self._prepared
+        count = total - first if partitions is None else min(partitions, total - first)
+        if count > 0:
+            # the delay line is a ring buffer: partition p is applied to the spectrum of the block p steps back
+            start = (self._pos - first) % total
+            head = min(count, start + 1)
+            self._tail += np.einsum('pkc,pkc->kc', self._fdl[start::-1][:head], self._spectra[first:first + head])
+            if count > head:
+                self._tail += np.einsum('pkc,pkc->kc', self._fdl[::-1][:count - head], self._spectra[first + head:first + count])
+            self._prepared += count
+
+        return total - self._prepared
+
+
+    def process(self, block):
+        '''
+        Convolve the next block of input.
+        :block: block_size frames, (frames,) or (frames, channels). A shorter final block is zero-padded.
+        Returns block_size frames of output, with as many channels as the wider of the input and impulse response.
+        '''
+        block_size = self._block_size
+        mono = self._mono and block.ndim == 1
+        block = block.reshape(len(block), -1)
+        assert len(block) <= block_size, f'block is longer than the block size: {len(block)} > {block_size}'
+        if self._input is None:
+            channels = block.shape[1]
+            assert 1 in (channels, self._spectra.shape[2]) or channels == self._spectra.shape[2], f'channel mismatch: block: {channels}; impulse: {self._spectra.shape[2]}'
+            self._input = np.zeros((2 * block_size, channels), dtype=self._spectra.real.dtype)
+            self._fdl = np.zeros((len(self._spectra), block_size + 1, channels), dtype=self._spectra.dtype)
+            self._tail = np.zeros((block_size + 1, max(channels, self._spectra.shape[2])), dtype=self._spectra.dtype)
+
+        # overlap-save: the FFT window holds the previous and the current block
+        self._input[:block_size] = self._input[block_size:]
+        self._input[block_size:block_size + len(block)] = block
+        self._input[block_size + len(block):] = 0
+
+        # the partitions prepare has not accumulated yet
+        self.prepare()
+        pos = self._pos
+        # blocks are small, so threads would cost more than they save
+        self._fdl[pos] = fb.rfft(self._input, axis=0, workers=1)
+        self._tail += self._fdl[pos] * self._spectra[0]
+        out = fb.irfft(self._tail, 2 * block_size, axis=0, workers=1)[block_size:]
+        self._pos = (pos + 1) % len(self._spectra)
+        self._tail[:] = 0
+        self._prepared = 1
+
+        return out[:, 0] if mono else out
+
+
+def convolve_blocks(blocks, impulse, block_size=default.block_size):
+    '''
+    Convolve a stream of input blocks with an impulse response, yielding output blocks as they are computed.
+    Memory use is bounded by the block size and impulse response length, so the source can be arbitrarily long
+    (e.g. the blocks of a wav_util.MappedWave or a Signal).
+    :blocks: iterable of blocks of at most block_size frames
+    :impulse: impulse response array, or a PartitionedConvolver to reuse its precomputed partition spectra
+    :block_size: (int) partition size in frames, ignored if impulse is a PartitionedConvolver
+    Yields output blocks of the same length as the corresponding input blocks.
+    '''
+    convolver = impulse if isinstance(impulse, PartitionedConvolver) else PartitionedConvolver(impulse, block_size)
+    for block in blocks:
+        yield convolver.process(block)[:len(block)]
+
+
+@instrument.instrumented()
+def convolve_partitioned(source, impulse, block_size=default.block_size, out=None, check_bounds=False):
+    '''
+    Convolve source with impulse using uniformly-partitioned overlap-save, truncated to the length of source.
+    :source: array or wav_util.MappedWave, (frames,) or (frames, channels)
+    :impulse: impulse response array, or a PartitionedConvolver, which is reset first
+    :block_size: (int) partition size in frames
+    :out: optional preallocated output array (e.g. a numpy memmap) of the output shape
+    :check_bounds: (bool) assert that every source block is within [-1, 1] as it is decoded
+    Returns the convolved (unscaled) signal.
+    '''
+    convolver = impulse if isinstance(impulse, PartitionedConvolver) else PartitionedConvolver(impulse, block_size)
+    convolver.reset()
+    block_size = convolver.get_block_size()
+    instrument.note('fft_size', 2 * block_size)
+    for start in range(0, len(source), block_size):
+        block = np.asarray(source[start:start + block_size])
+        if check_bounds:
+            assert np.max(block) <= 1.0 and np.min(block) >= -1.0, f'source samples not within bounds after frame {start}: {np.min(block), np.max(block)}'
+        conv = convolver.process(block)[:len(block)]
+        if out is None:
+            out = np.empty((len(source),) + conv.shape[1:], dtype=conv.dtype)
+        out[start:start + len(block)] = conv
+    if out is None:
+        out = np.zeros(np.shape(source), dtype=np.float32)
+
+    return out
 
 
 # adapted from https://github.com/pdx-cs-sound/hw-resample/blob/master/filtercoeffs.py - Bart Massey
+@functools.lru_cache(maxsize=8)
+def _lp_coefficients(nyquist_f):
+    from scipy import signal
+
+    cutoff = nyquist_f * 0.45
+    numtaps, beta = signal.kaiserord(60, 0.05)
+    return signal.firwin(numtaps, cutoff, window=('kaiser', beta), scale=True, fs=nyquist_f)
+
+
 def lp_filter(source, nyquist_f):
     '''
-    A simple low-pass filter.
+    A simple low-pass filter. The filter is designed once per cutoff frequency.
     :source: the source signal to filter
     :nyquist_f: cutoff frequency value (typically the Nyquist frequency) 
     Returns a numpy array of floating-point values of the filtered signal.
     '''
-    cutoff = nyquist_f * 0.45
-    numtaps, beta = signal.kaiserord(60, 0.05)
-    lpfilter = signal.firwin(numtaps, cutoff, window=('kaiser', beta), scale=True, fs=nyquist_f)
-    filtered = signal.convolve(source, lpfilter, mode='full', method='auto')
+    filtered = fb.fftconvolve(source, _lp_coefficients(nyquist_f))
     return filtered[:len(source)]
\ No newline at end of file
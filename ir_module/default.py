@@ -12,4 +12,10 @@ ir_dir = 'ir'                    # directory name for impulse responses
 sweep_dir = 'sweep'              # directory name for sine sweeps
 
 two_pi = 2 * np.pi               # regularly-used constants
-fft_sz = 4096
\ No newline at end of file
+fft_sz = 4096
+block_size = 4096                # frames per partition for partitioned convolution
+dtype = np.float32               # working precision of Signal samples; np.float64 on request
+cache_size = 2 * 2**30           # bytes of intermediate arrays kept by cache.DiskCache
+batch_memory = 512 * 2**20       # bytes of intermediate arrays per batch of batched convolution
+fft_workers = -1                 # threads per FFT (see fft_backend), -1 for all CPUs
+library_block_sizes = (256, 1024, 4096)  # partition sizes precomputed by ir_library.IRLibrary
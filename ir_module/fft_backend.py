@@ -0,0 +1,153 @@
+import functools
+from contextlib import contextmanager
+import numpy as np
+from . import default
+
+'''
+the FFT layer of ir_module: transform sizes, worker threads, cached windows and a swappable backend
+'''
+# a module with the scipy.fft interface, see set_backend. It is loaded by the first transform, as importing scipy.fft
+# takes longer than importing the rest of ir_module.
+_backend = None
+_backend_name = 'scipy'
+_workers = default.fft_workers
+
+
+def _load_scipy():
+    from scipy import fft
+
+    return fft
+
+
+def _load_pyfftw():
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+
+    # keep the FFTW plans of recently used sizes, so repeated transforms skip planning
+    pyfftw.interfaces.cache.enable()
+    pyfftw.interfaces.cache.set_keepalive_time(60)
+    return pyfftw.interfaces.scipy_fft
+
+
+_loaders = {'scipy': _load_scipy, 'pyfftw': _load_pyfftw}
+
+
+def _get_backend():
+    global _backend
+    if _backend is None:
+        _backend = _loaders[_backend_name]()
+    return _backend
+
+
+def set_backend(backend):
+    '''
+    Select the library that computes the transforms of ir_module.
+    :backend: 'scipy' (default, pocketfft), 'pyfftw' (FFTW, an optional dependency), or a module with the scipy.fft
+    interface (rfft, irfft and next_fast_len accepting workers)
+    The backend is also installed for the scipy.signal functions run inside scipy_context().
+    '''
+    global _backend, _backend_name
+    if isinstance(backend, str):
+        assert backend in _loaders, f'unknown FFT backend: {backend}'
+        _backend, _backend_name = _loaders[backend](), backend
+    else:
+        _backend, _backend_name = backend, getattr(backend, '__name__', repr(backend))
+    next_fast_len.cache_clear()
+
+
+def get_backend():
+    '''
+    Returns the name of the current backend.
+    '''
+    return _backend_name
+
+
+def set_workers(workers):
+    '''
+    Set the number of threads each transform may use, -1 for all CPUs. Threads split the independent transforms of
+    a batch (channels, takes, segments), so single 1-D transforms are not faster with more workers.
+    '''
+    global _workers
+    assert workers == -1 or workers >= 1, f'invalid number of FFT workers: {workers}'
+    _workers = workers
+
+
+def get_workers():
+    '''
+    Returns the number of threads per transform.
+    '''
+    return _workers
+
+
+@contextmanager
+def scipy_context():
+    '''
+    Context manager routing the transforms computed inside scipy.signal (e.g. stft, resample) through the current
+    backend and number of workers.
+    '''
+    from scipy import fft as sp_fft
+
+    with sp_fft.set_workers(_workers):
+        if _get_backend() is sp_fft:
+            yield
+        else:
+            with sp_fft.set_backend(_backend):
+                yield
+
+
+@functools.lru_cache(maxsize=1024)
+def next_fast_len(n):
+    '''
+    Returns the smallest length of at least n frames that the backend transforms efficiently (for real input).
+    '''
+    return _get_backend().next_fast_len(n, real=True)
+
+
+def rfft(x, n=None, axis=-1, workers=None):
+    '''
+    Real-input FFT, see scipy.fft.rfft.
+    :workers: (int) threads for this transform, default get_workers()
+    '''
+    return _get_backend().rfft(x, n, axis=axis, workers=_workers if workers is None else workers)
+
+
+def irfft(x, n=None, axis=-1, workers=None):
+    '''
+    Inverse of rfft, see scipy.fft.irfft.
+    :workers: (int) threads for this transform, default get_workers()
+    '''
+    return _get_backend().irfft(x, n, axis=axis, workers=_workers if workers is None else workers)
+
+
+def rfftfreq(n, d=1.0):
+    '''
+    Frequencies of the bins of rfft, see numpy.fft.rfftfreq.
+    '''
+    return np.fft.rfftfreq(n, d)
+
+
+def fftconvolve(a, b, axis=0):
+    '''
+    Full linear convolution of a and b along axis, with one forward transform of each and one inverse transform, at
+    a fast transform length. Other axes are broadcast, e.g. a (frames, channels) signal and a (frames, 1) filter.
+    Returns an array of len(a) + len(b) - 1 frames along axis.
+    '''
+    a, b = np.asarray(a), np.asarray(b)
+    conv_len = a.shape[axis] + b.shape[axis] - 1
+    nfft = next_fast_len(conv_len)
+    conv = irfft(rfft(a, nfft, axis=axis) * rfft(b, nfft, axis=axis), nfft, axis=axis)
+
+    return conv[(slice(None),) * (axis % conv.ndim) + (slice(conv_len),)]
+
+
+@functools.lru_cache(maxsize=32)
+def get_window(name, nperseg, dtype=np.float32):
+    '''
+    Returns a read-only window of nperseg frames, computed once per name, length and dtype (see
+    scipy.signal.get_window).
+    '''
+    from scipy import signal
+
+    window = signal.get_window(name, nperseg).astype(dtype)
+    window.flags.writeable = False
+    return window
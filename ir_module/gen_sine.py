@@ -1,7 +1,36 @@
+import functools
 import numpy as np
+from . import fft_backend as fb, instrument
 from .default import *
 
 
+def _envelope(n, sweep_len, st_amp, end_amp):
+    # same values as np.linspace(st_amp, end_amp, num=sweep_len, endpoint=True)[n]
+    if sweep_len < 2:
+        return np.full(len(n), float(st_amp))
+    return st_amp + (end_amp - st_amp) * (n / (sweep_len - 1))
+
+
+def _sine_frames(n, freq, sample_rate, amp):
+    return amp * np.sin(two_pi * freq * ((n % sample_rate) / sample_rate))
+
+
+def _lin_sweep_frames(n, start, end, duration, sample_rate, st_amp, end_amp):
+    t = n / sample_rate
+    phase = two_pi * ((start * t) + (((end - start) / (2 * duration)) * (t ** 2)))
+    return np.array(_envelope(n, sample_rate * duration, st_amp, end_amp) * np.sin(phase), dtype='f')
+
+
+def _exp_sweep_frames(n, start, end, duration, sample_rate, st_amp, end_amp):
+    sweep_len = sample_rate * duration
+    log_ratio = np.log(end / start)
+    # k**n, with k = (end / start) ** (1 / sweep_len)
+    growth = np.exp(n * (log_ratio / sweep_len))
+    phase = two_pi * start * duration * (growth - 1) / log_ratio
+    return np.array(_envelope(n, sweep_len, st_amp, end_amp) * np.sin(phase), dtype='f')
+
+
+@instrument.instrumented()
 def sine_wave(freq, duration, sample_rate=sample_rate, amp=amplitude):
     '''
     Generate single sine wave frequency for specified duration.
@@ -11,16 +40,13 @@ def sine_wave(freq, duration, sample_rate=sample_rate, amp=amplitude):
     :amp: signal amplitude, default=0.75
     Returns a numpy array of normalized floating-point frames.
     '''
-    def sine_func(samp):
-        return amp * np.sin(two_pi * freq * ((samp % sample_rate)/ sample_rate))
-
     length = sample_rate * duration
-    samples = np.linspace(0, length, num=length, endpoint=False)
-    samples = np.array(list(map(sine_func, samples)))
+    samples = _sine_frames(np.arange(length, dtype=np.float64), freq, sample_rate, amp)
 
     return samples
 
 # linear sine function referenced from https://www.recordingblogs.com/wiki/sine-sweep
+@instrument.instrumented()
 def lin_sweep(start, end, duration, sample_rate=sample_rate, st_amp=0.75, end_amp=0.75):
     '''
     Generate linear sine chirp, with constant amplitude over time
@@ -30,18 +56,13 @@ def lin_sweep(start, end, duration, sample_rate=sample_rate, st_amp=0.75, end_am
     Returns a numpy array of normalized floating-point frames.
     '''
     sweep_len = sample_rate * duration
-    amp_array = np.linspace(st_amp, end_amp, num=sweep_len, endpoint=True)
-    sweep = np.linspace(0, sweep_len, num=sweep_len, endpoint=False)
-
-    def sweep_func(sample):
-        return amp_array[int(sample)] * np.sin(two_pi * ((start*sample/sample_rate) + (((end-start)/(2*duration))*((sample/sample_rate)**2))))
-   
-    frames = np.array(list(map(sweep_func, sweep)), dtype='f')
+    frames = _lin_sweep_frames(np.arange(sweep_len, dtype=np.float64), start, end, duration, sample_rate, st_amp, end_amp)
 
     return frames
 
 
 # exponential sine function referenced from https://www.recordingblogs.com/wiki/sine-sweep
+@instrument.instrumented()
 def exp_sweep(start, end, duration, sample_rate=sample_rate, st_amp=0.75, end_amp=0.75):
     '''
     Generate exponential sine chirp, with increasing or decreasing amplitude over time
@@ -54,14 +75,74 @@ def exp_sweep(start, end, duration, sample_rate=sample_rate, st_amp=0.75, end_am
     Returns a numpy array of normalized floating-point frames.
     '''
     sweep_len = sample_rate * duration
-    freq_ratio = end / start
-    k = np.power(freq_ratio, 1/sweep_len)
-    amp_array = np.linspace(st_amp, end_amp, num=sweep_len, endpoint=True)
-    sweep = np.linspace(0, sweep_len, num=sweep_len, endpoint=False)
-
-    def sweep_func(sample):
-        return amp_array[int(sample)] * np.sin(two_pi * start * duration * (np.power(k, sample) - 1) / np.log(freq_ratio)) 
-
-    sweep = np.array(list(map(sweep_func, sweep)), dtype='f')
+    sweep = _exp_sweep_frames(np.arange(sweep_len, dtype=np.float64), start, end, duration, sample_rate, st_amp, end_amp)
     
     return sweep
+
+
+def sweep_blocks(mode, duration, block_size=fft_sz, freq=frequency, amp=amplitude, start=440, end=440, sample_rate=sample_rate, st_amp=0.75, end_amp=0.75):
+    '''
+    Generate a sine wave or sweep in consecutive blocks, for streaming to a playback or file sink with constant memory.
+    Every frame is computed from its absolute sample index, so the concatenated blocks are identical to the output of
+    sine_wave, lin_sweep or exp_sweep, with continuous phase across block boundaries.
+    :mode: ['sine', 'lin', 'exp'] as in Signal.generate_sine
+    :duration: duration of signal in seconds
+    :block_size: (int) frames per block; the final block may be shorter
+    :freq: / :amp: frequency and amplitude of a standing sine wave
+    :start: / :end: / :st_amp: / :end_amp: starting/ending frequency and amplitude of a sweep
+    :sample_rate: samples per second, default=48000
+    Yields numpy arrays of normalized floating-point frames.
+    '''
+    length = sample_rate * duration
+    for first in range(0, length, block_size):
+        n = np.arange(first, min(first + block_size, length), dtype=np.float64)
+        if mode == 'sine':
+            yield _sine_frames(n, freq, sample_rate, amp)
+        elif mode == 'lin':
+            yield _lin_sweep_frames(n, start, end, duration, sample_rate, st_amp, end_amp)
+        elif mode == 'exp':
+            yield _exp_sweep_frames(n, start, end, duration, sample_rate, st_amp, end_amp)
+        else:
+            raise ValueError(f'unknown mode: {mode}')
+
+
+# inverse filter from A. Farina, "Simultaneous measurement of impulse response and distortion with a Swept-Sine technique", 2000
+@functools.lru_cache(maxsize=8)
+def exp_sweep_inverse(start, end, duration, sample_rate=sample_rate, st_amp=0.75, end_amp=0.75):
+    '''
+    Generate the amplitude-compensated inverse filter of exp_sweep with the same parameters.
+    The time-reversed sweep is weighted by 6 dB/octave (proportional to the instantaneous frequency) to undo the pink
+    spectrum of the exponential sweep, and divided by the squared amplitude envelope, then scaled so that the sweep
+    convolved with its inverse filter has unity gain over the swept band.
+    The result is cached; the returned array is read-only.
+    Returns a numpy array of floating-point frames, the same length as the sweep.
+    '''
+    sweep = exp_sweep(start, end, duration, sample_rate=sample_rate, st_amp=st_amp, end_amp=end_amp)
+    sweep_len = len(sweep)
+    rate = np.log(end / start) / duration
+    t = np.arange(sweep_len) / sample_rate
+    # the sweep envelope, as seen by the time-reversed filter; limited to avoid dividing by a silent fade
+    amp = np.maximum(np.linspace(st_amp, end_amp, num=sweep_len, endpoint=True)[::-1], 1e-3)
+    inverse = sweep[::-1] * np.exp(-t * rate) / (amp ** 2)
+
+    # calibrate on the median gain over the swept band, one octave in from each end
+    nfft = fb.next_fast_len(2 * sweep_len - 1)
+    gain = np.abs(fb.rfft(sweep, nfft) * fb.rfft(inverse, nfft))
+    freqs = fb.rfftfreq(nfft, 1 / sample_rate)
+    band = (freqs >= min(start, end) * 2) & (freqs <= max(start, end) / 2)
+    inverse = np.array(inverse / np.median(gain[band]), dtype='f')
+    inverse.flags.writeable = False
+
+    return inverse
+
+
+@functools.lru_cache(maxsize=8)
+def exp_sweep_inverse_spectrum(start, end, duration, nfft, sample_rate=sample_rate, st_amp=0.75, end_amp=0.75):
+    '''
+    Real FFT of size nfft of exp_sweep_inverse with the same sweep parameters, for deconvolution by a single spectral multiply.
+    The result is cached; the returned array is read-only.
+    '''
+    spectrum = fb.rfft(exp_sweep_inverse(start, end, duration, sample_rate, st_amp, end_amp), nfft)
+    spectrum.flags.writeable = False
+
+    return spectrum
@@ -1,20 +1,132 @@
+import threading
 import numpy as np
 from time import time
-import matplotlib.pyplot as plt
-from scipy import signal
+from . import fft_backend as fb, instrument
 from .default import *
+from .wav_util import iter_blocks
 
-def graph_stft(sig, save=False, fname='', fft_sz=fft_sz):
+@instrument.instrumented()
+def graph_stft(sig, save=False, fname='', fft_sz=fft_sz, sample_rate=sample_rate, show=True):
     '''
     Calculate stft of signal and plot graph of magnitude spectrum
     :samples_arr: array of signal samples in 16-bit integer format
+    :sample_rate: (int) sampling rate in Hz, used for the time and frequency axes
+    :show: (bool) display the graph; the graph is saved before it is shown
     '''
-    f_out,t_out,stft = signal.stft(sig, nperseg=2048, nfft=fft_sz)
+    import matplotlib.pyplot as plt
+    from scipy import signal
+
+    with fb.scipy_context():
+        f_out,t_out,stft = signal.stft(sig, fs=sample_rate, nperseg=2048, nfft=fft_sz)
     plt.pcolormesh(t_out, f_out, np.abs(stft), shading='auto')
     plt.ylabel('Frequency [Hz]')
     plt.xlabel('Time [sec]')
-    plt.show()
     if save == True:
         filename = fname if fname != '' else f'stft_graph_{time()}'
         plt.savefig(f'{filename}')
+    if show == True:
+        plt.show()
+
+
+@instrument.instrumented()
+def streaming_spectrogram(source, nperseg=2048, hop=None, nfft=fft_sz, width=1024, height=512, sample_rate=sample_rate, fmax=None, window='hann', chunk_frames=256):
+    '''
+    Compute a spectrogram downsampled to a fixed-size pixel grid, processing the signal in chunks so that memory use
+    does not depend on the signal length. Each pixel holds the largest STFT magnitude among the frames and frequency
+    bins that fall into it, so short events and narrow tones remain visible.
+    :source: numpy array or wav_util.MappedWave, (frames,) or (frames, channels); channels are averaged
+    :nperseg: (int) STFT segment length
+    :hop: (int) frames between segments, default nperseg // 2
+    :nfft: (int) FFT size, at least nperseg
+    :width: / :height: (int) size of the pixel grid (time x frequency); width is limited to the number of STFT frames
+    :sample_rate: (int) sampling rate in Hz
+    :fmax: (float) highest frequency shown, default the Nyquist frequency
+    :window: window name, see scipy.signal.get_window. The window is computed once and cached.
+    :chunk_frames: (int) number of STFT frames computed per chunk
+    Returns a (height, width) float32 array of magnitudes, lowest frequency in row 0.
+    '''
+    hop = nperseg // 2 if hop is None else hop
+    nframes = len(source)
+    assert nframes >= nperseg, f'signal is shorter than one segment: {nframes} < {nperseg}'
+    total = 1 + (nframes - nperseg) // hop
+    width = min(width, total)
+    fmax = sample_rate / 2 if fmax is None else fmax
+    nbins = min(nfft // 2 + 1, int(np.floor(fmax * nfft / sample_rate)) + 1)
+    height = min(height, nbins)
+    win = fb.get_window(window, nperseg)
+    instrument.note('fft_size', nfft)
+    # first frequency bin of every pixel row, and first STFT frame of every pixel column
+    row_starts = (np.arange(height) * nbins) // height
+    col_of_frame = (np.arange(total) * width) // total
+
+    grid = np.zeros((width, height), dtype=np.float32)
+    frame = 0
+    blocksize = (chunk_frames - 1) * hop + nperseg
+    for block in iter_blocks(source, blocksize, overlap=nperseg - hop):
+        block = np.asarray(block, dtype=np.float32)
+        if block.ndim == 2:
+            block = block.mean(axis=1)
+        count = min(chunk_frames, total - frame, 1 + (len(block) - nperseg) // hop if len(block) >= nperseg else 0)
+        if count <= 0:
+            break
+        segments = np.lib.stride_tricks.sliding_window_view(block, nperseg)[:count * hop:hop]
+        mags = np.abs(fb.rfft(segments * win, nfft, axis=1)[:, :nbins])
+        rows = np.maximum.reduceat(mags, row_starts, axis=1)
+        cols = col_of_frame[frame:frame + count]
+        starts = np.flatnonzero(np.diff(cols, prepend=-1))
+        grid[cols[starts]] = np.maximum(grid[cols[starts]], np.maximum.reduceat(rows, starts, axis=0))
+        frame += count
+
+    return grid.T
+
+
+@instrument.instrumented()
+def render_spectrogram(grid, fname, duration=None, fmax=None, dynamic_range=100, title='', background=False):
+    '''
+    Render a spectrogram grid (see streaming_spectrogram) to an image file, without a display.
+    The figure is drawn with the Agg backend directly, without pyplot, so it is safe to use from worker threads.
+    :grid: (height, width) array of magnitudes
+    :fname: (string) output file name; the format follows the extension
+    :duration: (float) signal length in seconds, for the time axis
+    :fmax: (float) highest frequency in the grid, for the frequency axis
+    :dynamic_range: (float) dB range below the peak that is shown
+    :title: (string) optional figure title
+    :background: (bool) render in a new thread and return it (already started) instead of waiting
+    Returns fname, or the rendering thread when background is True.
+    '''
+    if background:
+        thread = threading.Thread(target=render_spectrogram, args=(grid, fname, duration, fmax, dynamic_range, title))
+        thread.start()
+        return thread
+
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    peak = np.max(grid)
+    with np.errstate(divide='ignore'):
+        db = 20 * np.log10(grid / peak) if peak > 0 else np.full(grid.shape, -dynamic_range)
+    extent = (0, duration if duration is not None else grid.shape[1], 0, fmax if fmax is not None else grid.shape[0])
+    fig = Figure(figsize=(10, 5))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot()
+    image = ax.imshow(db, origin='lower', aspect='auto', extent=extent, vmin=-dynamic_range, vmax=0, interpolation='nearest')
+    fig.colorbar(image, ax=ax, label='Magnitude [dB]')
+    ax.set_ylabel('Frequency [Hz]' if fmax is not None else 'Frequency [row]')
+    ax.set_xlabel('Time [sec]' if duration is not None else 'Time [column]')
+    if title:
+        ax.set_title(title)
+    fig.savefig(fname)
+
+    return fname
+
+
+def spectrogram_to_file(source, fname, sample_rate=sample_rate, fmax=None, background=False, **kwargs):
+    '''
+    Compute a streaming spectrogram of source and render it to fname, see streaming_spectrogram and render_spectrogram.
+    Remaining keyword arguments are passed to streaming_spectrogram.
+    Returns fname, or the rendering thread when background is True.
+    '''
+    fmax = sample_rate / 2 if fmax is None else fmax
+    grid = streaming_spectrogram(source, sample_rate=sample_rate, fmax=fmax, **kwargs)
 
+    return render_spectrogram(grid, fname, duration=len(source) / sample_rate, fmax=fmax, background=background)
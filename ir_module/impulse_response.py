@@ -1,21 +1,359 @@
+import hashlib, threading
+from collections import OrderedDict
 import numpy as np
-from scipy import signal
+from . import default, fft_backend as fb, gen_sine as gs, instrument, resample as rs
 
 
-def deconvolve_invfilt(output, input, mode='freq'):
+def sweep_key(input):
+    '''
+    Content hash of a sweep, used to recognize repeated use of the same reference signal.
+    Returns a hex digest string.
+    '''
+    input = np.ascontiguousarray(input)
+    digest = hashlib.blake2b(input.view(np.uint8), digest_size=16)
+    digest.update(f'{input.dtype.str}{input.shape}'.encode())
+
+    return digest.hexdigest()
+
+
+@instrument.instrumented()
+def apply_inverse_spectrum(output, inv_spectrum, nfft, conv_len):
+    '''
+    Convolve output with an inverse filter given by its spectrum.
+    :output: (frames,) or (frames, channels) array
+    :inv_spectrum: real FFT of the inverse filter, of length nfft // 2 + 1
+    :nfft: (int) FFT size, at least conv_len
+    :conv_len: (int) number of output samples to keep
+    Returns the (unnormalized) convolution as a numpy array.
+    '''
+    output = np.asarray(output)
+    instrument.note('fft_size', nfft)
+    if output.ndim == 2:
+        inv_spectrum = inv_spectrum[:, np.newaxis]
+
+    return fb.irfft(fb.rfft(output, nfft, axis=0) * inv_spectrum, nfft, axis=0)[:conv_len]
+
+
+class Deconvolver:
+    '''
+    Inverse-filter deconvolution with a least-recently-used cache of inverse-filter spectra.
+    Spectra are keyed by the content hash of the sweep, the FFT size and the sampling rates, so repeated
+    deconvolution of many recordings against the same sweep only transforms (and resamples) the sweep once.
+    '''
+    def __init__(self, maxsize=8):
+        '''
+        :maxsize: (int) number of inverse-filter spectra to keep
+        '''
+        self._maxsize = maxsize
+        self._spectra = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+
+    @instrument.instrumented()
+    def inverse_spectrum(self, input, nfft, sample_rate=None, target_rate=None):
+        '''
+        Returns the real FFT (size nfft) of the time-reversed input signal, from the cache when possible.
+        :input: the sweep, a (frames,) array
+        :nfft: (int) FFT size
+        :sample_rate: (int) sampling rate of the sweep
+        :target_rate: (int) sampling rate of the recordings, when it differs from sample_rate the sweep is resampled
+        to it first (see resample.resample). Ignored unless both rates are given.
+        '''
+        if sample_rate is None or target_rate is None:
+            target_rate = sample_rate
+        key = (sweep_key(input), nfft, sample_rate, target_rate)
+        with self._lock:
+            spectrum = self._spectra.get(key)
+            if spectrum is not None:
+                self._spectra.move_to_end(key)
+                self._hits += 1
+                return spectrum
+            self._misses += 1
+
+        if target_rate != sample_rate:
+            input = rs.resample(input, sample_rate, target_rate)
+        instrument.note('fft_size', nfft)
+        spectrum = fb.rfft(np.array(input[::-1], dtype='f'), nfft)
+        with self._lock:
+            self._spectra[key] = spectrum
+            while len(self._spectra) > self._maxsize:
+                self._spectra.popitem(last=False)
+
+        return spectrum
+
+
+    def deconvolve(self, output, input, sample_rate=None, target_rate=None):
+        '''
+        Convolve output with the inverse filter of input, resampled from sample_rate to target_rate when they differ.
+        Only the forward FFT of output and one inverse FFT are computed when the inverse filter is cached.
+        Returns the (unnormalized) convolution, of length len(output) + len(input) - 1 (after resampling input).
+        '''
+        input_len = len(input)
+        if target_rate is not None and sample_rate is not None and target_rate != sample_rate:
+            input_len = rs.resampled_length(input_len, sample_rate, target_rate)
+        conv_len = len(output) + input_len - 1
+        nfft = fb.next_fast_len(conv_len)
+
+        return apply_inverse_spectrum(output, self.inverse_spectrum(input, nfft, sample_rate, target_rate), nfft, conv_len)
+
+
+    def cache_info(self):
+        '''
+        Returns (hits, misses, current size, maximum size) of the spectrum cache.
+        '''
+        return self._hits, self._misses, len(self._spectra), self._maxsize
+
+
+    def clear(self):
+        '''
+        Empty the spectrum cache.
+        '''
+        with self._lock:
+            self._spectra.clear()
+            self._hits = 0
+            self._misses = 0
+
+
+# shared by deconvolve_invfilt, so consecutive calls with the same sweep reuse its spectrum
+default_deconvolver = Deconvolver()
+
+
+@instrument.instrumented()
+def deconvolve_invfilt(output, input, mode='freq', sample_rate=None, output_rate=None):
     '''
     Deconvolve output signal using inverse filter convolution technique
-    :output: output signal, usually the recorded signal
+    :output: output signal, usually the recorded signal. Either (frames,) or (frames, channels); all channels are
+    deconvolved in one batched FFT pass against a single transform of the input signal.
     :input: input signal, usually the original sine sweep
-    Returns a floating-point numpy array of the impulse response.
+    :sample_rate: (int) sampling rate of input, part of the key of the cached inverse-filter spectrum
+    :output_rate: (int) sampling rate of output, if it differs from sample_rate the input is resampled to it
+    In 'freq' mode the spectrum of the inverse filter is cached by default_deconvolver.
+    Returns a floating-point numpy array of the impulse response, with the same number of channels as output.
     '''
-    # create inverse filter
-    input = np.array(input[::-1], dtype='f')
-    # convolve with output signal
-    m = 'fft' if mode == 'freq' else 'direct'
-    conv = signal.convolve(output, input, mode='full', method=f'{m}')
-    # normalize
-    conv = (conv / conv[np.argmax(conv)])
+    output = np.asarray(output)
+    if mode == 'freq':
+        # convolve with output signal
+        conv = default_deconvolver.deconvolve(output, input, sample_rate, output_rate)
+    else:
+        from scipy import signal
+
+        if output_rate is not None and sample_rate is not None:
+            input = rs.resample(input, sample_rate, output_rate)
+        # create inverse filter
+        input = np.array(input[::-1], dtype='f')
+        if output.ndim == 2:
+            input = input[:, np.newaxis]
+        conv = signal.convolve(output, input, mode='full', method='direct')
+    # normalize, with a single gain for all channels to keep their relative levels
+    with instrument.stage('impulse_response.normalize'):
+        conv = (conv / np.max(conv))
 
     return conv
 
+
+@instrument.instrumented()
+def deconvolve_exp_sweep(output, start, end, duration, sample_rate=default.sample_rate, st_amp=0.75, end_amp=0.75):
+    '''
+    Deconvolve a recording of gen_sine.exp_sweep with its analytic, amplitude-compensated inverse filter (Farina 2000).
+    The inverse-filter spectrum is generated from the sweep parameters and cached, so no sweep file is needed and
+    deconvolution is a single spectral multiply. The result has a flat response over the swept band and needs no
+    further equalization; it is not normalized, so levels are comparable between recordings.
+    The linear impulse response starts at frame len(sweep) - 1, harmonic distortion products precede it.
+    :output: recorded signal, (frames,) or (frames, channels)
+    :start: / :end: / :duration: / :st_amp: / :end_amp: the parameters passed to gen_sine.exp_sweep
+    :sample_rate: (int) sampling rate in Hz
+    Returns a floating-point numpy array of the impulse response.
+    '''
+    sweep_len = int(sample_rate * duration)
+    conv_len = len(output) + sweep_len - 1
+    nfft = fb.next_fast_len(conv_len)
+    instrument.note('fft_size', nfft)
+    spectrum = gs.exp_sweep_inverse_spectrum(start, end, duration, nfft, sample_rate, st_amp, end_amp)
+
+    return apply_inverse_spectrum(output, spectrum, nfft, conv_len)
+
+
+def _energy(ir):
+    # squared samples, summed over channels
+    ir = np.asarray(ir, dtype=np.float64)
+    return (ir ** 2).reshape(len(ir), -1).sum(axis=1)
+
+
+@instrument.instrumented()
+def find_onset(ir, threshold_db=-20, search_start=0):
+    '''
+    Find the direct-sound onset of an impulse response: the first frame whose energy comes within threshold_db of the
+    peak energy (ISO 3382-1 uses -20 dB).
+    :ir: impulse response, (frames,) or (frames, channels); the channels are summed
+    :threshold_db: (float) onset threshold relative to the peak, in dB
+    :search_start: (int) first frame considered, e.g. to skip harmonic distortion products
+    Returns the frame index of the onset.
+    '''
+    energy = _energy(ir)[search_start:]
+    above = np.flatnonzero(energy >= np.max(energy) * 10 ** (threshold_db / 10))
+
+    return search_start + int(above[0])
+
+
+def _smoothed_db(energy, interval, reference):
+    blocks = max(1, len(energy) // interval)
+    env = energy[:blocks * interval].reshape(blocks, interval).mean(axis=1)
+    centres = (np.arange(blocks) + 0.5) * interval
+    return centres, 10 * np.log10(np.maximum(env, 1e-30) / reference)
+
+
+def _fit_decay(centres, env_db, top_db, bottom_db):
+    # least-squares line through the part of the envelope between top_db and bottom_db, after the envelope peak
+    first = int(np.argmax(env_db))
+    below = np.flatnonzero(env_db[first:] < bottom_db)
+    last = first + (below[0] if len(below) else len(env_db) - first)
+    region = np.arange(first, last)
+    region = region[env_db[region] <= top_db]
+    if len(region) < 2:
+        return None, None
+    slope, intercept = np.polyfit(centres[region], env_db[region], 1)
+    return slope, intercept
+
+
+# A. Lundeby, T. E. Vigran, H. Bietz, M. Vorlaender, "Uncertainties of Measurements in Room Acoustics", Acustica 81, 1995
+@instrument.instrumented()
+def lundeby(ir, sample_rate, interval=0.01, max_iter=5):
+    '''
+    Estimate the noise floor of an impulse response and the point where its decay meets it, with the iterative
+    method of Lundeby et al.: the energy envelope is smoothed in short intervals, a line is fitted to the decay above
+    the noise, and the interval length, noise estimate and fit are refined until the crosspoint settles.
+    :ir: impulse response starting at (or shortly before) its onset, (frames,) or (frames, channels)
+    :sample_rate: (int) sampling rate in Hz
+    :interval: (float) initial smoothing interval in seconds
+    :max_iter: (int) maximum number of refinements
+    Returns the crosspoint frame, the noise floor in dB relative to the peak energy, and the decay rate in dB per second.
+    If no decay is found, the crosspoint is the end of ir.
+    '''
+    energy = _energy(ir)
+    nframes = len(energy)
+    reference = np.max(energy)
+    if reference == 0:
+        return nframes, -np.inf, 0.0
+    step = max(1, int(interval * sample_rate))
+    centres, env_db = _smoothed_db(energy, step, reference)
+    # initial noise estimate: the median envelope level over the second half, rather than the mean of the last 10%,
+    # which is more robust to noise that is not stationary over long deconvolutions
+    noise_db = np.median(env_db[len(env_db) // 2:])
+    slope, intercept = _fit_decay(centres, env_db, 0, noise_db + 10)
+    if slope is None or slope >= 0:
+        return nframes, noise_db, 0.0
+    crosspoint = int(min(nframes, max(0, (noise_db - intercept) / slope)))
+
+    for _ in range(max_iter):
+        # about 5 intervals per 10 dB of decay
+        step = max(1, int(-10 / slope / 5))
+        centres, env_db = _smoothed_db(energy, step, reference)
+        # noise estimated from 5-10 dB of decay past the crosspoint, but from at least the last 10% of the response
+        noise_start = min(int(crosspoint - 7.5 / slope), int(0.9 * nframes))
+        noise_db = 10 * np.log10(max(np.mean(energy[noise_start:]), 1e-30) / reference)
+        # fit a dynamic range of 20 dB, starting 5 dB above the noise
+        new_slope, new_intercept = _fit_decay(centres, env_db, noise_db + 25, noise_db + 5)
+        if new_slope is None or new_slope >= 0:
+            break
+        slope, intercept = new_slope, new_intercept
+        new_crosspoint = int(min(nframes, max(0, (noise_db - intercept) / slope)))
+        if abs(new_crosspoint - crosspoint) < step:
+            crosspoint = new_crosspoint
+            break
+        crosspoint = new_crosspoint
+
+    return crosspoint, noise_db, slope * sample_rate
+
+
+def harmonic_delays(start, end, duration, orders=(2, 3, 4, 5)):
+    '''
+    Time advance of the harmonic distortion impulse responses of an exponential sweep, relative to the linear
+    impulse response (Farina 2000): the k-th harmonic appears duration * ln(k) / ln(end / start) seconds earlier.
+    Returns a numpy array of delays in seconds, one per order.
+    '''
+    return duration * np.log(np.asarray(orders, dtype=np.float64)) / np.log(end / start)
+
+
+@instrument.instrumented()
+def separate_harmonics(ir, sample_rate, onset, start, end, duration, orders=(2, 3, 4, 5), pre_onset=0.002):
+    '''
+    Cut the harmonic distortion impulse responses out of the deconvolution of an exponential sweep recording.
+    Each window starts pre_onset seconds before the expected arrival of its harmonic and ends where the next
+    lower-order harmonic (or the linear response) begins.
+    :ir: the deconvolved recording, as returned by deconvolve_invfilt or deconvolve_exp_sweep
+    :sample_rate: (int) sampling rate in Hz
+    :onset: (int) frame of the linear impulse response onset, see find_onset
+    :start: / :end: / :duration: the sweep parameters
+    Returns a dict mapping each order to its impulse response (empty if it falls before the start of ir).
+    '''
+    delays = np.round(harmonic_delays(start, end, duration, orders) * sample_rate).astype(int)
+    pre = int(pre_onset * sample_rate)
+    bounds = np.concatenate(([0], delays))
+    harmonics = {}
+    for i, order in enumerate(orders):
+        first = max(0, onset - delays[i] - pre)
+        last = max(0, onset - bounds[i] - pre)
+        harmonics[order] = ir[first:last]
+
+    return harmonics
+
+
+def _fade(length, rising):
+    # half of a Hann window
+    ramp = 0.5 - 0.5 * np.cos(np.pi * (np.arange(length) + 0.5) / length)
+    return ramp if rising else ramp[::-1]
+
+
+@instrument.instrumented()
+def extract_ir(ir, sample_rate, pre_onset=0.002, fade_out=0.05, max_seconds=None, sweep=None, threshold_db=-20):
+    '''
+    Extract the useful part of a deconvolved recording: the linear impulse response from just before its direct sound
+    onset until its decay reaches the noise floor (see lundeby), with short fades at both ends.
+    The result is typically much shorter than the deconvolution, so convolving with it is much cheaper.
+    :ir: the deconvolved recording, (frames,) or (frames, channels)
+    :sample_rate: (int) sampling rate in Hz
+    :pre_onset: (float) seconds kept (and faded in) before the onset
+    :fade_out: (float) length in seconds of the fade-out at the end, at most 10% of the result
+    :max_seconds: (float) optional upper bound on the length of the result
+    :sweep: optional (start, end, duration) of an exponential sweep; the onset search then starts after the second
+    harmonic, so distortion products are not taken for the direct sound, and the noise floor is estimated only over
+    the part of the deconvolution that is covered by the recording
+    :threshold_db: (float) onset threshold, see find_onset
+    Returns the trimmed impulse response, and a dict with 'onset' and 'end' (frames in ir), 'noise_floor_db' and
+    'decay_rate' (dB/s), plus 'harmonics' (see separate_harmonics) when sweep is given.
+    '''
+    ir = np.asarray(ir)
+    peak = int(np.argmax(_energy(ir)))
+    search_start = 0
+    valid_end = len(ir)
+    if sweep is not None:
+        gap = harmonic_delays(*sweep, orders=(2,))[0] - pre_onset
+        search_start = max(0, peak - int(gap * sample_rate))
+        # past the end of the recording, fewer and fewer recorded samples contribute to the deconvolution.
+        # a recording that stops before the end of the sweep has no such region, and is analyzed to its end.
+        valid_end = len(ir) - int(round(sweep[2] * sample_rate)) + 1
+        valid_end = valid_end if valid_end > peak else len(ir)
+    onset = find_onset(ir[:peak + 1], threshold_db, search_start)
+    first = max(0, onset - int(pre_onset * sample_rate))
+
+    crosspoint, noise_db, decay = lundeby(ir[onset:valid_end], sample_rate)
+    last = onset + max(crosspoint, 1)
+    if max_seconds is not None:
+        last = min(last, first + int(max_seconds * sample_rate))
+    trimmed = np.array(ir[first:last], dtype=ir.dtype)
+
+    fade_in = onset - first
+    fade_len = min(int(fade_out * sample_rate), len(trimmed) // 10)
+    shape = (slice(None),) + (np.newaxis,) * (trimmed.ndim - 1)
+    if fade_in > 0:
+        trimmed[:fade_in] *= _fade(fade_in, True)[shape]
+    if fade_len > 0:
+        trimmed[-fade_len:] *= _fade(fade_len, False)[shape]
+
+    info = {'onset': onset, 'end': last, 'noise_floor_db': noise_db, 'decay_rate': decay}
+    if sweep is not None:
+        info['harmonics'] = separate_harmonics(ir, sample_rate, onset, *sweep, pre_onset=pre_onset)
+
+    return trimmed, info
@@ -0,0 +1,273 @@
+import functools, json, os, threading, time, tracemalloc
+from contextlib import contextmanager, nullcontext
+
+'''
+timing and allocation tracking for pipeline stages
+'''
+# one record per step of track_allocations, in the order the steps started
+allocation_log = []
+# one event per stage, in the order the stages started, while instrumentation is enabled
+events = []
+
+_enabled = False
+_track_memory = False
+_epoch = time.perf_counter()
+# memory frames of the open steps and stages; tracemalloc is process-wide, so only the main thread uses them
+_memory_stack = []
+# open stages, per thread
+_local = threading.local()
+_null = nullcontext()
+
+
+def _memory_enter():
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    if _memory_stack:
+        # the parent's peak so far is lost when the peak is reset below
+        _memory_stack[-1]['peak'] = max(_memory_stack[-1]['peak'], tracemalloc.get_traced_memory()[1])
+    tracemalloc.reset_peak()
+    frame = {'start': tracemalloc.get_traced_memory()[0], 'peak': 0, 'started': started}
+    _memory_stack.append(frame)
+    return frame
+
+
+def _memory_exit(frame):
+    current, peak = tracemalloc.get_traced_memory()
+    _memory_stack.pop()
+    peak = max(frame['peak'], peak)
+    if _memory_stack:
+        _memory_stack[-1]['peak'] = max(_memory_stack[-1]['peak'], peak)
+    if frame['started']:
+        tracemalloc.stop()
+    return current - frame['start'], peak - frame['start']
+
+
+@contextmanager
+def track_allocations(step):
+    '''
+    Record the memory allocated while the enclosed code runs, e.g.
+        with instrument.track_allocations('deconvolve'):
+            rir = recording.deconvolve(sweep)
+    tracemalloc is started if it is not already tracing, and stopped again after the outermost step.
+    Steps can be nested; the peak of a step includes the peaks of the steps inside it.
+    Appends a dict to allocation_log with the step name, its nesting depth, 'net' bytes still allocated at the end
+    of the step, and 'peak' bytes allocated at the same time during the step, both relative to its start
+    (None until the step ends).
+    '''
+    record = {'step': step, 'depth': len(_memory_stack), 'net': None, 'peak': None}
+    allocation_log.append(record)
+    frame = _memory_enter()
+    try:
+        yield
+    finally:
+        record['net'], record['peak'] = _memory_exit(frame)
+
+
+def enable(memory=True):
+    '''
+    Start recording an event for every stage (see stage and instrumented) into events.
+    :memory: (bool) also record the bytes allocated per stage, with tracemalloc. This slows down code that creates
+    many Python objects; wall and CPU times are more accurate without it.
+    '''
+    global _enabled, _track_memory
+    _enabled = True
+    _track_memory = memory
+
+
+def disable():
+    '''
+    Stop recording events. Recorded events are kept until clear().
+    '''
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    '''
+    Returns True while events are recorded.
+    '''
+    return _enabled
+
+
+class _Stage:
+    __slots__ = ('_name', '_args', '_event', '_memory', '_wall', '_cpu')
+
+    def __init__(self, name, args):
+        self._name = name
+        self._args = args
+
+
+    def __enter__(self):
+        stack = getattr(_local, 'stack', None)
+        if stack is None:
+            stack = _local.stack = []
+        self._event = {'name': self._name, 'depth': len(stack), 'thread': threading.get_ident(), 'start': None,
+                       'wall': None, 'cpu': None, 'net': None, 'peak': None, 'args': dict(self._args)}
+        stack.append(self._event)
+        events.append(self._event)
+        self._memory = _memory_enter() if _track_memory and threading.current_thread() is threading.main_thread() else None
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        self._event['start'] = self._wall - _epoch
+        return self
+
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        event = self._event
+        event['wall'], event['cpu'] = wall, cpu
+        if self._memory is not None:
+            event['net'], event['peak'] = _memory_exit(self._memory)
+        _local.stack.pop()
+
+
+def stage(name, **args):
+    '''
+    Context manager timing the enclosed code as a stage, e.g.
+        with instrument.stage('average', takes=len(files)):
+            ...
+    While instrumentation is enabled, appends an event to events with the stage name, its nesting depth, thread,
+    start time and wall-clock duration (seconds), CPU time of the process (seconds, including the threads it starts),
+    'net' and 'peak' bytes allocated (see track_allocations; None when memory is not tracked, or outside the main
+    thread) and args: the keyword arguments, plus the values recorded with note() while the stage is open.
+    When instrumentation is disabled, returns a shared no-op context manager.
+    '''
+    if not _enabled:
+        return _null
+    return _Stage(name, args)
+
+
+def note(key, value):
+    '''
+    Attach a value to the innermost open stage, appended to the list args[key], e.g. note('fft_size', nfft).
+    Does nothing when instrumentation is disabled or no stage is open.
+    '''
+    if not _enabled:
+        return
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        stack[-1]['args'].setdefault(key, []).append(value)
+
+
+def instrumented(name=None):
+    '''
+    Decorator recording every call of a function or method as a stage (see stage).
+    When instrumentation is disabled, the only cost is a check of a global flag.
+    :name: stage name, default '<class>.<method>' for methods and '<module>.<function>' for functions
+    '''
+    def decorate(func):
+        label = name
+        if label is None:
+            label = func.__qualname__ if '.' in func.__qualname__ else f'{func.__module__.rsplit(".", 1)[-1]}.{func.__qualname__}'
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Stage(label, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+def clear():
+    '''
+    Empty allocation_log and events.
+    '''
+    allocation_log.clear()
+    events.clear()
+
+
+def format_report(log=None):
+    '''
+    Format allocation records as a table, one line per step, indented by nesting depth.
+    :log: list of records from track_allocations, default: allocation_log
+    Returns a string.
+    '''
+    log = allocation_log if log is None else log
+    lines = [f'{"step":<32}{"net MiB":>12}{"peak MiB":>12}']
+    for record in log:
+        if record['net'] is None:
+            continue
+        name = '  ' * record['depth'] + record['step']
+        lines.append(f'{name:<32}{record["net"] / 2**20:>12.2f}{record["peak"] / 2**20:>12.2f}')
+
+    return '\n'.join(lines)
+
+
+def summary(log=None):
+    '''
+    Aggregate completed events per stage name.
+    :log: list of events, default: events
+    Returns a dict of stage name -> {'calls', 'wall', 'cpu' (total seconds), 'peak' (largest, bytes or None)}.
+    '''
+    log = events if log is None else log
+    totals = {}
+    for event in log:
+        if event['wall'] is None:
+            continue
+        total = totals.setdefault(event['name'], {'calls': 0, 'wall': 0.0, 'cpu': 0.0, 'peak': None})
+        total['calls'] += 1
+        total['wall'] += event['wall']
+        total['cpu'] += event['cpu']
+        if event['peak'] is not None:
+            total['peak'] = max(total['peak'] or 0, event['peak'])
+
+    return totals
+
+
+def format_summary(log=None):
+    '''
+    Format summary() as a table, slowest stages first.
+    Returns a string.
+    '''
+    lines = [f'{"stage":<40}{"calls":>7}{"wall s":>10}{"cpu s":>10}{"peak MiB":>10}']
+    for name, total in sorted(summary(log).items(), key=lambda item: -item[1]['wall']):
+        peak = '' if total['peak'] is None else f'{total["peak"] / 2**20:.2f}'
+        lines.append(f'{name:<40}{total["calls"]:>7}{total["wall"]:>10.4f}{total["cpu"]:>10.4f}{peak:>10}')
+
+    return '\n'.join(lines)
+
+
+def export_json(path=None, log=None):
+    '''
+    Export completed events as a list of dicts, optionally written to a JSON file.
+    Returns the list.
+    '''
+    log = events if log is None else log
+    data = [dict(event) for event in log if event['wall'] is not None]
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1, default=str)
+
+    return data
+
+
+def export_chrome_trace(path=None, log=None):
+    '''
+    Export completed events in the Chrome trace event format, for chrome://tracing or https://ui.perfetto.dev,
+    optionally written to a JSON file. Each stage is a complete ('X') event, with its CPU time, allocations and
+    args attached.
+    Returns the trace as a dict.
+    '''
+    log = events if log is None else log
+    pid = os.getpid()
+    trace = []
+    for event in log:
+        if event['wall'] is None:
+            continue
+        args = dict(event['args'], cpu_ms=event['cpu'] * 1e3)
+        if event['peak'] is not None:
+            args.update(net_bytes=event['net'], peak_bytes=event['peak'])
+        trace.append({'name': event['name'], 'cat': 'ir_module', 'ph': 'X', 'ts': event['start'] * 1e6,
+                      'dur': event['wall'] * 1e6, 'pid': pid, 'tid': event['thread'], 'args': args})
+    trace = {'traceEvents': trace, 'displayTimeUnit': 'ms'}
+    if path is not None:
+        with open(path, 'w') as f:
+            json.dump(trace, f, default=str)
+
+    return trace
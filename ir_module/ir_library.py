@@ -0,0 +1,194 @@
+import os, json, uuid
+import numpy as np
+from . import acoustics, convolve, default, instrument, wav_util
+from .Signal import Signal
+
+'''
+indexed library of impulse responses, stored as memory-mapped arrays with precomputed partition spectra
+'''
+index_name = 'index.json'
+
+
+def _save_array(path, array):
+    # written to a temporary file first, so a reader never sees a partial array
+    temp = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp, 'wb') as f:
+        np.save(f, np.asarray(array))
+    os.replace(temp, path)
+
+
+class IRLibrary:
+    '''
+    A directory of impulse responses with a metadata index:
+        index.json                       name -> sample rate, length, channels, room, position, acoustic metrics, ...
+        <name>.npy                       float32 samples, (frames,) or (frames, channels)
+        <name>.spectra.<block_size>.npy  partition spectra for convolve.PartitionedConvolver at that block size
+    Samples and spectra are opened memory-mapped, so looking up an impulse response reads only the index and
+    the pages that are used, with no WAVE decoding, normalization or FFT.
+    '''
+    def __init__(self, directory, block_sizes=default.library_block_sizes):
+        '''
+        :directory: (string) library directory, created if it does not exist
+        :block_sizes: block sizes whose partition spectra are precomputed when an impulse response is added
+        '''
+        self._directory = directory
+        self._block_sizes = tuple(block_sizes)
+        self._arrays = {}
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, index_name)
+        if os.path.exists(path):
+            with open(path) as f:
+                self._index = json.load(f)
+        else:
+            self._index = {}
+
+
+    def _write_index(self):
+        path = os.path.join(self._directory, index_name)
+        temp = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(temp, 'w') as f:
+            json.dump(self._index, f, indent=1, sort_keys=True)
+        os.replace(temp, path)
+
+
+    def _path(self, name, block_size=None):
+        suffix = '.npy' if block_size is None else f'.spectra.{block_size}.npy'
+        return os.path.join(self._directory, name + suffix)
+
+
+    def _open(self, path):
+        array = self._arrays.get(path)
+        if array is None:
+            array = self._arrays[path] = np.load(path, mmap_mode='r')
+        return array
+
+
+    @instrument.instrumented()
+    def add(self, name, samples, sample_rate, room=None, position=None, metrics=True, **metadata):
+        '''
+        Add an impulse response, or replace the one of the same name.
+        :name: (string) unique name, also used for the file names
+        :samples: (frames,) or (frames, channels) array; scaled down to a peak of 1 if it exceeds it
+        :sample_rate: (int) sampling rate in Hz
+        :room: / :position: optional descriptions, see find
+        :metrics: (bool) compute the acoustic parameters of every channel with acoustics.analyze
+        Remaining keyword arguments are stored in the index as they are, and must be JSON-serializable.
+        Returns the index entry.
+        '''
+        assert name and os.sep not in name and not name.startswith('.'), f'invalid impulse response name: {name!r}'
+        samples = np.asarray(samples, dtype=np.float32)
+        peak = float(np.max(np.abs(samples)))
+        if peak > 1:
+            samples = samples / peak
+        self.remove(name)
+        _save_array(self._path(name), samples)
+        for block_size in self._block_sizes:
+            _save_array(self._path(name, block_size), convolve.partition_spectra(samples, block_size))
+
+        entry = dict(metadata, sample_rate=sample_rate, frames=len(samples), channels=samples.shape[1] if samples.ndim == 2 else 1,
+                     room=room, position=position, block_sizes=list(self._block_sizes))
+        if metrics:
+            channels = samples.T if samples.ndim == 2 else samples[np.newaxis]
+            results = acoustics.analyze(list(channels), sample_rate)
+            entry['metrics'] = {key: np.asarray(value).tolist() for key, value in results.items()}
+        self._index[name] = entry
+        self._write_index()
+
+        return entry
+
+
+    def add_wav(self, wavfile, name=None, **metadata):
+        '''
+        Add the impulse response of a WAVE file, see add.
+        :name: (string) default: the file name without its extension
+        Returns the index entry.
+        '''
+        params, samples = wav_util.read_wave_nbit(wavfile)
+        name = os.path.splitext(os.path.basename(wavfile))[0] if name is None else name
+
+        return self.add(name, samples, params.framerate, source=os.path.abspath(wavfile), **metadata)
+
+
+    def remove(self, name):
+        '''
+        Remove an impulse response and its spectra, if present.
+        '''
+        entry = self._index.pop(name, None)
+        if entry is None:
+            return
+        for block_size in [None] + entry['block_sizes']:
+            path = self._path(name, block_size)
+            self._arrays.pop(path, None)
+            if os.path.exists(path):
+                os.remove(path)
+        self._write_index()
+
+
+    def names(self):
+        '''
+        Returns the sorted names of the impulse responses.
+        '''
+        return sorted(self._index)
+
+
+    def info(self, name):
+        '''
+        Returns the index entry of an impulse response: sample_rate, frames, channels, room, position, block_sizes,
+        metrics (see acoustics.analyze, one row per channel) and any other metadata it was added with.
+        '''
+        return self._index[name]
+
+
+    def find(self, **criteria):
+        '''
+        Find impulse responses by metadata, e.g. find(room='garage', sample_rate=48000).
+        Returns the sorted names of the impulse responses whose entries equal every given value.
+        '''
+        return sorted(name for name, entry in self._index.items() if all(entry.get(key) == value for key, value in criteria.items()))
+
+
+    def load(self, name):
+        '''
+        Returns the samples of an impulse response, memory-mapped read-only.
+        '''
+        assert name in self._index, f'no impulse response named {name!r}'
+        return self._open(self._path(name))
+
+
+    def signal(self, name, dtype=default.dtype):
+        '''
+        Returns a Signal of an impulse response. With the default float32 dtype, its samples are the memory-mapped array.
+        '''
+        entry = self.info(name)
+        return Signal(self.load(name), entry['sample_rate'], entry['channels'], dtype=dtype)
+
+
+    def spectra(self, name, block_size=default.block_size):
+        '''
+        Returns the partition spectra of an impulse response at block_size, memory-mapped read-only.
+        Spectra of a block size that was not precomputed are computed and stored on first use.
+        '''
+        entry = self.info(name)
+        path = self._path(name, block_size)
+        if block_size not in entry['block_sizes']:
+            _save_array(path, convolve.partition_spectra(self.load(name), block_size))
+            entry['block_sizes'].append(block_size)
+            self._write_index()
+
+        return self._open(path)
+
+
+    def convolver(self, name, block_size=default.block_size):
+        '''
+        Returns a new convolve.PartitionedConvolver of an impulse response at block_size, built from its stored
+        spectra. Pass it to Signal.convolve, convolve.convolve_audio or convolve.convolve_blocks.
+        '''
+        return convolve.PartitionedConvolver(None, spectra=self.spectra(name, block_size))
+
+
+    def __contains__(self, name):
+        return name in self._index
+
+
+    def __len__(self):
+        return len(self._index)
@@ -0,0 +1,309 @@
+import asyncio, os, time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from . import avg_signal as avg, default, fft_backend as fb, impulse_response as ir, instrument, wav_util
+
+'''
+play-and-record measurement of room impulse responses, driven by asyncio
+'''
+
+
+class DuplexDevice(ABC):
+    '''
+    A full-duplex audio device that plays a signal and records its input over the same sample clock, so frame i of
+    the recording is captured while frame i of the signal is played (plus the device's constant round-trip latency).
+    Subclasses implement play_record, and cannot be instantiated without it.
+    '''
+    def __init__(self, sample_rate=default.sample_rate, channels=default.channels):
+        '''
+        :sample_rate: (int) sampling rate in Hz
+        :channels: (int) number of recorded channels
+        '''
+        self._sample_rate = sample_rate
+        self._channels = channels
+
+
+    def get_sample_rate(self):
+        '''
+        Returns the sampling rate in Hz.
+        '''
+        return self._sample_rate
+
+
+    def get_channels(self):
+        '''
+        Returns the number of recorded channels.
+        '''
+        return self._channels
+
+
+    @abstractmethod
+    async def play_record(self, samples, tail_frames):
+        '''
+        Play samples and record the input at the same time, continuing to record for tail_frames after the end of
+        samples so the decay of the room is captured.
+        :samples: (frames,) float array between -1 and 1
+        :tail_frames: (int) frames recorded after the end of samples
+        Returns the recording, a float32 array of len(samples) + tail_frames frames, (frames,) or (frames, channels).
+        '''
+
+
+    def close(self):
+        '''
+        Release the device.
+        '''
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class PyAudioDevice(DuplexDevice):
+    '''
+    Duplex device on a PyAudio (PortAudio) stream. Output and input are exchanged in one stream callback, as 32-bit
+    floating-point frames, so playback and capture stay sample-aligned.
+    '''
+    def __init__(self, sample_rate=default.sample_rate, channels=default.channels, output_channel=None, block_size=1024, input_device=None, output_device=None):
+        '''
+        :output_channel: (int) index of the output channel that plays the signal, default: all channels
+        :block_size: (int) frames per stream callback
+        :input_device: / :output_device: optional PyAudio device indices
+        PyAudio opens duplex streams with one channel count, so the output has as many channels as the input.
+        '''
+        import pyaudio
+
+        super().__init__(sample_rate, channels)
+        self._pyaudio = pyaudio
+        self._py_audio = pyaudio.PyAudio()
+        self._output_channel = output_channel
+        self._block_size = block_size
+        self._input_device = input_device
+        self._output_device = output_device
+
+
+    async def play_record(self, samples, tail_frames):
+        pyaudio = self._pyaudio
+        channels = self._channels
+        total = len(samples) + tail_frames
+        playback = np.zeros((total, channels), dtype=np.float32)
+        if self._output_channel is None:
+            playback[:len(samples)] = np.asarray(samples, dtype=np.float32)[:, np.newaxis]
+        else:
+            playback[:len(samples), self._output_channel] = samples
+        recording = np.zeros((total, channels), dtype=np.float32)
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        position = 0
+
+        def callback(in_data, frame_count, time_info, status):
+            nonlocal position
+            block = np.frombuffer(in_data, dtype=np.float32).reshape(-1, channels)
+            count = min(frame_count, total - position)
+            recording[position:position + count] = block[:count]
+            out = np.zeros((frame_count, channels), dtype=np.float32)
+            out[:count] = playback[position:position + count]
+            position += count
+            if position < total:
+                return out.tobytes(), pyaudio.paContinue
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+            return out.tobytes(), pyaudio.paComplete
+
+        stream = self._py_audio.open(
+                        rate=self._sample_rate,
+                        channels=channels,
+                        format=pyaudio.paFloat32,
+                        input=True,
+                        output=True,
+                        frames_per_buffer=self._block_size,
+                        input_device_index=self._input_device,
+                        output_device_index=self._output_device,
+                        stream_callback=callback)
+        try:
+            stream.start_stream()
+            await done
+        finally:
+            stream.stop_stream()
+            stream.close()
+
+        return recording[:, 0] if channels == 1 else recording
+
+
+    def close(self):
+        if self._py_audio is not None:
+            self._py_audio.terminate()
+            self._py_audio = None
+
+
+class LoopbackDevice(DuplexDevice):
+    '''
+    In-process duplex device that simulates a room: the played signal is convolved with an impulse response, delayed
+    by a latency that varies randomly between takes, and recorded with added noise. For testing and benchmarking
+    measurement code without audio hardware.
+    '''
+    def __init__(self, sample_rate=default.sample_rate, impulse_response=None, channels=default.channels, latency=256, jitter=64, noise_db=-70, realtime=False, seed=None):
+        '''
+        :impulse_response: (frames,) or (frames, channels) array, default: a simulated room with a 0.5 s decay
+        :latency: (int) round-trip latency in frames
+        :jitter: (int) largest random variation of the latency between takes, in frames
+        :noise_db: (float) level of the white noise added to the recording, in dB relative to full scale
+        :realtime: (bool) take as long as a real device would to play and record
+        :seed: optional seed of the random latency and noise
+        '''
+        if impulse_response is None:
+            impulse_response = simulated_room(sample_rate, channels=channels, seed=seed)
+        impulse_response = np.asarray(impulse_response, dtype=np.float32)
+        super().__init__(sample_rate, impulse_response.shape[1] if impulse_response.ndim == 2 else channels)
+        self._impulse_response = impulse_response
+        self._latency = latency
+        self._jitter = jitter
+        self._noise = 10 ** (noise_db / 20)
+        self._realtime = realtime
+        self._rng = np.random.default_rng(seed)
+
+
+    def get_impulse_response(self):
+        '''
+        Returns the impulse response of the simulated room.
+        '''
+        return self._impulse_response
+
+
+    def _simulate(self, samples, tail_frames, delay, noise):
+        samples = np.asarray(samples, dtype=np.float32)
+        impulse = self._impulse_response
+        wet = fb.fftconvolve(samples[:, np.newaxis] if impulse.ndim == 2 else samples, impulse)
+        recording = noise.astype(np.float32)
+        end = min(len(recording), delay + len(wet))
+        recording[delay:end] += wet[:end - delay]
+        return recording
+
+
+    async def play_record(self, samples, tail_frames):
+        total = len(samples) + tail_frames
+        delay = self._latency + int(self._rng.integers(0, self._jitter + 1))
+        shape = (total, self._channels) if self._channels > 1 else (total,)
+        noise = self._rng.standard_normal(shape) * self._noise
+        loop = asyncio.get_running_loop()
+        # the room is simulated off the event loop, like a device thread filling its buffers
+        recording = loop.run_in_executor(None, self._simulate, samples, tail_frames, delay, noise)
+        if self._realtime:
+            await asyncio.sleep(total / self._sample_rate)
+
+        return await recording
+
+
+def simulated_room(sample_rate=default.sample_rate, rt60=0.5, seconds=None, channels=1, delay=0.003, seed=None):
+    '''
+    Impulse response of a simulated room: a direct-sound impulse followed by exponentially decaying noise with the
+    given reverberation time.
+    :seconds: (float) length, default rt60 (60 dB of decay)
+    Returns a float32 array, (frames,) or (frames, channels), with a peak of 0.9.
+    '''
+    rng = np.random.default_rng(seed)
+    frames = int((rt60 if seconds is None else seconds) * sample_rate)
+    shape = (frames, channels) if channels > 1 else (frames,)
+    # energy falls by 60 dB over rt60 seconds
+    decay = np.exp(-6.9078 * np.arange(frames) / (rt60 * sample_rate))
+    room = rng.standard_normal(shape) * (decay[:, np.newaxis] if channels > 1 else decay) * 0.05
+    room[int(delay * sample_rate)] = 1.0
+
+    return (room * (0.9 / np.max(np.abs(room)))).astype(np.float32)
+
+
+class MeasurementSession:
+    '''
+    Measure an impulse response from repeated takes of a sweep.
+    Each take is played and recorded on the device, and while the next take is recording, the previous one is
+    deconvolved in a worker thread (numpy and scipy release the GIL in their transforms). The inverse filter of the
+    sweep is transformed once, for the first take. After the last take, the deconvolved takes are aligned with
+    sub-sample precision and averaged, so only that step and the trimming remain after the last sweep.
+    '''
+    def __init__(self, device, sweep, takes=4, tail_seconds=1.0, pause_seconds=0.0, record_dir=None, executor=None, sweep_params=None):
+        '''
+        :device: DuplexDevice
+        :sweep: (frames,) array of the sweep to play, at the device's sampling rate, e.g. from gen_sine.exp_sweep
+        :takes: (int) number of repeated takes
+        :tail_seconds: (float) seconds recorded after the end of the sweep
+        :pause_seconds: (float) silence between takes, to let the room decay
+        :record_dir: (string) optional directory to also write every recording to, as take_<n>.wav (float32)
+        :executor: optional concurrent.futures executor for the processing, default a single worker thread
+        :sweep_params: optional (start, end, duration) of an exponential sweep, passed to extract_ir to cut out the
+        harmonic-distortion responses
+        '''
+        self._device = device
+        self._sweep = np.asarray(sweep, dtype=np.float32)
+        self._takes = takes
+        self._tail = int(tail_seconds * device.get_sample_rate())
+        self._pause = pause_seconds
+        self._record_dir = record_dir
+        self._executor = executor
+        self._sweep_params = sweep_params
+        self._deconvolver = ir.Deconvolver(maxsize=1)
+
+
+    @instrument.instrumented()
+    def _process_take(self, index, recording):
+        if self._record_dir is not None:
+            channels = recording.shape[1] if recording.ndim == 2 else 1
+            with wav_util.WaveWriter(f'{self._record_dir}/take_{index}.wav', self._device.get_sample_rate(), channels, 4, 'FLOAT') as writer:
+                writer.write(recording)
+        return self._deconvolver.deconvolve(recording, self._sweep, self._device.get_sample_rate())
+
+
+    async def run(self, extract=True):
+        '''
+        Run all takes and process them.
+        :extract: (bool) also trim the averaged impulse response with impulse_response.extract_ir
+        Returns a dict with the averaged, peak-normalized deconvolution 'ir', the trimmed 'trimmed' impulse response
+        and its extraction 'info' (with extract), the number of 'takes', and 'timings': seconds spent recording each
+        take, and 'after_last_take', the time from the end of the last recording to the result.
+        '''
+        if self._record_dir is not None:
+            os.makedirs(self._record_dir, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        executor = self._executor or ThreadPoolExecutor(max_workers=1)
+        pending = []
+        record_times = []
+        try:
+            for index in range(self._takes):
+                if index > 0 and self._pause > 0:
+                    await asyncio.sleep(self._pause)
+                start = time.perf_counter()
+                recording = await self._device.play_record(self._sweep, self._tail)
+                record_times.append(time.perf_counter() - start)
+                pending.append(loop.run_in_executor(executor, self._process_take, index, recording))
+            last_take = time.perf_counter()
+            deconvolved = await asyncio.gather(*pending)
+            result = await loop.run_in_executor(executor, self._finish, deconvolved, extract)
+        finally:
+            if self._executor is None:
+                executor.shutdown(wait=False)
+        result['takes'] = self._takes
+        result['timings'] = {'record': record_times, 'after_last_take': time.perf_counter() - last_take}
+
+        return result
+
+
+    @instrument.instrumented()
+    def _finish(self, deconvolved, extract):
+        averaged = avg.align_and_average(np.stack(deconvolved)) if len(deconvolved) > 1 else deconvolved[0]
+        averaged = averaged / np.max(np.abs(averaged)) * 0.95
+        result = {'ir': averaged}
+        if extract:
+            result['trimmed'], result['info'] = ir.extract_ir(averaged, self._device.get_sample_rate(), sweep=self._sweep_params)
+
+        return result
+
+
+def measure(device, sweep, takes=4, tail_seconds=1.0, **kwargs):
+    '''
+    Run a MeasurementSession to completion, for use outside of asyncio code.
+    Remaining keyword arguments are passed to MeasurementSession.
+    Returns the result of MeasurementSession.run.
+    '''
+    return asyncio.run(MeasurementSession(device, sweep, takes=takes, tail_seconds=tail_seconds, **kwargs).run())
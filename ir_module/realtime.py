@@ -0,0 +1,169 @@
+import numpy as np
+from . import default
+from .convolve import PartitionedConvolver
+
+
+# Non-uniformly partitioned convolution, after W. G. Gardner, "Efficient Convolution without Input-Output Delay",
+# JAES 43(3), 1995, using uniformly-partitioned overlap-save segments for each partition size.
+class StreamingConvolver:
+    '''
+    Low-latency block convolution for live audio.
+    The head of the impulse response is convolved with small partitions of block_size frames, and later parts of the
+    impulse response with partitions that double in size (up to max_partition), so long impulse responses need far
+    fewer multiply-accumulates per block than a uniform partitioning at block_size would.
+    A segment with partition size L starts at an offset of at least L frames into the impulse response, so its
+    output is always computed before it is due, and the overall latency is one block. Most of a segment's
+    multiply-accumulate is done in the blocks while its next partition of input fills up (see
+    PartitionedConvolver.prepare), so the time per block stays close to its average.
+    '''
+    def __init__(self, impulse, block_size=256, max_partition=default.block_size, partitions_per_segment=4):
+        '''
+        :impulse: impulse response, (frames,) or (frames, channels)
+        :block_size: (int) frames per input/output block, e.g. 64-512
+        :max_partition: (int) largest partition size, a power-of-two multiple of block_size
+        :partitions_per_segment: (int) number of partitions of each size before doubling, at least 2
+        '''
+        assert partitions_per_segment >= 2, 'partitions_per_segment must be at least 2'
+        assert max_partition >= block_size and (max_partition // block_size) & (max_partition // block_size - 1) == 0, f'max_partition must be a power-of-two multiple of block_size: {max_partition}'
+        impulse = np.asarray(impulse)
+        self._block_size = block_size
+        self._segments = []
+        offset, size = 0, block_size
+        while offset < len(impulse) or not self._segments:
+            length = min(partitions_per_segment * size, len(impulse) - offset) if size < max_partition else len(impulse) - offset
+            length = max(length, 1)
+            self._segments.append((size, offset, PartitionedConvolver(impulse[offset:offset + length], size)))
+            offset += length
+            if size < max_partition and offset >= 2 * size:
+                size *= 2
+        # contributions of the larger segments land up to offset + size frames ahead of the current block
+        reach = max(offset + size for size, offset, _ in self._segments) + block_size
+        self._ring_size = 1 << int(np.ceil(np.log2(reach)))
+        self.reset()
+
+
+    def get_block_size(self):
+        '''
+        Returns the number of frames per block.
+        '''
+        return self._block_size
+
+
+    def get_partitioning(self):
+        '''
+        Returns a list of (partition size, impulse response offset, partition count) for each segment.
+        '''
+        return [(size, offset, conv.get_partitions()) for size, offset, conv in self._segments]
+
+
+    def reset(self):
+        '''
+        Clear all internal state, as if no blocks had been processed.
+        '''
+        for _, _, conv in self._segments:
+            conv.reset()
+        self._buffers = [None] * len(self._segments)
+        self._ring = None
+        self._frames = 0
+
+
+    def process(self, block):
+        '''
+        Convolve the next input block.
+        :block: block_size frames, (frames,) or (frames, channels)
+        Returns block_size frames of output.
+        '''
+        assert len(block) == self._block_size, f'blocks must be {self._block_size} frames. actual: {len(block)}'
+        block_size = self._block_size
+        self._frames += block_size
+        now = self._frames
+
+        out = self._segments[0][2].process(block)
+        if self._ring is None:
+            self._ring = np.zeros((self._ring_size,) + out.shape[1:], dtype=out.dtype)
+
+        for i, (size, offset, conv) in enumerate(self._segments[1:], start=1):
+            if self._buffers[i] is None:
+                self._buffers[i] = np.zeros((size,) + block.shape[1:], dtype=block.dtype)
+            fill = (now - block_size) % size
+            self._buffers[i][fill:fill + block_size] = block
+            if now % size == 0:
+                # output for input frames [now - size, now), delayed by the segment offset
+                self._accumulate(now - size + offset, conv.process(self._buffers[i]))
+            else:
+                # spread the multiply-accumulate of the partitions after the first over the blocks in between
+                blocks_left = (size - fill) // block_size - 1
+                conv.prepare(-(-conv.prepare(0) // blocks_left))
+
+        start = (now - block_size) % self._ring_size
+        out = out + self._ring[start:start + block_size]
+        self._ring[start:start + block_size] = 0
+
+        return out
+
+
+    def _accumulate(self, frame, samples):
+        start = frame % self._ring_size
+        first = min(len(samples), self._ring_size - start)
+        self._ring[start:start + first] += samples[:first]
+        self._ring[:len(samples) - first] += samples[first:]
+
+
+def stream_blocks(blocks, convolver):
+    '''
+    Run a StreamingConvolver over an iterable of blocks, e.g. for offline rendering or testing.
+    The final block is zero-padded to the block size and its output trimmed back.
+    Yields output blocks.
+    '''
+    block_size = convolver.get_block_size()
+    for block in blocks:
+        if len(block) < block_size:
+            padded = np.zeros((block_size,) + block.shape[1:], dtype=block.dtype)
+            padded[:len(block)] = block
+            yield convolver.process(padded)[:len(block)]
+        else:
+            yield convolver.process(block)
+
+
+def open_reverb_stream(convolver, samp_rate, channels=default.channels, gain=1.0, input_device=None, output_device=None):
+    '''
+    Open a full-duplex PyAudio stream that convolves live input with the convolver's impulse response.
+    Audio is exchanged as 32-bit floating-point frames in blocks of the convolver's block size.
+    :convolver: StreamingConvolver
+    :samp_rate: (int) sampling rate in Hz
+    :channels: (int) number of input channels; the output has as many channels as the convolver produces
+    :gain: (float) output gain; the output is clipped to [-1, 1]
+    :input_device: / :output_device: optional PyAudio device indices
+    Returns the PyAudio instance and the started stream. Stop and close the stream, then terminate the PyAudio instance when done.
+    '''
+    import pyaudio
+
+    block_size = convolver.get_block_size()
+    probe = convolver.process(np.zeros((block_size, channels) if channels > 1 else block_size, dtype=np.float32))
+    convolver.reset()
+    out_channels = probe.shape[1] if probe.ndim == 2 else 1
+    # PyAudio opens duplex streams with one channel count, so mono input feeding a wider output is not supported
+    assert out_channels == channels, f'the convolver produces {out_channels} channels for {channels} input channels'
+
+    def callback(in_data, frame_count, time_info, status):
+        block = np.frombuffer(in_data, dtype=np.float32)
+        if channels > 1:
+            block = block.reshape(-1, channels)
+        out = convolver.process(block) * gain
+        np.clip(out, -1.0, 1.0, out=out)
+        return out.astype(np.float32).tobytes(), pyaudio.paContinue
+
+    py_audio = pyaudio.PyAudio()
+    stream = py_audio.open(
+                    rate=samp_rate,
+                    channels=channels,
+                    format=pyaudio.paFloat32,
+                    input=True,
+                    output=True,
+                    frames_per_buffer=block_size,
+                    input_device_index=input_device,
+                    output_device_index=output_device,
+                    stream_callback=callback)
+    stream.start_stream()
+
+    return py_audio, stream
@@ -0,0 +1,178 @@
+import functools, math
+import numpy as np
+from . import instrument
+
+'''
+rational sample-rate conversion with polyphase FIR filters
+'''
+# Kaiser window parameter and filter half-length per unit of max(up, down), as used by scipy.signal.resample_poly
+kaiser_beta = 5.0
+half_width = 10
+
+
+@functools.lru_cache(maxsize=32)
+def rational_ratio(old_rate, new_rate):
+    '''
+    Returns the smallest (up, down) integer pair with new_rate / old_rate == up / down, e.g. (160, 147) for 44.1 -> 48 kHz.
+    '''
+    assert old_rate > 0 and new_rate > 0, f'sampling rates must be positive: {old_rate} -> {new_rate}'
+    divisor = math.gcd(int(old_rate), int(new_rate))
+
+    return int(new_rate) // divisor, int(old_rate) // divisor
+
+
+@functools.lru_cache(maxsize=32)
+def design_filter(up, down):
+    '''
+    Low-pass prototype filter for resampling by up / down, with its cutoff at the lower of the two Nyquist frequencies.
+    The design is cached per ratio, so converting many signals between the same rates designs the filter once.
+    Returns a read-only float64 array of 2 * half_width * max(up, down) + 1 taps, with unit DC gain.
+    '''
+    from scipy import signal
+
+    max_rate = max(up, down)
+    h = signal.firwin(2 * half_width * max_rate + 1, 1 / max_rate, window=('kaiser', kaiser_beta))
+    h.flags.writeable = False
+
+    return h
+
+
+@functools.lru_cache(maxsize=32)
+def polyphase_filters(up, down):
+    '''
+    The filter of design_filter(up, down), scaled by up and split into its up polyphase components.
+    Returns a read-only (up, taps per phase) float64 array; row p holds taps p, p + up, p + 2 * up, ...
+    '''
+    h = design_filter(up, down) * up
+    taps = -(-len(h) // up)
+    phases = np.zeros(taps * up)
+    phases[:len(h)] = h
+    phases = np.ascontiguousarray(phases.reshape(taps, up).T)
+    phases.flags.writeable = False
+
+    return phases
+
+
+def resampled_length(nframes, old_rate, new_rate):
+    '''
+    Returns the number of frames of a signal of nframes frames after resampling from old_rate to new_rate.
+    '''
+    up, down = rational_ratio(old_rate, new_rate)
+
+    return -(-nframes * up // down)
+
+
+@instrument.instrumented()
+def resample(samples, old_rate, new_rate):
+    '''
+    Convert samples from old_rate to new_rate with a polyphase FIR filter (scipy.signal.resample_poly), using the
+    cached filter design for the ratio. Cost is linear in the signal length, whatever the length.
+    :samples: (frames,) or (frames, channels) array
+    :old_rate: / :new_rate: (int) sampling rates in Hz
+    Returns a numpy array of resampled_length(len(samples), old_rate, new_rate) frames, or samples itself when the
+    rates are equal. Floating-point input keeps its dtype.
+    '''
+    from scipy import signal
+
+    samples = np.asarray(samples)
+    up, down = rational_ratio(old_rate, new_rate)
+    if up == down:
+        return samples
+    resampled = signal.resample_poly(samples, up, down, axis=0, window=design_filter(up, down))
+
+    return resampled.astype(samples.dtype, copy=False) if samples.dtype.kind == 'f' else resampled
+
+
+class Resampler:
+    '''
+    Streaming rational resampler, for converting a signal block by block, e.g. while reading a long file or live input.
+    The concatenated output of process() followed by flush() equals resample() of the whole signal.
+    Output is held back until the filter has seen the input it depends on, so the first blocks may be short or empty.
+    '''
+    def __init__(self, old_rate, new_rate):
+        '''
+        :old_rate: / :new_rate: (int) sampling rates in Hz
+        '''
+        self._up, self._down = rational_ratio(old_rate, new_rate)
+        self._phases = polyphase_filters(self._up, self._down)
+        self._half_len = half_width * max(self._up, self._down)
+        self.reset()
+
+
+    def get_ratio(self):
+        '''
+        Returns the (up, down) conversion ratio.
+        '''
+        return self._up, self._down
+
+
+    def get_latency(self):
+        '''
+        Returns the number of input frames by which the output lags the input, (half the filter length) / up.
+        '''
+        return self._half_len / self._up
+
+
+    def reset(self):
+        '''
+        Clear all internal state, as if no blocks had been processed.
+        '''
+        self._buffer = None
+        # absolute input index of the first buffered frame; frames before the start of the signal are zeros
+        self._buffer_start = 1 - self._phases.shape[1]
+        self._frames_in = 0
+        self._frames_out = 0
+
+
+    def process(self, block):
+        '''
+        Resample the next input block.
+        :block: (frames,) or (frames, channels), with the same channel count for every block
+        Returns the output frames that can be computed so far.
+        '''
+        block = np.asarray(block)
+        if self._buffer is None:
+            self._buffer = np.zeros((-self._buffer_start,) + block.shape[1:], dtype=np.result_type(block.dtype, np.float32))
+        self._buffer = np.concatenate((self._buffer, block))
+        self._frames_in += len(block)
+        # output m depends on input frames up to (m * down + half_len) // up
+        available = -(-(self._frames_in * self._up - self._half_len) // self._down)
+
+        return self._emit(max(available, self._frames_out))
+
+
+    def flush(self):
+        '''
+        Returns the remaining output frames, computed as if the input were followed by silence, and resets the state.
+        '''
+        if self._buffer is None:
+            return np.zeros(0)
+        total = -(-self._frames_in * self._up // self._down)
+        needed = (total * self._down + self._half_len) // self._up + 1
+        padding = max(0, needed - self._buffer_start - len(self._buffer))
+        self._buffer = np.concatenate((self._buffer, np.zeros((padding,) + self._buffer.shape[1:], dtype=self._buffer.dtype)))
+        out = self._emit(total)
+        self.reset()
+
+        return out
+
+
+    def _emit(self, stop):
+        taps = self._phases.shape[1]
+        positions = np.arange(self._frames_out, stop) * self._down + self._half_len
+        base, phase = np.divmod(positions, self._up)
+        # row i of the gathered input holds frames base, base - 1, ..., base - taps + 1 for output i
+        index = base[:, np.newaxis] - np.arange(taps) - self._buffer_start
+        gathered = self._buffer[index]
+        if gathered.ndim == 3:
+            out = np.einsum('mt,mtc->mc', self._phases[phase], gathered)
+        else:
+            out = np.einsum('mt,mt->m', self._phases[phase], gathered)
+        self._frames_out = stop
+        # keep only the frames the next output can depend on
+        keep_from = min((stop * self._down + self._half_len) // self._up - taps + 1, self._buffer_start + len(self._buffer))
+        if keep_from > self._buffer_start:
+            self._buffer = self._buffer[keep_from - self._buffer_start:]
+            self._buffer_start = keep_from
+
+        return out.astype(self._buffer.dtype, copy=False)
@@ -1,24 +1,148 @@
 import numpy as np
-import pyaudio
 import struct, wave as w
+from collections import namedtuple
+from . import instrument
 
 '''
 handle wav files
 '''
+# same fields as the parameters returned by wave.getparams(), so the two are interchangeable.
+# comptype is 'NONE' for integer PCM and 'FLOAT' for IEEE floating-point PCM.
+wave_params = namedtuple('wave_params', ['nchannels', 'sampwidth', 'framerate', 'nframes', 'comptype', 'compname'])
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# RF64 (EBU Tech 3306) files set the 32-bit sizes to this value, and keep the real sizes in a ds64 chunk
+RF64_SIZE = 0xFFFFFFFF
+
+# number of frames decoded at a time when a format needs a temporary widened copy (24-bit)
+decode_chunk = 1 << 20
+
+
+def read_wave_header(wav_file):
+    '''
+    Parse the RIFF/WAVE header of an open binary file, stopping at the start of the sample data.
+    Handles integer PCM, IEEE floating-point PCM and WAVE_FORMAT_EXTENSIBLE headers, and RF64 files over 4 GB.
+    :wav_file: file object opened in 'rb' mode, positioned at the start of the file
+    Returns the wave parameters and the byte offset of the sample data within the file.
+    '''
+    riff, _, wave_id = struct.unpack('<4sI4s', wav_file.read(12))
+    if riff not in (b'RIFF', b'RF64') or wave_id != b'WAVE':
+        raise TypeError(f'{getattr(wav_file, "name", wav_file)} is not a RIFF/WAVE file')
+
+    fmt = None
+    data_size_64 = None
+    while True:
+        chunk_header = wav_file.read(8)
+        if len(chunk_header) < 8:
+            raise EOFError(f'{getattr(wav_file, "name", wav_file)}: no data chunk found')
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+        if chunk_id == b'fmt ':
+            fmt = wav_file.read(chunk_size)
+            if chunk_size % 2:
+                wav_file.seek(1, 1)
+        elif chunk_id == b'ds64':
+            # RIFF size, data size and sample count as 64-bit values, followed by an optional table
+            data_size_64 = struct.unpack('<QQQ', wav_file.read(24))[1]
+            wav_file.seek(chunk_size - 24, 1)
+        elif chunk_id == b'data':
+            if riff == b'RF64' and chunk_size == RF64_SIZE:
+                assert data_size_64 is not None, 'RF64 file without a ds64 chunk'
+                chunk_size = data_size_64
+            break
+        else:
+            # chunks are padded to an even number of bytes
+            wav_file.seek(chunk_size + (chunk_size % 2), 1)
+
+    assert fmt is not None, 'fmt chunk must precede the data chunk'
+    format_tag, nchannels, framerate, _, block_align, bits = struct.unpack('<HHIIHH', fmt[:16])
+    if format_tag == WAVE_FORMAT_EXTENSIBLE:
+        # the first two bytes of the sub-format GUID hold the actual format tag
+        format_tag = struct.unpack('<H', fmt[24:26])[0]
+    if format_tag == WAVE_FORMAT_PCM:
+        comptype, compname = 'NONE', 'not compressed'
+    elif format_tag == WAVE_FORMAT_IEEE_FLOAT:
+        comptype, compname = 'FLOAT', 'IEEE float'
+    else:
+        raise TypeError(f'unsupported WAVE format tag: {format_tag:#06x}')
+
+    sampwidth = (bits + 7) // 8
+    params = wave_params(nchannels, sampwidth, framerate, chunk_size // block_align, comptype, compname)
+
+    return params, wav_file.tell()
+
+
+def decode_frames(data, sampwidth, nchannels=1, comptype='NONE'):
+    '''
+    Decode raw little-endian PCM bytes to floating-point samples between -1 and 1, without Python-level loops.
+    Supports 8-, 16-, 24- and 32-bit integer PCM, and 32-bit floating-point PCM.
+    :data: bytes, bytearray, memoryview or uint8 numpy array of interleaved frames
+    :sampwidth: (int) sample width in bytes
+    :nchannels: (int) number of interleaved channels
+    :comptype: 'NONE' for integer PCM, 'FLOAT' for IEEE floating-point PCM
+    Returns a float32 numpy array, of shape (frames,) for mono or (frames, channels) otherwise.
+    '''
+    raw = np.frombuffer(data, dtype=np.uint8)
+    block_align = sampwidth * nchannels
+    raw = raw[:len(raw) - (len(raw) % block_align)]
+
+    if comptype == 'FLOAT':
+        assert sampwidth == 4, f'only 32-bit floating-point samples are supported. actual: {sampwidth * 8} bit'
+        samples = raw.view('<f4').astype(np.float32)
+    elif sampwidth == 1:
+        # 8-bit WAVE samples are unsigned
+        samples = raw.astype(np.float32)
+        samples -= 128
+        samples *= 2**-7
+    elif sampwidth == 2:
+        samples = raw.view('<i2').astype(np.float32)
+        samples *= 2**-15
+    elif sampwidth == 3:
+        samples = decode_24bit(raw)
+    elif sampwidth == 4:
+        samples = raw.view('<i4').astype(np.float32)
+        samples *= 2**-31
+    else:
+        raise TypeError(f'unknown sample format: {sampwidth * 8} bit')
+
+    if nchannels > 1:
+        samples = samples.reshape(-1, nchannels)
+
+    return samples
+
+
+def decode_24bit(raw):
+    '''
+    Decode packed 24-bit little-endian samples to floating-point values between -1 and 1.
+    Each 3-byte sample is placed in the upper bytes of a 32-bit word, so the sign is extended by the integer view itself.
+    The widened copy is made in chunks of decode_chunk samples to bound peak memory.
+    :raw: uint8 numpy array, length a multiple of 3
+    Returns a float32 numpy array.
+    '''
+    raw = raw.reshape(-1, 3)
+    samples = np.empty(len(raw), dtype=np.float32)
+    wide = np.zeros((min(len(raw), decode_chunk), 4), dtype=np.uint8)
+    for start in range(0, len(raw), decode_chunk):
+        chunk = raw[start:start + decode_chunk]
+        wide[:len(chunk), 1:] = chunk
+        np.multiply(wide[:len(chunk)].view('<i4')[:, 0], 2**-31, out=samples[start:start + len(chunk)], casting='unsafe')
+
+    return samples
+
+
 def read_wave_16bit(wav_obj, params):
     '''
     Read 16-bit wave file and convert to a Python array
-    Returns the array of floating-point values
+    Returns the array of floating-point values, of shape (frames, channels) for multichannel files
     :wav_obj: wave object
     :params: wave object parameters
     '''
     assert params.sampwidth == 2, f'file is not in 16-bit format. actual: {params.sampwidth * 8} bit'
-    assert params.nchannels == 1, f'file is not mono. actual: {params.nchannels} channels'
 
     frames = wav_obj.readframes(params.nframes)
-    sample_array = struct.unpack(f'<{params.nframes}h', frames)
-    samples = np.array(sample_array, 'f')
-    samples = samples / (2**15)
+    samples = decode_frames(frames, 2, params.nchannels)
 
     return samples
 
@@ -26,73 +150,330 @@ def read_wave_16bit(wav_obj, params):
 def read_wave_24bit(wave_obj, params):
     '''
     Read  24-bit wave file and convert to a Python array
-    Returns the array of floating-point values
+    Returns the array of floating-point values, of shape (frames, channels) for multichannel files
     :wav_obj: wave object
     :params: wave object parameters
     '''
     assert params.sampwidth == 3, "not 24-bit"
-    assert params.nchannels == 1, "not mono"
 
     frames = wave_obj.readframes(params.nframes)
-    frames = [
-        frames[i] | (frames[i + 1] << 8) | (frames[i + 2] << 16)
-        for i in range(0, params.nframes * 3, 3)
-    ]
-    # https://stackoverflow.com/a/32031543
-    sign_bit = 0x800000
-    sign_mask = sign_bit - 1
-    def sign_extend(value):
-        return (value & sign_mask) - (value & sign_bit)
-    frames = [sign_extend(f) / sign_bit for f in frames]
-    frames = np.array(frames, 'f')
+    frames = decode_frames(frames, 3, params.nchannels)
     
     return frames
 
-def read_wave_nbit(wavfile):
+class MappedWave:
     '''
-    Unpack wave file to a floating-point numpy array
-    Return wave file parameters and frames 
+    Memory-mapped, lazily decoded view of the samples in a WAVE file.
+    The RIFF header is parsed once; sample bytes are only read from disk and decoded when indexed,
+    so files larger than the available memory can be processed in blocks.
+    Behaves like a read-only float32 array of shape (frames,) for mono or (frames, channels) otherwise.
+    Floating-point files are not peak-normalized, since that would require a pass over the whole file.
     '''
-    with w.open(wavfile, 'rb') as wav:
-        params = wav.getparams()
-        num_frames = wav.getnframes()
+    def __init__(self, wavfile):
+        with open(wavfile, 'rb') as wav:
+            params, offset = read_wave_header(wav)
+        self.filename = wavfile
+        self.params = params
+        self._block_align = params.sampwidth * params.nchannels
+        nbytes = params.nframes * self._block_align
+        if nbytes == 0:
+            self._raw = np.zeros(0, dtype=np.uint8)
+        else:
+            self._raw = np.memmap(wavfile, dtype=np.uint8, mode='r', offset=offset, shape=(nbytes,))
+
+
+    @property
+    def shape(self):
+        if self.params.nchannels == 1:
+            return (self.params.nframes,)
+        return (self.params.nframes, self.params.nchannels)
+
 
-        frames = None
-        if params.sampwidth == 2:
-            frames = read_wave_16bit(wav, params)
-        elif params.sampwidth == 3:
-            frames = read_wave_24bit(wav, params)
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+
+    def __len__(self):
+        return self.params.nframes
+
+
+    def read(self, start=0, stop=None):
+        '''
+        Decode frames [start, stop) from the file.
+        Returns a float32 numpy array.
+        '''
+        start, stop, _ = slice(start, stop).indices(self.params.nframes)
+        stop = max(start, stop)
+        data = self._raw[start * self._block_align:stop * self._block_align]
+        return decode_frames(data, self.params.sampwidth, self.params.nchannels, self.params.comptype)
+
+
+    def __getitem__(self, key):
+        frame_key, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(frame_key, slice):
+            start, stop, step = frame_key.indices(self.params.nframes)
+            if step > 0:
+                samples = self.read(start, stop)[::step]
+            else:
+                samples = self.read(stop + 1, start + 1)[::step]
         else:
-            TypeError(f'{wavfile} is an unknown format: {params.sampwidth * 8} bit')
-        
-    if frames.any() > 1.0:
-        frames = frames / frames[np.argmax(frames)]
-    elif frames.any() < -1.0:
-        frames = frames / (frames[np.argmin(frames)] * -1)
+            index = range(self.params.nframes)[frame_key]
+            # a single frame has no frame axis left, so the rest of the key indexes its channels
+            row = self.read(index, index + 1)[0]
+            return row[rest] if rest else row
+        return samples[(slice(None),) + rest] if rest else samples
+
+
+    def __array__(self, dtype=None, copy=None):
+        samples = self.read()
+        return samples if dtype is None else samples.astype(dtype, copy=False)
+
+
+    def blocks(self, blocksize, overlap=0, pad=False):
+        '''
+        Yield consecutive blocks of decoded frames.
+        :blocksize: (int) number of frames per block
+        :overlap: (int) number of frames shared by consecutive blocks, less than blocksize
+        :pad: (bool) zero-pad the final block to blocksize frames
+        '''
+        yield from iter_blocks(self, blocksize, overlap=overlap, pad=pad)
+
+
+def iter_blocks(samples, blocksize, overlap=0, pad=False):
+    '''
+    Yield consecutive, optionally overlapping blocks from a numpy array or MappedWave.
+    Only one block is decoded/held at a time for a MappedWave.
+    :samples: array-like of frames, indexed along the first axis
+    :blocksize: (int) number of frames per block
+    :overlap: (int) number of frames shared by consecutive blocks, less than blocksize
+    :pad: (bool) zero-pad the final block to blocksize frames
+    '''
+    assert 0 <= overlap < blocksize, f'overlap must be between 0 and blocksize - 1. overlap: {overlap}; blocksize: {blocksize}'
+    hop = blocksize - overlap
+    nframes = len(samples)
+    start = 0
+    while True:
+        block = samples[start:start + blocksize]
+        if pad and len(block) < blocksize:
+            padded = np.zeros((blocksize,) + block.shape[1:], dtype=block.dtype)
+            padded[:len(block)] = block
+            block = padded
+        yield block
+        start += hop
+        if start + overlap >= nframes:
+            break
+
+
+@instrument.instrumented()
+def read_wave_nbit(wavfile, lazy=False):
+    '''
+    Unpack wave file to a floating-point numpy array.
+    Reads 8/16/24/32-bit integer and 32-bit floating-point PCM.
+    Interleaved multichannel files are returned as a (frames, channels) array.
+    :lazy: (bool) return a memory-mapped MappedWave instead of decoding the whole file
+    Return wave file parameters and frames 
+    '''
+    if lazy:
+        frames = MappedWave(wavfile)
+        return frames.params, frames
+
+    with open(wavfile, 'rb') as wav:
+        params, _ = read_wave_header(wav)
+        data = wav.read(params.nframes * params.sampwidth * params.nchannels)
+
+    frames = decode_frames(data, params.sampwidth, params.nchannels, params.comptype)
+    del data
+
+    # only floating-point files can exceed full scale
+    peak = np.max(np.abs(frames)) if len(frames) else 0
+    if peak > 1.0:
+        frames /= peak
 
     return params, frames
 
-def write_wav_file_16bit(file, frames, channels, samp_rate, sampwidth):
+class WaveWriter:
+    '''
+    Incremental WAVE file writer, for signals that are produced block by block, e.g. by realtime.stream_blocks.
+    Blocks of floating-point samples are encoded to 16- or 24-bit integer PCM or 32-bit floating-point PCM without
+    Python-level loops. Integer output is optionally TPDF-dithered and is clipped to full scale, counting the clipped
+    samples, instead of wrapping around.
+    Space for a ds64 chunk is reserved in the header (as a JUNK chunk), so the RIFF sizes written on close can be
+    switched to RF64 when the data exceeds 4 GB.
+    Use as a context manager, or call close() to finish the file.
+    '''
+    def __init__(self, filename, samp_rate, channels=1, sampwidth=2, comptype='NONE', dither=False, rf64='auto', seed=None):
+        '''
+        :filename: (string) path of the file to write
+        :samp_rate: (int) sampling rate in Hz
+        :channels: (int) number of channels; blocks are (frames,) for mono or (frames, channels)
+        :sampwidth: (int) bytes per sample: 2 or 3 for integer PCM, 4 for floating-point PCM
+        :comptype: 'NONE' for integer PCM, 'FLOAT' for IEEE floating-point PCM
+        :dither: (bool) add triangular (TPDF) dither of +-1 LSB before rounding to integers
+        :rf64: 'auto' writes RF64 only when needed, True always, False never (sizes over 4 GB are then an error)
+        :seed: optional seed of the dither noise generator
+        '''
+        assert (comptype, sampwidth) in (('NONE', 2), ('NONE', 3), ('FLOAT', 4)), f'unsupported output format: {comptype} {sampwidth * 8} bit'
+        self.params = wave_params(channels, sampwidth, samp_rate, 0, comptype, 'IEEE float' if comptype == 'FLOAT' else 'not compressed')
+        self._block_align = channels * sampwidth
+        self._dither = dither
+        self._rng = np.random.default_rng(seed)
+        self._rf64 = rf64
+        self._frames = 0
+        self._clipped = 0
+        self._file = open(filename, 'wb')
+        self._write_header()
+
+
+    def _write_header(self):
+        channels, sampwidth, samp_rate, _, comptype, _ = self.params
+        if comptype == 'FLOAT':
+            # non-PCM formats have a cbSize field and a fact chunk with the number of frames
+            fmt = struct.pack('<HHIIHHH', WAVE_FORMAT_IEEE_FLOAT, channels, samp_rate, samp_rate * self._block_align, self._block_align, sampwidth * 8, 0)
+        else:
+            fmt = struct.pack('<HHIIHH', WAVE_FORMAT_PCM, channels, samp_rate, samp_rate * self._block_align, self._block_align, sampwidth * 8)
+        header = b'RIFF' + struct.pack('<I', 0) + b'WAVE'
+        self._ds64_offset = len(header)
+        header += b'JUNK' + struct.pack('<I', 28) + bytes(28)
+        header += b'fmt ' + struct.pack('<I', len(fmt)) + fmt
+        self._fact_offset = None
+        if comptype == 'FLOAT':
+            self._fact_offset = len(header)
+            header += b'fact' + struct.pack('<II', 4, 0)
+        self._data_offset = len(header)
+        header += b'data' + struct.pack('<I', 0)
+        self._file.write(header)
+
+
+    def get_frames(self):
+        '''
+        Returns the number of frames written so far.
+        '''
+        return self._frames
+
+
+    def get_clipped(self):
+        '''
+        Returns the number of samples that exceeded full scale and were clipped (integer formats only).
+        '''
+        return self._clipped
+
+
+    def encode(self, block):
+        '''
+        Encode a block of floating-point samples to the bytes of the output format.
+        :block: (frames,) or (frames, channels) array, nominally between -1 and 1
+        Returns a bytes object.
+        '''
+        block = np.asarray(block)
+        block_channels = block.shape[1] if block.ndim == 2 else 1
+        assert block_channels == self.params.nchannels, f'block has {block_channels} channels, expected {self.params.nchannels}'
+        if self.params.comptype == 'FLOAT':
+            return np.ascontiguousarray(block, dtype='<f4').tobytes()
+
+        full_scale = 2 ** (self.params.sampwidth * 8 - 1)
+        scaled = block * float(full_scale)
+        if self._dither:
+            scaled += self._rng.random(scaled.shape)
+            scaled -= self._rng.random(scaled.shape)
+        np.rint(scaled, out=scaled)
+        over = (scaled > full_scale - 1) | (scaled < -full_scale)
+        self._clipped += int(np.count_nonzero(over))
+        np.clip(scaled, -full_scale, full_scale - 1, out=scaled)
+        if self.params.sampwidth == 2:
+            return np.ascontiguousarray(scaled, dtype='<i2').tobytes()
+        # 24-bit: the low three bytes of each little-endian 32-bit integer
+        wide = np.ascontiguousarray(scaled, dtype='<i4').reshape(-1)
+        return wide.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+
+
+    def write(self, block):
+        '''
+        Encode and append a block of frames.
+        :block: (frames,) or (frames, channels) array of floating-point samples
+        Returns the number of frames written.
+        '''
+        data = self.encode(block)
+        if self._rf64 is False:
+            assert self._data_offset + 8 + (self._frames + len(block)) * self._block_align <= RF64_SIZE, 'file exceeds 4 GB; use rf64=True or "auto"'
+        self._file.write(data)
+        self._frames += len(block)
+
+        return len(block)
+
+
+    def write_blocks(self, blocks):
+        '''
+        Write every block of an iterable of blocks, e.g. the output of realtime.stream_blocks.
+        Returns the total number of frames written.
+        '''
+        return sum(self.write(block) for block in blocks)
+
+
+    def close(self):
+        '''
+        Pad the data chunk to an even size, write the final chunk sizes into the header and close the file.
+        '''
+        if self._file.closed:
+            return
+        data_size = self._frames * self._block_align
+        if data_size % 2:
+            self._file.write(b'\0')
+        riff_size = self._file.tell() - 8
+        rf64 = self._rf64 is True or (self._rf64 == 'auto' and riff_size > RF64_SIZE)
+        if rf64:
+            self._file.seek(0)
+            self._file.write(b'RF64' + struct.pack('<I', RF64_SIZE))
+            self._file.seek(self._ds64_offset)
+            self._file.write(b'ds64' + struct.pack('<IQQQI', 28, riff_size, data_size, self._frames, 0))
+        else:
+            self._file.seek(4)
+            self._file.write(struct.pack('<I', riff_size))
+        if self._fact_offset is not None:
+            self._file.seek(self._fact_offset + 8)
+            self._file.write(struct.pack('<I', min(self._frames, RF64_SIZE)))
+        self._file.seek(self._data_offset + 4)
+        self._file.write(struct.pack('<I', RF64_SIZE if rf64 else data_size))
+        self._file.close()
+        self.params = self.params._replace(nframes=self._frames)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+@instrument.instrumented()
+def write_wav_file_16bit(file, frames, channels, samp_rate, sampwidth, dither=False):
     '''
     Convert floating-point array of audio samples (frames) to a bytes object, 
     and write bytes out to wav file format
     :file: (str) name of file to write 
-    :frames: floating-point numpy array of samples (currently handles mono-channel only)
+    :frames: floating-point numpy array of samples, of shape (frames,) for mono or (frames, channels)
     :channels: (int) number of channels 
     :samp_rate: (int) sampling rate in Hz
-    :sampwidth: (int) bit-width of sample in bytes
+    :sampwidth: (int) bit-width of sample in bytes: 2 or 3 for integer PCM
+    :dither: (bool) add TPDF dither before rounding, see WaveWriter
+    Samples beyond full scale are clipped. Returns the number of clipped samples.
     '''
-    fbytes = samples_to_bytes_16bit(frames)
-    wav = w.open(file, 'wb')
-    wav.setnchannels(channels)
-    wav.setsampwidth(sampwidth)
-    wav.setframerate(samp_rate)
-    wav.setnframes(samp_rate)
-    wav.writeframes(fbytes)
-    wav.close()
+    with WaveWriter(file, samp_rate, channels, sampwidth, dither=dither) as writer:
+        writer.write(frames)
+
+    return writer.get_clipped()
 
 
 def play_wav_16bit(samples, samp_rate, channels, dtype):
+    # PyAudio needs PortAudio, which is only loaded when audio is played
+    import pyaudio
+
     samples = samples_to_bytes_16bit(samples)
     py_audio = pyaudio.PyAudio()
     wav_stream = py_audio.open(
@@ -122,13 +503,14 @@ def bytes_to_samples_16bit(data, frames):
 def samples_to_bytes_16bit(sample_array):
     '''
     Translate array of floating-point samples into a bytes object
+    A (frames, channels) array is written with interleaved channels.
     Returns the bytes
     :sample_array: array of samples
     :dtype: data type of the samples
     '''
-    assert sample_array[np.argmax(sample_array)] < 1, f'input samples must be floating-point values between 0 and 1. type: {sample_array.dtype}; max value: {sample_array[np.argmax(sample_array)]}'
+    assert np.max(sample_array) < 1, f'input samples must be floating-point values between 0 and 1. type: {sample_array.dtype}; max value: {np.max(sample_array)}'
     samples_16bit = sample_array * (2**15)
-    arr = np.array(samples_16bit, dtype='<i2')
+    arr = np.ascontiguousarray(samples_16bit, dtype='<i2')
     signal_bytes = arr.tobytes()
 
     return signal_bytes
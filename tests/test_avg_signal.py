@@ -0,0 +1,9 @@
+import numpy as np
+from ir_module import avg_signal as avg
+
+
+def test_upsample_default_factor():
+    takes = np.sin(np.linspace(0, 20, 300)).reshape(3, 100)
+    upsampled = avg.upsample(takes)
+    assert upsampled.shape == (3, 200)
+    np.testing.assert_allclose(upsampled[:, ::2], takes, atol=1e-10)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from ir_module import batch, fft_backend as fb, gen_sine as gs, wav_util
+from ir_module.measure import simulated_room
+
+
+def _write_tree(root, sample_rate=16000, sweep_rate=None):
+    # the sweep file may be stored at another rate than the recordings are made at
+    sweep_rate = sweep_rate or sample_rate
+    wav_util.write_wav_file_16bit(str(root / 'sweep.wav'), gs.exp_sweep(50, 7000, 1.0, sample_rate=sweep_rate), 1, sweep_rate, 2)
+    sweep = gs.exp_sweep(50, 7000, 1.0, sample_rate=sample_rate)
+    room = simulated_room(sample_rate, rt60=0.2, seed=1)
+    for position in ('a', 'b'):
+        (root / 'takes' / position).mkdir(parents=True)
+        for take in range(2):
+            recording = np.zeros(len(sweep) + sample_rate // 2)
+            recording[100 + take:100 + take + len(sweep) + len(room) - 1] = np.convolve(sweep, room)[:len(recording) - 100 - take]
+            wav_util.write_wav_file_16bit(str(root / 'takes' / position / f'take_{take}.wav'), recording * 0.5, 1, sample_rate, 2)
+
+
+def test_serial_process_tree_restores_state(tmp_path):
+    _write_tree(tmp_path)
+    fb.set_workers(3)
+    try:
+        results, totals = batch.process_tree(str(tmp_path / 'takes'), str(tmp_path / 'sweep.wav'), str(tmp_path / 'out'), workers=1)
+        assert fb.get_workers() == 3
+    finally:
+        fb.set_workers(-1)
+    assert batch._shared == {}
+    assert [result['sample_rate'] for result in results] == [16000, 16000]
+    assert 'setup' in totals
+
+
+def _rir(path):
+    _, samples = wav_util.read_wave_nbit(path)
+    return samples
+
+
+def test_process_tree_resamples_sweep_to_recordings(tmp_path):
+    matched, resampled = tmp_path / 'matched', tmp_path / 'resampled'
+    matched.mkdir(), resampled.mkdir()
+    _write_tree(matched, sample_rate=16000)
+    _write_tree(resampled, sample_rate=16000, sweep_rate=22050)
+    for root in (matched, resampled):
+        results, _ = batch.process_tree(str(root / 'takes'), str(root / 'sweep.wav'), str(root / 'out'), workers=1)
+        assert [result['sample_rate'] for result in results] == [16000, 16000]
+    expected, actual = _rir(str(matched / 'out' / 'a_rir.wav')), _rir(str(resampled / 'out' / 'a_rir.wav'))
+    length = min(len(expected), len(actual))
+    assert abs(np.argmax(np.abs(actual)) - np.argmax(np.abs(expected))) <= 1
+    assert np.corrcoef(expected[:length], actual[:length])[0, 1] > 0.9
+
+
+def test_process_tree_rejects_mixed_rates_in_a_directory(tmp_path):
+    _write_tree(tmp_path)
+    wav_util.write_wav_file_16bit(str(tmp_path / 'takes' / 'a' / 'take_2.wav'), np.zeros(20000), 1, 22050, 2)
+    with pytest.raises(ValueError, match='different sampling rates'):
+        batch.process_tree(str(tmp_path / 'takes'), str(tmp_path / 'sweep.wav'), str(tmp_path / 'out'), workers=1)
+
+
+def test_process_directory_needs_a_sweep_outside_process_tree(tmp_path):
+    _write_tree(tmp_path)
+    directory, out_file = str(tmp_path / 'takes' / 'a'), str(tmp_path / 'a_rir.wav')
+    with pytest.raises(ValueError, match='sweep_file'):
+        batch.process_directory(directory, out_file, 20000)
+    result = batch.process_directory(directory, out_file, 20000, sweep_file=str(tmp_path / 'sweep.wav'))
+    assert result['sample_rate'] == 16000 and result['frames'] > 0
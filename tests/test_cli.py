@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from ir_module import cli, fft_backend as fb, wav_util
+
+
+def _band_levels(ir, sample_rate, bands):
+    spectrum = np.abs(fb.rfft(ir, 1 << 16))
+    freqs = fb.rfftfreq(1 << 16, 1 / sample_rate)
+    return [20 * np.log10(np.mean(spectrum[(freqs > f / 1.2) & (freqs < f * 1.2)])) for f in bands]
+
+
+def test_deconvolve_exp_sweep_is_flat(tmp_path):
+    rate = 16000
+    sweep, recording, out = (str(tmp_path / name) for name in ('sweep.wav', 'recording.wav', 'ir.wav'))
+    cli.main(['sweep', sweep, '--start', '50', '--end', '7500', '--seconds', '2', '--rate', str(rate), '--format', 'float32'])
+    _, played = wav_util.read_wave_nbit(sweep)
+    # a room that is a delayed impulse only, so the impulse response should be flat over the swept band
+    recorded = np.zeros(len(played) + rate // 2)
+    recorded[200:200 + len(played)] = played * 0.5
+    with wav_util.WaveWriter(recording, rate, 1, 4, 'FLOAT') as writer:
+        writer.write(recorded)
+    cli.main(['deconvolve', recording, out, '--sweep', '50', '7500', '2', '--trim'])
+    _, ir = wav_util.read_wave_nbit(out)
+    levels = _band_levels(ir, rate, [100, 1000, 6000])
+    assert max(levels) - min(levels) < 3
+
+
+def test_deconvolve_needs_one_reference(tmp_path):
+    with pytest.raises(SystemExit):
+        cli.main(['deconvolve', str(tmp_path / 'recording.wav'), str(tmp_path / 'ir.wav')])
@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+from ir_module import wav_util
+from ir_module.convolve import convolve_audio
+
+
+def _write(path, samples, comptype, sampwidth):
+    with wav_util.WaveWriter(str(path), 8000, 1, sampwidth, comptype) as writer:
+        writer.write(samples)
+    return wav_util.MappedWave(str(path))
+
+
+@pytest.mark.parametrize('engine', ['fft', 'partitioned'])
+def test_hot_float_source_is_rejected(tmp_path, engine):
+    samples = np.zeros(5000, dtype=np.float32)
+    samples[3000] = 1.5
+    source = _write(tmp_path / 'hot.wav', samples, 'FLOAT', 4)
+    with pytest.raises(AssertionError, match='not within bounds'):
+        convolve_audio(source, np.array([1.0, 0.5]), engine=engine, block_size=256)
+
+
+@pytest.mark.parametrize('comptype, sampwidth', [('FLOAT', 4), ('NONE', 2)])
+def test_mapped_source_matches_array(tmp_path, comptype, sampwidth):
+    samples = np.random.default_rng(0).uniform(-0.5, 0.5, 5000).astype(np.float32)
+    source = _write(tmp_path / 'source.wav', samples, comptype, sampwidth)
+    impulse = np.random.default_rng(1).uniform(-0.5, 0.5, 300)
+    expected = convolve_audio(np.asarray(source), impulse)
+    for engine in ('fft', 'partitioned'):
+        np.testing.assert_allclose(convolve_audio(source, impulse, engine=engine, block_size=256), expected, atol=1e-5)
@@ -0,0 +1,7 @@
+import subprocess, sys
+
+
+def test_modules_do_not_load_scipy_on_import():
+    code = 'import sys, ir_module.Signal, ir_module.batch, ir_module.cli; print(sorted(m for m in ("scipy", "matplotlib", "pyaudio") if m in sys.modules))'
+    loaded = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout.strip()
+    assert loaded == '[]'
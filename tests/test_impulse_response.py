@@ -0,0 +1,17 @@
+import numpy as np
+from ir_module import gen_sine as gs, impulse_response as ir
+
+
+def test_deconvolve_with_only_output_rate():
+    sweep = gs.exp_sweep(50, 7000, 0.5, sample_rate=16000)
+    recording = np.concatenate([np.zeros(100), sweep * 0.5, np.zeros(2000)])
+    expected = ir.deconvolve_invfilt(recording, sweep)
+    np.testing.assert_allclose(ir.deconvolve_invfilt(recording, sweep, output_rate=48000), expected)
+    np.testing.assert_allclose(ir.Deconvolver().inverse_spectrum(sweep, 16384, target_rate=48000), ir.Deconvolver().inverse_spectrum(sweep, 16384))
+
+
+def test_deconvolve_resamples_input_to_output_rate():
+    recording_sweep = gs.exp_sweep(50, 7000, 0.5, sample_rate=16000)
+    recording = np.concatenate([np.zeros(100), recording_sweep * 0.5, np.zeros(2000)])
+    deconvolved = ir.deconvolve_invfilt(recording, gs.exp_sweep(50, 7000, 0.5, sample_rate=22050), sample_rate=22050, output_rate=16000)
+    assert abs(np.argmax(np.abs(deconvolved)) - (len(recording_sweep) - 1 + 100)) <= 1
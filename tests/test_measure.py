@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+from scipy import signal
+from ir_module import gen_sine as gs
+from ir_module.measure import DuplexDevice, LoopbackDevice, measure, simulated_room
+
+
+def test_loopback_measurement_recovers_impulse_response():
+    rate, latency, jitter = 16000, 200, 16
+    room = simulated_room(rate, rt60=0.3, seed=7)
+    # a linear sweep has a flat spectrum, so its matched filter recovers the room without tilt
+    sweep = gs.lin_sweep(20, 7900, 1.5, sample_rate=rate)
+    device = LoopbackDevice(rate, room, latency=latency, jitter=jitter, noise_db=-80, seed=3)
+    result = measure(device, sweep, takes=3, tail_seconds=0.5)
+    assert result['takes'] == 3 and len(result['timings']['record']) == 3
+
+    # the direct sound, after the round-trip latency of the first take
+    direct = int(0.003 * rate)
+    peak = np.argmax(np.abs(result['ir'])) - (len(sweep) - 1)
+    assert latency + direct <= peak <= latency + jitter + direct
+
+    trimmed = result['trimmed']
+    assert np.argmax(np.abs(trimmed)) <= int(0.002 * rate) + direct
+    reference = room[:len(trimmed)]
+    similarity = np.max(np.abs(signal.correlate(trimmed, reference))) / (np.linalg.norm(trimmed) * np.linalg.norm(reference))
+    assert similarity > 0.98
+
+
+def test_device_without_play_record_cannot_be_created():
+    class Silent(DuplexDevice):
+        pass
+
+    with pytest.raises(TypeError):
+        Silent()
@@ -0,0 +1,40 @@
+import numpy as np
+from ir_module.convolve import PartitionedConvolver, convolve_audio
+from ir_module.measure import simulated_room
+from ir_module.realtime import StreamingConvolver, stream_blocks
+
+
+def _stream(source, convolver):
+    block_size = convolver.get_block_size()
+    blocks = (source[start:start + block_size] for start in range(0, len(source), block_size))
+    return np.concatenate(list(stream_blocks(blocks, convolver)))
+
+
+def test_streaming_matches_convolve_audio():
+    impulse = simulated_room(48000, rt60=0.3, seconds=0.4, seed=1)
+    source = (np.random.default_rng(0).standard_normal(48000) * 0.1).astype(np.float32)
+    convolver = StreamingConvolver(impulse, block_size=64, max_partition=1024)
+    assert convolver.get_partitioning()[-1][0] == 1024
+    streamed = _stream(source, convolver)
+    expected = convolve_audio(source, impulse) / 0.75
+    assert streamed.shape == expected.shape
+    np.testing.assert_allclose(streamed, expected, atol=1e-4)
+
+
+def test_streaming_stereo_impulse():
+    impulse = simulated_room(48000, rt60=0.2, seconds=0.1, channels=2, seed=2)
+    source = (np.random.default_rng(3).standard_normal(10000) * 0.1).astype(np.float32)
+    streamed = _stream(source, StreamingConvolver(impulse, block_size=128, max_partition=512))
+    expected = convolve_audio(source, impulse) / 0.75
+    assert streamed.shape == (len(source), 2)
+    np.testing.assert_allclose(streamed, expected, atol=1e-4)
+
+
+def test_prepare_in_steps_matches_process():
+    impulse = np.random.default_rng(4).standard_normal(1000) * 0.1
+    source = np.random.default_rng(5).standard_normal(4096) * 0.1
+    whole, staged = PartitionedConvolver(impulse, 64), PartitionedConvolver(impulse, 64)
+    for start in range(0, len(source), 64):
+        block = source[start:start + 64]
+        staged.prepare(start // 64 % 5)
+        np.testing.assert_allclose(staged.process(block), whole.process(block), atol=1e-10)
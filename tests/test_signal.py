@@ -0,0 +1,18 @@
+import numpy as np
+from ir_module.Signal import Signal
+
+
+def test_signal_from_list():
+    signal = Signal([[0.1, -0.1], [0.2, -0.2], [0.3, -0.3]], 8000)
+    assert signal.get_channels() == 2
+    assert signal.get_signal().shape == (3, 2)
+    signal.set_state([0.5, 0.25], 16000, 1, 2)
+    assert signal.get_state() == (16000, 1, 2)
+    assert signal.get_signal().dtype == np.float32
+
+
+def test_set_signal_from_list():
+    signal = Signal(np.zeros(4), 8000)
+    signal.set_signal([[0.1, 0.2, 0.3]] * 5)
+    assert signal.get_channels() == 3
+    assert signal.get_signal().dtype == np.float32
@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from ir_module import wav_util
+
+
+@pytest.fixture(params=[1, 2])
+def wave_file(tmp_path, request):
+    channels = request.param
+    samples = np.random.default_rng(channels).uniform(-0.9, 0.9, (50, channels) if channels > 1 else 50)
+    path = str(tmp_path / f'noise_{channels}.wav')
+    wav_util.write_wav_file_16bit(path, samples, channels, 8000, 2)
+    _, expected = wav_util.read_wave_nbit(path)
+    return wav_util.MappedWave(path), expected
+
+
+@pytest.mark.parametrize('key', [0, 7, -1, slice(3, 20), slice(None, None, -1), slice(40, 5, -3), slice(5, 40, 4), slice(30, 10)])
+def test_mapped_wave_frames(wave_file, key):
+    mapped, expected = wave_file
+    np.testing.assert_array_equal(mapped[key], expected[key])
+
+
+@pytest.mark.parametrize('key', [(5, 1), (-2, 0), (slice(3, 20), 1), (slice(None, None, -2), 0), (slice(40, 5, -3), slice(None, None, -1))])
+def test_mapped_wave_frames_and_channels(tmp_path, key):
+    samples = np.random.default_rng(0).uniform(-0.9, 0.9, (50, 2))
+    path = str(tmp_path / 'stereo.wav')
+    wav_util.write_wav_file_16bit(path, samples, 2, 8000, 2)
+    _, expected = wav_util.read_wave_nbit(path)
+    np.testing.assert_array_equal(wav_util.MappedWave(path)[key], expected[key])